@@ -1,7 +1,10 @@
 import json
+import time
 import urllib.parse
 import boto3
 import pcaconfiguration as cf
+import pcalanes
+import pcatranscribe
 
 # Mime audio type mappings
 mimeAudioMapping = {'audio/wav': 'wav', 'audio/mp4': 'mp4', 'audio/x-flac': 'flac', 'audio/flac': 'flac', 'audio/mpeg': 'mp3', 'audio/mp3': 'mp3'}
@@ -33,19 +36,19 @@ def lambda_handler(event, context):
     else:
         mediaFormat = mimeAudioMapping[mimeFormat]
 
-    # Check a Transcribe job isn't in progress for this file-name
-    jobName = cf.generateJobName(key)
-    try:
-        # If it exists (e.g. doesn't exception) then we may want to delete iz
-        transcribe = boto3.client('transcribe')
-        currentJobStatus = transcribe.get_transcription_job(TranscriptionJobName=jobName)["TranscriptionJob"]["TranscriptionJobStatus"]
-    except Exception as e:
-        # Job didn't already exist - no problem here
-        currentJobStatus = ""
+    # Files moved in by the bulk workflow are tagged as such - everything else is real-time
+    lane = pcalanes.LANE_REALTIME
+    if response.get('TagCount', 0) > 0:
+        tagSet = s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+        for tag in tagSet:
+            if (tag['Key'] == pcalanes.LANE_TAG_NAME) and (tag['Value'] in pcalanes.LANES):
+                lane = tag['Value']
 
-    # If there's a job already running then the input file may have been copied - quit
-    if (currentJobStatus == "IN_PROGRESS") or (currentJobStatus == "QUEUED"):
-        # Throw an exception if this is the case
+    # Check a Transcribe job isn't in progress for this file-name - every submission has its own versioned name,
+    # so look for any version of it
+    jobName = cf.generateJobName(key)
+    if pcatranscribe.isJobActive(boto3.client('transcribe'), jobName):
+        # If there's a job already running then the input file may have been copied - quit
         raise Exception(
             'A Transcription job named \'{}\' is already in progress - cannot continue.'.format(jobName))
 
@@ -61,23 +64,29 @@ def lambda_handler(event, context):
     sfnArn = sfnArnList[0]['stateMachineArn']
 
     # Decide what language this should transcribed in.  The logic is:
-    # SSM:TranscribeLanguages == {2+ languages} => Transcribe Language Detection [blank lang-code]
+    # SSM:TranscribeLanguages == {2+ languages} => Transcribe Language Detection [blank lang-code],
+    #   or with SSM:TranscribeLanguageIdMode == full => identified by the main job ["identify" lang-code]
     # SSM:InputBucketName == {S3 trigger bucket} => SSM:TranscribeLanguages
     # => SSM:TranscribeAlternateLanguage
     transcribeLanguage = ""
-    if not cf.isAutoLanguageDetectionSet():
+    if cf.isSinglePassLanguageIdSet():
+        transcribeLanguage = cf.LANGCODE_IDENTIFY
+    elif not cf.isAutoLanguageDetectionSet():
         if bucket == cf.appConfig[cf.CONF_S3BUCKET_INPUT]:
             transcribeLanguage = cf.appConfig[cf.CONF_TRANSCRIBE_LANG][0]
         else:
             transcribeLanguage = cf.appConfig[cf.CONF_TRANSCRIBE_ALTLANG]
 
-    # Trigger a new Step Function execution
-    parameters = '{\n  \"bucket\": \"' + bucket + '\",\n' +\
-                 '  \"key\": \"' + key + '\",\n' +\
-                 '  \"contentType\": \"' + mediaFormat + '\",\n' + \
-                 '  \"langCode\": \"' + transcribeLanguage + '\"\n' +\
-                 '}'
-    sfnClient.start_execution(stateMachineArn = sfnArn, input = parameters)
+    # Trigger a new Step Function execution, noting the lane and when it joined it
+    parameters = {
+        "bucket": bucket,
+        "key": key,
+        "contentType": mediaFormat,
+        "langCode": transcribeLanguage,
+        "lane": lane,
+        "laneQueuedAt": time.time()
+    }
+    sfnClient.start_execution(stateMachineArn = sfnArn, input = json.dumps(parameters, indent=2))
 
     # Everything was successful
     return {
@@ -1,4 +1,5 @@
 import pcaconfiguration as cf
+import pcamanifest
 import copy
 import boto3
 
@@ -8,8 +9,10 @@ def lambda_handler(event, context):
     once, and re-use them throughout the run, so the config values at the start of the run will
     remain valid.  There is not quick way to count the files in an S3 bucket, so rather than track
     what's left in the bucket we just care about having any left to process and instead count
-    how far we've gotten instead.
+    how far we've gotten instead.  If a bulk manifest has been supplied then it is loaded and sorted into
+    priority order on the first pass, and after that we just track a cursor through it.
     """
+    s3Client = boto3.client('s3')
 
     # Get our params, looking them up if we haven't got them
     if "sourceBucket" in event:
@@ -34,14 +37,37 @@ def lambda_handler(event, context):
         sfData["dripRate"] = max(1, dripRate)
         sfData["filesProcessed"] = 0
 
-    # Just get a single S3 check on whether or not we have files to go
-    s3Client = boto3.client('s3')
-    response = s3Client.list_objects_v2(Bucket=bucket, MaxKeys=dripRate)
-    if "Contents" in response:
-        filesFound = len(response["Contents"])
+        # The manifest is optional - if there isn't one then we just list the bucket each time round
+        try:
+            manifestKey = ssmClient.get_parameter(Name=cf.BULK_MANIFEST)["Parameter"]["Value"]
+        except Exception as e:
+            manifestKey = ""
+        if manifestKey == "undefined":
+            # The parameter hasn't been set, which is the same as not having one
+            manifestKey = ""
+        if manifestKey != "":
+            entries = pcamanifest.loadManifest(s3Client, bucket, manifestKey)
+            if entries is not None:
+                pageBucket = ssmClient.get_parameter(Name=cf.CONF_SUPPORT_BUCKET)["Parameter"]["Value"]
+                sfData["manifestBucket"] = pageBucket
+                sfData["manifestPrefix"] = pcamanifest.writeManifestPages(s3Client, pageBucket, entries)
+                sfData["manifestTotal"] = len(entries)
+                sfData["manifestCursor"] = 0
+
+    if "manifestPrefix" in sfData:
+        # Manifest mode - no need to go near the bucket, as the cursor tells us what's left
+        filesFound = min(dripRate, sfData["manifestTotal"] - sfData["manifestCursor"])
+        if filesFound <= 0:
+            pcamanifest.removeManifestPages(s3Client, sfData["manifestBucket"], sfData["manifestPrefix"],
+                                            sfData["manifestTotal"])
     else:
-        filesFound = 0
-    sfData["filesToMove"] = filesFound
+        # Just get a single S3 check on whether or not we have files to go
+        response = s3Client.list_objects_v2(Bucket=bucket, MaxKeys=dripRate)
+        if "Contents" in response:
+            filesFound = len(response["Contents"])
+        else:
+            filesFound = 0
+    sfData["filesToMove"] = max(0, filesFound)
 
     # Return current event data
     return sfData
@@ -1,10 +1,13 @@
+import pcamanifest
+import pcalanes
 import copy
 import boto3
 
 def lambda_handler(event, context):
     """
     Based upon the queueSpace parameter, this will move up to that many file into the PCA audio bucket, but
-    only up to a maximum number as specified by the dripRate - this ensures that we don't overload they system
+    only up to a maximum number as specified by the dripRate - this ensures that we don't overload they system.
+    If we're working from a manifest then the files are taken in manifest order from the current cursor position
     """
     # Load our event
     sfData = copy.deepcopy(event)
@@ -18,24 +21,35 @@ def lambda_handler(event, context):
 
     # Get as many files from S3 as we can move this time (minimum of queueSpace and dripRate)
     s3Client = boto3.client('s3')
-    response = s3Client.list_objects_v2(Bucket=sourceBucket, MaxKeys=(min(dripRate, queueSpace)))
-    if "Contents" in response:
-        # We now have a list of objects that we can use
-        sourcePrefix = "/" + sourceBucket + "/"
-        keyPrefix = targetAudioKey
-        if keyPrefix != "":
-            keyPrefix += "/"
-        for audioFile in response["Contents"]:
-            try:
-                # Copy and delete file
-                copyResponse = s3Client.copy_object(Bucket=targetBucket,
-                                                    CopySource=(sourcePrefix + audioFile["Key"]),
-                                                    Key=(keyPrefix + audioFile["Key"]))
-                deleteResponse = s3Client.delete_object(Bucket=sourceBucket, Key=audioFile["Key"])
-                movedFiles += 1
-            except:
-                print("Failed to move audio file {}".format(audioFile["Key"]))
-                pass
+    if "manifestPrefix" in sfData:
+        # Take the next block of keys from the manifest, and move the cursor past them whether or not they
+        # move successfully, as otherwise a single missing file would stall the whole run
+        audioKeys = pcamanifest.readManifestEntries(s3Client, sfData["manifestBucket"], sfData["manifestPrefix"],
+                                                    sfData["manifestCursor"], min(dripRate, queueSpace),
+                                                    sfData["manifestTotal"])
+        sfData["manifestCursor"] += len(audioKeys)
+    else:
+        response = s3Client.list_objects_v2(Bucket=sourceBucket, MaxKeys=(min(dripRate, queueSpace)))
+        audioKeys = [audioFile["Key"] for audioFile in response.get("Contents", [])]
+
+    # We now have a list of objects that we can use
+    sourcePrefix = "/" + sourceBucket + "/"
+    keyPrefix = targetAudioKey
+    if keyPrefix != "":
+        keyPrefix += "/"
+    for audioKey in audioKeys:
+        try:
+            # Copy and delete file, tagging the copy so that it goes through the bulk Transcribe lane
+            copyResponse = s3Client.copy_object(Bucket=targetBucket,
+                                                CopySource=(sourcePrefix + audioKey),
+                                                Key=(keyPrefix + audioKey),
+                                                Tagging=(pcalanes.LANE_TAG_NAME + "=" + pcalanes.LANE_BULK),
+                                                TaggingDirective="REPLACE")
+            deleteResponse = s3Client.delete_object(Bucket=sourceBucket, Key=audioKey)
+            movedFiles += 1
+        except:
+            print("Failed to move audio file {}".format(audioKey))
+            pass
 
     # Increase our counter, remove the queue value and return
     sfData["filesProcessed"] += movedFiles
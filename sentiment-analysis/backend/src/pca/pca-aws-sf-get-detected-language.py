@@ -1,4 +1,5 @@
 from urllib.parse import urlparse
+import pcatranscribe
 import boto3
 import copy
 
@@ -8,14 +9,17 @@ def lambda_handler(event, context):
     sfData = copy.deepcopy(event)
     transcribeJob = sfData["jobName"]
 
-    # Load in the Amazon Transcribe job header information, ensuring that the job has completed
+    # Use the Amazon Transcribe job header information from the workflow state, only going
+    # to Transcribe if it isn't there, and ensure that the job has completed
     transcribe = boto3.client("transcribe")
-    try:
-        transcribeJobInfo = transcribe.get_transcription_job(TranscriptionJobName=transcribeJob)["TranscriptionJob"]
-        assert transcribeJobInfo[
-                "TranscriptionJobStatus"] == "COMPLETED", f"Transcription job '{transcribeJob}' has not yet completed."
-    except transcribe.exceptions.BadRequestException:
-        assert False, f"Unable to load information for Transcribe job named '{transcribeJob}'."
+    transcribeJobInfo = pcatranscribe.getJobDescriptor(sfData, transcribeJob)
+    if transcribeJobInfo is None:
+        try:
+            transcribeJobInfo = transcribe.get_transcription_job(TranscriptionJobName=transcribeJob)["TranscriptionJob"]
+        except transcribe.exceptions.BadRequestException:
+            assert False, f"Unable to load information for Transcribe job named '{transcribeJob}'."
+    assert transcribeJobInfo[
+            "TranscriptionJobStatus"] == "COMPLETED", f"Transcription job '{transcribeJob}' has not yet completed."
 
     # Find our job information and delete it
     try:
@@ -31,6 +35,7 @@ def lambda_handler(event, context):
         transcribe.delete_transcription_job(TranscriptionJobName=transcribeJob)
         sfData.pop("jobName", None)
         sfData.pop("transcribeStatus", None)
+        sfData.pop("transcribeJobInfo", None)
     except:
         # File already gone somehow - nothing for us to do
         pass
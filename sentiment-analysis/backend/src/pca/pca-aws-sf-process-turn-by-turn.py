@@ -7,7 +7,22 @@ from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
 import pcaconfiguration as cf
+import pcatranscribe
+import pcarefresh
+import pcapatch
+import pcaoutput
+import pcabatch
+import pcaexport
+import pcarollup
+import pcasearch
+import pcaindexer
+import pcacheckpoint
+import pcashedding
+import pcaratelimit
+import pcaworker
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import threading
 import copy
 import re
 import json
@@ -15,6 +30,7 @@ import csv
 import boto3
 import sys
 import time
+import os
 
 # Sentiment helpers
 MIN_SENTIMENT_LENGTH = 16
@@ -24,6 +40,47 @@ NLP_THROTTLE_RETRIES = 1
 PII_PLACEHOLDER = "[PII]"
 TMP_DIR = "/tmp"
 
+# Processing status of a results file - the transcript alone, published as soon as it's ready, and then the
+# complete results once sentiment and entity detection have finished
+STATUS_TRANSCRIBED = "TRANSCRIBED"
+STATUS_PARTIAL = "PARTIAL"
+STATUS_COMPLETE = "COMPLETE"
+
+# Time left in the Lambda invocation at which we stop sending segments to Comprehend, which leaves enough time to
+# publish what we have, and how many times a call can be handed on to a new invocation to finish its NLP before
+# its partial results become final
+NLP_DEADLINE_MARGIN_MS = 60000
+NLP_CONTINUATION_LIMIT = 5
+
+# Where the sentiment rollups are kept - the DynamoDB table, or a local SQLite file when running outside Lambda
+ROLLUP_TABLE = os.environ.get("RollupTableName", "")
+ROLLUP_DATABASE = os.environ.get("RollupDatabase", "")
+
+# Local folder for the processing checkpoints when running outside Lambda, which is used instead of S3, and the
+# parser state that goes into a checkpoint alongside the speech segments
+CHECKPOINT_FOLDER = os.environ.get("CheckpointFolder", "")
+CHECKPOINT_PARSER_STATE = ["numWordsParsed", "cummulativeWordAccuracy", "maxSpeakerIndex", "duration",
+                           "matchedSimpleEntities", "headerEntityDict", "audioPlaybackUri", "deferredStages"]
+
+# Workflow tracking table, which holds the load-shedding circuit breakers and the Comprehend rate limit token
+# buckets - they're only held in memory if unset
+TRACKING_TABLE = os.environ.get("TableName", "")
+
+# Comprehend rate limiter, which is kept for the life of the process so that its leased tokens aren't wasted
+RATE_LIMITER = None
+
+# AWS clients, which are kept for the life of the process, and how long the warm cache of the configuration, the
+# custom entity endpoints and the simple entity maps keeps them.  Nothing is cached by default, as a Lambda
+# invocation should see any change to them, but a worker process keeps them for a few minutes and a batch
+# invocation keeps its lookups for as long as a Lambda can run
+AWS_CLIENTS = {}
+CLIENT_LOCK = threading.RLock()
+WORKER_CACHE_SECONDS = 300
+BATCH_CACHE_SECONDS = 900
+
+# How many jobs of a batch invocation are parsed at once, unless the event says otherwise
+BATCH_JOB_CONCURRENCY = 4
+
 
 class SpeechSegment:
     """ Class to hold information about a single speech segment """
@@ -43,8 +100,12 @@ class SpeechSegment:
 
 
 class TranscribeParser:
+    """
+    Class to parse the output of a Transcribe job.  The configuration must already be loaded, as it's never
+    reloaded here - parsers can be running side by side on threads that are all reading it
+    """
 
-    def __init__(self, minSentimentPos, minSentimentNeg, customEntityEndpoint):
+    def __init__(self, minSentimentPos, minSentimentNeg, customEntityEndpoint, warmCache=None):
         self.min_sentiment_positive = minSentimentPos
         self.min_sentiment_negative = minSentimentNeg
         self.transcribeJobInfo = ""
@@ -63,14 +124,18 @@ class TranscribeParser:
         self.matchedSimpleEntities = {}
         self.audioPlaybackUri = ""
         self.duration = 0.0
-        cf.loadConfiguration()
+        self.processingStatus = STATUS_TRANSCRIBED
+        self.nextContinuation = None
+        self.checkpoint = None
+        self.shedder = None
+        self.deferredStages = []
+        self.warmCache = WARM_CACHE if warmCache is None else warmCache
 
         # Check the model exists - if now we may use simple file entity detection instead
         if self.customEntityEndpointName != "":
             # Get the ARN for our classifier endpoint, getting out quickly if there
             # isn't one defined or if we can't find the one that is defined
-            comprehendClient = boto3.client("comprehend")
-            recognizerList = comprehendClient.list_endpoints()
+            recognizerList = self.warmCache.read("endpoints", lambda: getClient("comprehend").list_endpoints())
             recognizer = list(filter(lambda x: x["EndpointArn"].endswith(self.customEntityEndpointName),
                                      recognizerList["EndpointPropertiesList"]))
 
@@ -155,6 +220,8 @@ class TranscribeParser:
         resultsHeaderInfo["ProcessTime"] = str(datetime.now())
         resultsHeaderInfo["LanguageCode"] = self.conversationLanguageCode
         resultsHeaderInfo["Duration"] = str(self.duration)
+        resultsHeaderInfo["Status"] = self.processingStatus
+        resultsHeaderInfo[pcapatch.SCHEMA_VERSION_FIELD] = pcapatch.getCurrentSchemaVersion()
         if self.conversationTime == "":
             resultsHeaderInfo["ConversationTime"] = resultsHeaderInfo["ProcessTime"]
 
@@ -369,8 +436,13 @@ class TranscribeParser:
         if float(entityLine['Score']) >= cf.appConfig[cf.CONF_ENTITYCONF]:
             entityType = entityLine['Type']
 
-            # If we have a type filter then ensure we match it before adding the entry
-            if (typeFilter == []) or (entityType in typeFilter):
+            # If we have a type filter then ensure we match it before adding the entry, but never add the
+            # same entity twice, which can happen when a backfill re-runs an entity stage
+            alreadyDetected = [entity for entity in speechSegment.segmentCustomEntities
+                               if (entity["Type"] == entityType) and
+                               (entity["BeginOffset"] == entityLine["BeginOffset"]) and
+                               (entity["EndOffset"] == entityLine["EndOffset"])]
+            if ((typeFilter == []) or (entityType in typeFilter)) and (alreadyDetected == []):
 
                 # Update our header entry
                 self.updateHeaderEntityCount(entityType, entityLine["Text"])
@@ -436,69 +508,136 @@ class TranscribeParser:
 
         return locationEntityResponse
 
-    def performComprehendNLP(self, segmentList):
+    def orderSegmentsForNLP(self, segmentList, segmentIndexes=None):
+        """
+        Returns the indexes of the segments that are long enough to need NLP, in the order that they should be
+        done - longest first unless configured otherwise, so if we run out of time it's the short turns that
+        are left
+        """
+        if segmentIndexes is None:
+            segmentIndexes = range(len(segmentList))
+        indexes = [index for index in segmentIndexes if len(segmentList[index].segmentText) >= MIN_SENTIMENT_LENGTH]
+        if cf.appConfig[cf.CONF_NLP_PRIORITY] == cf.NLP_PRIORITY_LONGEST:
+            indexes = sorted(indexes, key=lambda index: -len(segmentList[index].segmentText))
+        return indexes
+
+    def performComprehendNLP(self, segmentList, isOutOfTime=None, segmentIndexes=None):
         """
         Generates sentiment per speech segment, inserting the results into the input list.
         If we had no valid language for Comprehend to use then we use Neutral for everything.
         It also extracts standard LOCATION entities, and calls any custom entity recognition
-        model that has been configured for that language
+        model that has been configured for that language.  Only the given segments are done, if
+        any are given, and we stop once isOutOfTime says that we're near our deadline, returning
+        the indexes of the segments that still need doing
         """
-        client = boto3.client("comprehend")
+        client = createComprehendClient()
 
         # Work out with Comprehend language model to use
         if self.comprehendLanguageCode == "":
             # If there's no language model then everything is Neutral
             neutralSentimentSet = {'Positive': 0.0, 'Negative': 0.0, 'Neutral': 1.0, 'Mixed': 0.0}
 
-        # Go through each of our segments
-        for nextSegment in segmentList:
-            if len(nextSegment.segmentText) >= MIN_SENTIMENT_LENGTH:
-                nextText = nextSegment.segmentText
-                # If we have a language model then extract sentiment via Comprehend
-                if self.comprehendLanguageCode != "":
-                    # Get sentiment and standard entity detection from Comprehend
-                    sentimentResponse = self.comprehendSingleSentiment(nextText, client)
-                    locationEntityResponse = self.comprehendSingleEntity(nextText, client)
-
-                    # We're only interested in LOCATION standard entities
-                    for detectedEntity in locationEntityResponse["Entities"]:
-                        self.extractEntitiesFromLine(detectedEntity, nextSegment, ["LOCATION"])
-
-                    # Now do the same for any entities we can find in a custom model.  At the
-                    # time of writing, Custom Entity models in Comprehend are ENGLISH ONLY
-                    if (self.customEntityEndpointARN != "") and (self.comprehendLanguageCode == "en"):
-                        # Call the custom model and insert
-                        customEntityResponse = client.detect_entities(Text=nextText,
-                                                                      EndpointArn=self.customEntityEndpointARN)
-                        for detectedEntity in customEntityResponse["Entities"]:
-                            self.extractEntitiesFromLine(detectedEntity, nextSegment, [])
-
-                    # Now onto the sentiment - begin by storing the raw values
-                    positiveBase = sentimentResponse["SentimentScore"]["Positive"]
-                    negativeBase = sentimentResponse["SentimentScore"]["Negative"]
-
-                    # If we're over the NEGATIVE threshold then we're negative
-                    if negativeBase >= self.min_sentiment_negative:
-                        nextSegment.segmentSentiment = "Negative"
-                        nextSegment.segmentIsNegative = True
-                        nextSegment.segmentSentimentScore = negativeBase
-                    # Else if we're over the POSITIVE threshold then we're positive,
-                    # otherwise we're either MIXED or NEUTRAL and we don't really care
-                    elif positiveBase >= self.min_sentiment_positive:
-                        nextSegment.segmentSentiment = "Positive"
-                        nextSegment.segmentIsPositive = True
-                        nextSegment.segmentSentimentScore = positiveBase
-
-                    # Store all of the original sentiments for future use
-                    nextSegment.segmentAllSentiments = sentimentResponse["SentimentScore"]
-                    nextSegment.segmentPositive = positiveBase
-                    nextSegment.segmentNegative = negativeBase
-                else:
-                    # We had no language - default sentiment, no new entities
-                    nextSegment.segmentAllSentiments = neutralSentimentSet
-                    nextSegment.segmentPositive = 0.0
-                    nextSegment.segmentNegative = 0.0
+        # Go through each of our segments in priority order, until we run out of time,
+        # checkpointing as we go so that a retry doesn't repeat the Comprehend calls
+        pendingIndexes = self.orderSegmentsForNLP(segmentList, segmentIndexes)
+        processedCount = 0
+        while pendingIndexes != []:
+            if (isOutOfTime is not None) and isOutOfTime():
+                print(f"Near the time limit with {len(pendingIndexes)} segments still needing NLP")
+                break
+            if (processedCount > 0) and (processedCount % pcacheckpoint.NLP_CHECKPOINT_SEGMENTS == 0):
+                self.saveCheckpoint(pendingIndexes=pendingIndexes)
+            processedCount += 1
+            nextSegment = segmentList[pendingIndexes.pop(0)]
+            nextText = nextSegment.segmentText
+            # If we have a language model then extract sentiment via Comprehend
+            if self.comprehendLanguageCode != "":
+                # Get sentiment and entity detection from Comprehend
+                sentimentResponse = self.comprehendSingleSentiment(nextText, client)
+                self.detectSegmentEntities(nextSegment, client)
+
+                # Now onto the sentiment - begin by storing the raw values
+                positiveBase = sentimentResponse["SentimentScore"]["Positive"]
+                negativeBase = sentimentResponse["SentimentScore"]["Negative"]
+
+                # If we're over the NEGATIVE threshold then we're negative
+                if negativeBase >= self.min_sentiment_negative:
+                    nextSegment.segmentSentiment = "Negative"
+                    nextSegment.segmentIsNegative = True
+                    nextSegment.segmentSentimentScore = negativeBase
+                # Else if we're over the POSITIVE threshold then we're positive,
+                # otherwise we're either MIXED or NEUTRAL and we don't really care
+                elif positiveBase >= self.min_sentiment_positive:
+                    nextSegment.segmentSentiment = "Positive"
+                    nextSegment.segmentIsPositive = True
+                    nextSegment.segmentSentimentScore = positiveBase
+
+                # Store all of the original sentiments for future use
+                nextSegment.segmentAllSentiments = sentimentResponse["SentimentScore"]
+                nextSegment.segmentPositive = positiveBase
+                nextSegment.segmentNegative = negativeBase
+            else:
+                # We had no language - default sentiment, no new entities
+                nextSegment.segmentAllSentiments = neutralSentimentSet
+                nextSegment.segmentPositive = 0.0
+                nextSegment.segmentNegative = 0.0
+
+        return sorted(pendingIndexes)
+
+    def detectSegmentEntities(self, segment, client):
+        """
+        Adds the standard LOCATION entities and any custom entities to a segment, unless those stages are being
+        shed.  If we're shedding load and either one fails then its circuit breaker hears about it, and that
+        stage is deferred for the rest of the call
+        """
+        # We're only interested in LOCATION standard entities
+        if not self.isStageShed(pcashedding.STAGE_STANDARD_ENTITIES):
+            try:
+                locationEntityResponse = self.comprehendSingleEntity(segment.segmentText, client)
+                self.recordStageSuccess(pcashedding.BREAKER_COMPREHEND)
+                for detectedEntity in locationEntityResponse["Entities"]:
+                    self.extractEntitiesFromLine(detectedEntity, segment, ["LOCATION"])
+            except Exception as e:
+                self.recordStageFailure(pcashedding.BREAKER_COMPREHEND, pcashedding.STAGE_STANDARD_ENTITIES, e)
+
+        # Now do the same for any entities we can find in a custom model.  At the
+        # time of writing, Custom Entity models in Comprehend are ENGLISH ONLY
+        if (self.customEntityEndpointARN != "") and (self.comprehendLanguageCode == "en") and \
+                not self.isStageShed(pcashedding.STAGE_CUSTOM_ENTITIES):
+            # Call the custom model and insert
+            try:
+                customEntityResponse = client.detect_entities(Text=segment.segmentText,
+                                                              EndpointArn=self.customEntityEndpointARN)
+                self.recordStageSuccess(pcashedding.BREAKER_CUSTOM_ENDPOINT)
+                for detectedEntity in customEntityResponse["Entities"]:
+                    self.extractEntitiesFromLine(detectedEntity, segment, [])
+            except Exception as e:
+                self.recordStageFailure(pcashedding.BREAKER_CUSTOM_ENDPOINT, pcashedding.STAGE_CUSTOM_ENTITIES, e)
+
+    def isStageShed(self, stage):
+        """
+        Returns True if an optional stage is being shed, in which case it is recorded as deferred for backfill
+        """
+        if (self.shedder is None) or not self.shedder.isShed(stage):
+            return False
+        if stage not in self.deferredStages:
+            self.deferredStages.append(stage)
+        return True
 
+    def recordStageSuccess(self, breaker):
+        if self.shedder is not None:
+            self.shedder.recordSuccess(breaker)
+
+    def recordStageFailure(self, breaker, stage, error):
+        """
+        Tells the circuit breaker about a failed stage and defers that stage, or just fails if we're not
+        shedding load, as we always used to
+        """
+        if self.shedder is None:
+            raise error
+        print(f"Deferring {stage} after a failure ({str(error)})")
+        self.shedder.recordFailure(breaker)
+        self.isStageShed(stage)
 
     def generateSpeakerLabel(self, transcribeSpeaker):
         '''
@@ -687,20 +826,62 @@ class TranscribeParser:
             speechSegmentList = sorted(speechSegmentList, key=lambda segment: segment.segmentStartTime)
             speechSegmentList = self.mergeSpeakerSegments(speechSegmentList)
 
+        # Now set the overall call duration if we actually had any speech
+        if len(speechSegmentList) > 0:
+            self.duration = float(speechSegmentList[-1].segmentConfidence[-1]["EndTime"])
+
+        # Return our full turn-by-turn speaker segment list, which has no sentiment or entities yet
+        return speechSegmentList
+
+    def enrichSpeechSegments(self, speechSegmentList, isOutOfTime=None, segmentIndexes=None):
+        """
+        Adds the sentiment and entities to the turn-by-turn segments, or to just the given segments, which marks
+        our results as complete.  If we run out of time first then they are only partial, and the indexes of the
+        segments that still need doing are returned
+        """
         # Inject sentiments into the segment list
-        self.performComprehendNLP(speechSegmentList)
+        pendingIndexes = self.performComprehendNLP(speechSegmentList, isOutOfTime, segmentIndexes)
+        if pendingIndexes != []:
+            self.processingStatus = STATUS_PARTIAL
+            return pendingIndexes
 
         # If we ended up with any matched simple entities then insert
         # them, which we can now do as we now have the sentence order
-        if self.matchedSimpleEntities != {}:
+        if self.simpleEntityMatchingUsed and self.isStageShed(pcashedding.STAGE_SIMPLE_ENTITIES):
+            pass
+        elif self.matchedSimpleEntities != {}:
             self.createSimpleEntityEntries(speechSegmentList)
 
-        # Now set the overall call duration if we actually had any speech
-        if len(speechSegmentList) > 0:
-            self.duration = float(speechSegmentList[-1].segmentConfidence[-1]["EndTime"])
+        self.processingStatus = STATUS_COMPLETE
+        return []
 
-        # Return our full turn-by-turn speaker segment list with sentiment
-        return speechSegmentList
+    def restoreEnrichment(self, data, pendingIndexes):
+        """
+        Copies the sentiment and entities of the segments that an earlier invocation had finished, and its MP3
+        playback file, back from its partial results.  Returns False if those results don't match our segments,
+        in which case nothing is copied
+        """
+        if len(data["SpeechSegments"]) != len(self.speechSegmentList):
+            return False
+
+        for index, (segment, output) in enumerate(zip(self.speechSegmentList, data["SpeechSegments"])):
+            if (index not in pendingIndexes) and (output["BaseSentimentScores"] != []):
+                segment.segmentIsPositive = bool(output["SentimentIsPositive"])
+                segment.segmentIsNegative = bool(output["SentimentIsNegative"])
+                segment.segmentSentimentScore = output["SentimentScore"]
+                if segment.segmentIsPositive or segment.segmentIsNegative:
+                    segment.segmentSentiment = "Positive" if segment.segmentIsPositive else "Negative"
+                segment.segmentAllSentiments = output["BaseSentimentScores"]
+                segment.segmentPositive = output["BaseSentimentScores"]["Positive"]
+                segment.segmentNegative = output["BaseSentimentScores"]["Negative"]
+                segment.segmentCustomEntities = output["EntitiesDetected"]
+                for entity in output["EntitiesDetected"]:
+                    self.updateHeaderEntityCount(entity["Type"], entity["Text"])
+
+        jobInfo = data["ConversationAnalytics"]["SourceInformation"][0]["TranscribeJobInfo"]
+        if jobInfo["MediaFileUri"] != jobInfo["MediaOriginalUri"]:
+            self.audioPlaybackUri = jobInfo["MediaFileUri"]
+        return True
 
     def createSimpleEntityEntries(self, speechSegments):
         """
@@ -768,29 +949,23 @@ class TranscribeParser:
             if (self.comprehendLanguageCode != ""):
                 key = key.split('.csv')[0] + "-" + self.comprehendLanguageCode + ".csv"
 
-            # Then check that the language-specific mapping file actually exists
-            s3 = boto3.client("s3")
+            # Then load the language-specific mapping file, if it actually exists
             bucket = cf.appConfig[cf.CONF_SUPPORT_BUCKET]
-            try:
-                response = s3.get_object(Bucket=bucket, Key=key)
-            except Exception as e:
+            entityMap = self.warmCache.read("entityMap#" + key, lambda: readSimpleEntityStringMap(bucket, key))
+            if entityMap is None:
                 # Mapping file doesn't exist, so just quietly exit but log something
                 print("ERROR: Configured simple entity file {} in bucket {} does not exist - entity detection not possible".format(key, bucket))
                 self.simpleEntityMatchingUsed = False
                 return
+            self.simpleEntityMap = entityMap
 
-            # Go download the mapping file and get it into a structure
-            mapFilepath = TMP_DIR + '/' + cf.appConfig[cf.CONF_ENTITY_FILE]
-            s3.download_file(bucket, key, mapFilepath)
-            reader = csv.DictReader(open(mapFilepath, errors="ignore"))
-            try:
-                for row in reader:
-                    origTerm = row.pop("Text")
-                    checkTerm = origTerm.lower()
-                    if not (checkTerm in self.simpleEntityMap):
-                        self.simpleEntityMap[checkTerm] = { "Type": row.pop("Type"), "Original": origTerm }
-            except Exception as e:
-                print(e)
+    def isPlaybackMP3AudioNeeded(self):
+        """
+        Returns True if the audio has to be transcoded to MP3 for playback - 8Khz WAV or non-standard bucket audio
+        """
+        bucket = urlparse(self.transcribeJobInfo["Media"]["MediaFileUri"]).netloc
+        return (bucket != cf.appConfig[cf.CONF_S3BUCKET_INPUT]) or \
+            ((self.transcribeJobInfo["MediaFormat"] == "wav") and (self.transcribeJobInfo["MediaSampleRateHertz"] == 8000))
 
     def createPlaybackMP3Audio(self):
         """
@@ -807,13 +982,12 @@ class TranscribeParser:
         bucket = s3Object.netloc
 
         # 8Khz WAV or non-standard bucket audio gets converted
-        if (bucket != cf.appConfig[cf.CONF_S3BUCKET_INPUT]) or\
-                ((self.transcribeJobInfo["MediaFormat"] == "wav") and (self.transcribeJobInfo["MediaSampleRateHertz"] == 8000)):
+        if self.isPlaybackMP3AudioNeeded():
             # First, we need to download the original audio file
             fileObject = s3Object.path.lstrip('/')
             inputFilename = TMP_DIR + '/' + fileObject.split('/')[-1]
             outputFilename = inputFilename.split('.wav')[0] + '.mp3'
-            s3Client = boto3.client('s3')
+            s3Client = getClient("s3")
             s3Client.download_file(bucket, fileObject, inputFilename)
 
             # Transform the file via FFMPEG - this will exception if not installed
@@ -830,20 +1004,86 @@ class TranscribeParser:
                 print(e)
                 print("Unable to create MP3 version of original audio file - could not find FFMPEG libraries")
 
-    def parseTranscribeFile(self, transcribeJob):
+    def saveCheckpoint(self, stage=None, pendingIndexes=None):
         """
-        Parses the output from the specified Transcribe job
+        Writes the speech segments and the parser state to our checkpoint, along with the stage that we've
+        reached and the segments that still need their NLP, if given
         """
-        # Load in the Amazon Transcribe job header information, ensuring that the job has completed
-        transcribe = boto3.client("transcribe")
-        try:
-            self.transcribeJobInfo = transcribe.get_transcription_job(TranscriptionJobName = transcribeJob)["TranscriptionJob"]
-            assert self.transcribeJobInfo["TranscriptionJobStatus"] == "COMPLETED", f"Transcription job '{transcribeJob}' has not yet completed."
-        except transcribe.exceptions.BadRequestException:
-            assert False, f"Unable to load information for Transcribe job named '{transcribeJob}'."
+        if self.checkpoint is None:
+            return
+        state = {"Segments": [vars(segment) for segment in self.speechSegmentList],
+                 "Parser": {name: getattr(self, name) for name in CHECKPOINT_PARSER_STATE}}
+        if pendingIndexes is not None:
+            state["PendingSegments"] = sorted(pendingIndexes)
+        self.checkpoint.save(stage, **state)
+
+    def restoreCheckpoint(self):
+        """
+        Restores the speech segments and the parser state from our checkpoint, returning the indexes of the
+        segments that still need their NLP, or None if it hadn't been started
+        """
+        for name, value in self.checkpoint.data["Parser"].items():
+            setattr(self, name, value)
+        self.speechSegmentList = []
+        for fields in self.checkpoint.data["Segments"]:
+            segment = SpeechSegment()
+            segment.__dict__.update(fields)
+            self.speechSegmentList.append(segment)
+        return self.checkpoint.data.get("PendingSegments")
 
-        # Create an MP3 playback file if we have to
-        self.createPlaybackMP3Audio()
+    def writeSearchIndexItems(self, resultsKey, outputJson, storedMetadata):
+        """
+        Writes this call's final items to the web UI's search table if configured, returning the metadata that
+        tells the UI's indexer that it can skip the results file.  The items are only written if the stored
+        results weren't already indexed with this same content.  If the items can't be written then the indexer
+        is left to do it, as it would have done anyway
+        """
+        if not cf.isSearchIndexTableSet():
+            return {}
+        indexedMetadata = {pcaoutput.INDEXED_HASH_METADATA: pcaoutput.computeContentHash(outputJson)}
+        if storedMetadata.get(pcaoutput.INDEXED_HASH_METADATA) == indexedMetadata[pcaoutput.INDEXED_HASH_METADATA]:
+            return indexedMetadata
+        try:
+            pcaindexer.writeIndexItems(getClient("dynamodb"), cf.appConfig[cf.CONF_SEARCH_INDEX_TABLE],
+                                       resultsKey, outputJson)
+            return indexedMetadata
+        except Exception as e:
+            print(f"Unable to write search index items for {resultsKey}, leaving it to the indexer ({str(e)})")
+            return {}
+
+    def moveExportPartition(self, s3Client, outputS3Bucket, resultsKey, outputJson, storedMetadata):
+        """
+        Returns the metadata that records the Parquet partition that the final results are exported to, if that's
+        configured.  If the call was exported to a different partition before then it's taken out of that one
+        first, which is done before the results are published so that a retry would still know where it was
+        """
+        if not cf.isParquetExportSet():
+            return {}
+        partitionName = pcaexport.generatePartitionName(pcaexport.generatePartition(outputJson))
+        previousName = storedMetadata.get(pcaoutput.EXPORT_PARTITION_METADATA)
+        if (previousName is not None) and (previousName != partitionName):
+            pcaexport.removeCallExport(s3Client, outputS3Bucket, cf.appConfig[cf.CONF_PREFIX_PARSED_EXPORT],
+                                       resultsKey, previousName)
+        return {pcaoutput.EXPORT_PARTITION_METADATA: partitionName}
+
+    def parseTranscribeFile(self, transcribeJob, transcribeJobInfo=None, isOutOfTime=None, continuation=None):
+        """
+        Parses the output from the specified Transcribe job.  If the workflow has already given us the job
+        information then we use that, otherwise we have to go and get it from Transcribe.  If isOutOfTime
+        says that we're near our deadline before the NLP is finished then the partial results are published
+        and nextContinuation is set to what the next invocation needs to finish them off, which it passes
+        in as the continuation
+        """
+        # Load in the Amazon Transcribe job header information, ensuring that the job has completed
+        if transcribeJobInfo is not None:
+            self.transcribeJobInfo = transcribeJobInfo
+        else:
+            transcribe = getClient("transcribe")
+            try:
+                self.transcribeJobInfo = transcribe.get_transcription_job(TranscriptionJobName = transcribeJob)["TranscriptionJob"]
+            except transcribe.exceptions.BadRequestException:
+                assert False, f"Unable to load information for Transcribe job named '{transcribeJob}'."
+        assert self.transcribeJobInfo["TranscriptionJobStatus"] == "COMPLETED", f"Transcription job '{transcribeJob}' has not yet completed."
 
         # Pick out the config parameters that we need
         outputS3Bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
@@ -860,159 +1100,617 @@ class TranscribeParser:
         else:
             uri = self.transcribeJobInfo["Transcript"]["TranscriptFileUri"]
         offset = uri.find(outputS3Bucket) + len(outputS3Bucket) + 1
-        self.jsonOutputFilename = uri[offset:]
-        jsonFilepath = TMP_DIR + '/' + self.jsonOutputFilename
-        s3Client = boto3.client('s3')
+        transcriptKey = uri[offset:]
+        jsonFilepath = TMP_DIR + '/' + transcriptKey
+        s3Client = getClient("s3")
+
+        # Our results are written under the un-versioned name, so re-transcribing
+        # a file replaces its earlier results rather than adding a second copy
+        self.jsonOutputFilename = pcatranscribe.removeJobNameVersion(transcriptKey)
 
-        # Now download - this has been known to get a "404 HeadObject Not Found",
+        # Find the version of the transcript - this has been known to get a "404 HeadObject Not Found",
         # which makes no sense, so if that happens then re-try in a sec.  Only once.
         try:
-            s3Client.download_file(outputS3Bucket, self.jsonOutputFilename, jsonFilepath)
+            transcriptETag = s3Client.head_object(Bucket=outputS3Bucket, Key=transcriptKey)["ETag"]
         except:
             time.sleep(3)
-            s3Client.download_file(outputS3Bucket, self.jsonOutputFilename, jsonFilepath)
-
-        # Before we process, let's load up any required simply entity map
-        self.loadSimpleEntityStringMap()
-
-        # Now create turn-by-turn diarisation, with associated sentiments and entities
-        self.speechSegmentList = self.createTurnByTurnSegments(jsonFilepath)
+            transcriptETag = s3Client.head_object(Bucket=outputS3Bucket, Key=transcriptKey)["ETag"]
+
+        # Work out which optional stages we're shedding this time, keeping hold of those that an
+        # earlier invocation for this call had already deferred
+        self.shedder = createLoadShedder()
+        if continuation is not None:
+            self.deferredStages = list(continuation.get("deferredStages", []))
+
+        # If an earlier attempt at this transcript left a checkpoint then carry on from there, otherwise
+        # download it, load up any required simple entity map and create the turn-by-turn diarisation
+        self.checkpoint = pcacheckpoint.Checkpoint(createCheckpointStore(s3Client), transcribeJob, transcriptETag)
+        pendingIndexes = None
+        if self.checkpoint.hasReached(pcacheckpoint.STAGE_SEGMENTS):
+            pendingIndexes = self.restoreCheckpoint()
+        else:
+            s3Client.download_file(outputS3Bucket, transcriptKey, jsonFilepath)
+            self.loadSimpleEntityStringMap()
+            self.speechSegmentList = self.createTurnByTurnSegments(jsonFilepath)
+            self.saveCheckpoint(pcacheckpoint.STAGE_SEGMENTS)
+
+        # Publish the transcript straight away if this is a new call - an earlier
+        # version of a call stays in place until we have the complete one
+        resultsKey = outputS3Key + '/' + self.jsonOutputFilename
+        isNewCall = pcaoutput.readStoredMetadata(s3Client, outputS3Bucket, resultsKey) is None
+        self.fixConversationTime(s3Client, outputS3Bucket, resultsKey, isNewCall)
+        if isNewCall:
+            self.publishResults(s3Client, outputS3Bucket, resultsKey)
+
+        # If we're carrying on from an earlier invocation without a checkpoint then pick up what it had
+        # published, otherwise create an MP3 playback file if we haven't already, then add the sentiments
+        # and entities
+        if (pendingIndexes is None) and (continuation is not None) and \
+                self.restoreEnrichment(pcaoutput.readParsedResults(s3Client, outputS3Bucket, resultsKey)[0],
+                                       continuation["pendingSegments"]):
+            pendingIndexes = continuation["pendingSegments"]
+        elif not self.checkpoint.hasReached(pcacheckpoint.STAGE_PLAYBACK):
+            if self.isPlaybackMP3AudioNeeded() and not self.isStageShed(pcashedding.STAGE_PLAYBACK):
+                self.createPlaybackMP3Audio()
+            self.saveCheckpoint(pcacheckpoint.STAGE_PLAYBACK)
+        pendingIndexes = self.enrichSpeechSegments(self.speechSegmentList, isOutOfTime, pendingIndexes)
+        if pendingIndexes != []:
+            self.saveCheckpoint(pendingIndexes=pendingIndexes)
+        outputJson = self.publishResults(s3Client, outputS3Bucket, resultsKey)
+
+        # Hand any unfinished NLP on to another invocation, unless this call has had too many already,
+        # in which case the partial results are final
+        attempt = 1 if continuation is None else continuation["attempt"] + 1
+        if (pendingIndexes != []) and (attempt <= NLP_CONTINUATION_LIMIT):
+            self.nextContinuation = {"pendingSegments": pendingIndexes, "attempt": attempt,
+                                     "deferredStages": self.deferredStages}
+            return self.jsonOutputFilename
+        self.recordFinalResults(s3Client, outputS3Bucket, resultsKey, outputJson)
+
+        # Queue up any stages that we shed for backfilling, or clear out any earlier marker if we didn't shed
+        # anything, as this call is now fully enriched
+        if cf.isLoadSheddingSet():
+            if self.deferredStages != []:
+                pcashedding.writeBackfillMarker(s3Client, outputS3Bucket, cf.appConfig[cf.CONF_PREFIX_BACKFILL],
+                                                resultsKey, self.deferredStages)
+            else:
+                s3Client.delete_object(Bucket=outputS3Bucket, Key=pcashedding.generateMarkerKey(
+                    cf.appConfig[cf.CONF_PREFIX_BACKFILL], resultsKey))
 
-        # Write out the JSON data to our S3 location
-        s3Resource = boto3.resource('s3')
-        s3Object = s3Resource.Object(outputS3Bucket, outputS3Key + '/' + self.jsonOutputFilename)
-        s3Object.put(
-            Body=(bytes(json.dumps(self.outputAsJSON()).encode('UTF-8')))
-        )
+        # Everything's done, so a retry would have to start again anyway
+        self.checkpoint.discard()
 
         # Return our filename for re-use later
         return self.jsonOutputFilename
 
+    def recordFinalResults(self, s3Client, outputS3Bucket, resultsKey, outputJson):
+        """
+        Passes the final results for a call on to the Parquet analytics tables and the sentiment rollups,
+        if they're configured
+        """
+        if cf.isParquetExportSet():
+            pcaexport.exportCall(s3Client, outputS3Bucket, cf.appConfig[cf.CONF_PREFIX_PARSED_EXPORT],
+                                 resultsKey, outputJson)
+
+        rollupStore = createRollupStore()
+        if rollupStore is not None:
+            pcarollup.recordCall(rollupStore, resultsKey, outputJson)
+
+    def fixConversationTime(self, s3Client, outputS3Bucket, resultsKey, isNewCall):
+        """
+        If the filename didn't give us the conversation time then a new call is dated now, and a call that's
+        being processed again keeps the date that it was given the first time.  Otherwise its results would be
+        different every time, so they'd always be re-published and the call would move to a new partition
+        """
+        if self.conversationTime != "":
+            return
+        storedTime = None
+        if not isNewCall:
+            storedTime = pcaoutput.readStoredConversationTime(s3Client, outputS3Bucket, resultsKey)
+        self.conversationTime = storedTime if storedTime is not None else str(datetime.now())
+
+    def restoreFromResults(self, resultsKey, data):
+        """
+        Rebuilds the parser's state from a call's published results, so that stages can be added to them
+        without the original transcript or Transcribe job
+        """
+        header = data["ConversationAnalytics"]
+        jobInfo = header["SourceInformation"][0]["TranscribeJobInfo"]
+        self.jsonOutputFilename = resultsKey.split("/")[-1]
+        self.conversationTime = header["ConversationTime"]
+        self.conversationLocation = header["ConversationLocation"]
+        self.setComprehendLanguageCode(header["LanguageCode"])
+        self.duration = float(header["Duration"])
+        self.processingStatus = header["Status"]
+        self.maxSpeakerIndex = len(header["SpeakerLabels"]) - 1
+        self.headerEntityDict = {entity["Name"]: entity["Values"] for entity in header["CustomEntities"]}
+
+        # Our job information only needs what goes back into the output, and the average accuracy is
+        # kept as the accuracy of one word
+        self.transcribeJobInfo = {"TranscriptionJobName": jobInfo["TranscriptionJobName"],
+                                  "CompletionTime": jobInfo["CompletionTime"],
+                                  "MediaFormat": jobInfo["MediaFormat"],
+                                  "MediaSampleRateHertz": jobInfo["MediaSampleRateHertz"],
+                                  "Media": {"MediaFileUri": jobInfo["MediaOriginalUri"]},
+                                  "Settings": {"ChannelIdentification": bool(jobInfo["ChannelIdentification"])}}
+        if "VocabularyName" in jobInfo:
+            self.transcribeJobInfo["Settings"]["VocabularyName"] = jobInfo["VocabularyName"]
+        self.numWordsParsed = 1
+        self.cummulativeWordAccuracy = jobInfo["AverageAccuracy"]
+        if jobInfo["MediaFileUri"] != jobInfo["MediaOriginalUri"]:
+            self.audioPlaybackUri = jobInfo["MediaFileUri"]
+
+        self.speechSegmentList = []
+        for output in data["SpeechSegments"]:
+            segment = SpeechSegment()
+            segment.segmentStartTime = output["SegmentStartTime"]
+            segment.segmentEndTime = output["SegmentEndTime"]
+            segment.segmentSpeaker = output["SegmentSpeaker"]
+            segment.segmentText = output["OriginalText"]
+            segment.segmentConfidence = output["WordConfidence"]
+            segment.segmentIsPositive = bool(output["SentimentIsPositive"])
+            segment.segmentIsNegative = bool(output["SentimentIsNegative"])
+            segment.segmentSentimentScore = output["SentimentScore"]
+            segment.segmentAllSentiments = output["BaseSentimentScores"]
+            if output["BaseSentimentScores"] != []:
+                segment.segmentPositive = output["BaseSentimentScores"]["Positive"]
+                segment.segmentNegative = output["BaseSentimentScores"]["Negative"]
+            segment.segmentCustomEntities = output["EntitiesDetected"]
+            self.speechSegmentList.append(segment)
+
+    def matchSimpleEntities(self):
+        """
+        Finds the simple entities in the words of our segments, as the diarisation does for a new call
+        """
+        for segment in self.speechSegmentList:
+            for wordEntry in segment.segmentConfidence:
+                checkTerm = wordEntry["Text"].lower().strip(" ,?.")
+                if checkTerm in self.simpleEntityMap:
+                    self.matchedSimpleEntities[checkTerm] = self.simpleEntityMap[checkTerm]
+
+    def publishResults(self, s3Client, outputS3Bucket, resultsKey):
+        """
+        Writes out the JSON data in its current state to our S3 location, plus the header object, segment
+        shards, word index and, for the final results, search items and export partition if configured, unless
+        it's no different to what's already there.  Returns the JSON data
+        """
+        headerKey = None
+        shardFolder = None
+        indexKey = None
+        if cf.isParsedHeaderOutputSet():
+            headerKey = cf.appConfig[cf.CONF_PREFIX_PARSED_HEADERS] + '/' + self.jsonOutputFilename
+        if cf.isSegmentShardOutputSet():
+            shardFolder = cf.appConfig[cf.CONF_PREFIX_PARSED_SHARDS] + '/' + self.jsonOutputFilename
+        if cf.isCallIndexOutputSet():
+            indexKey = cf.appConfig[cf.CONF_PREFIX_PARSED_INDEX] + '/' + self.jsonOutputFilename
+        outputJson = self.outputAsJSON()
+        resultsMetadata = {}
+        if (self.processingStatus == STATUS_COMPLETE) and (cf.isSearchIndexTableSet() or cf.isParquetExportSet()):
+            storedMetadata = pcaoutput.readStoredMetadata(s3Client, outputS3Bucket, resultsKey) or {}
+            resultsMetadata.update(self.writeSearchIndexItems(resultsKey, outputJson, storedMetadata))
+            resultsMetadata.update(self.moveExportPartition(s3Client, outputS3Bucket, resultsKey, outputJson,
+                                                            storedMetadata))
+        pcaoutput.publishParsedResults(s3Client, outputS3Bucket, resultsKey, outputJson, headerKey, shardFolder,
+                                       cf.appConfig[cf.CONF_PARSED_ENCODING], indexKey, resultsMetadata)
+        return outputJson
+
+
+def getClient(service):
+    """
+    Returns the AWS client for the service, creating it the first time that it's needed by this process
+    """
+    with CLIENT_LOCK:
+        if service not in AWS_CLIENTS:
+            AWS_CLIENTS[service] = boto3.client(service)
+        return AWS_CLIENTS[service]
+
+class WarmCache:
+    """
+    Values that are kept for a few seconds at a time rather than loaded every time that they're needed.  The
+    parsers of a batch share one, so only one of them loads a value while the others wait for it
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.values = {}
+        self.lock = threading.RLock()
+
+    def read(self, name, loadFunction):
+        """
+        Returns the cached value if it's young enough, otherwise loads it again with loadFunction
+        """
+        with self.lock:
+            now = time.time()
+            if (name in self.values) and (now - self.values[name][0] < self.seconds):
+                return self.values[name][1]
+            value = loadFunction()
+            if self.seconds > 0:
+                self.values[name] = (now, value)
+            return value
+
+# The cache that parsers use unless they're given one, which caches nothing until a worker process replaces it
+WARM_CACHE = WarmCache(0)
+
+def readSimpleEntityStringMap(bucket, key):
+    """
+    Reads a simple entity CSV file into a map of lower-case term to its type and original text, or returns None
+    if the file doesn't exist
+    """
+    try:
+        response = getClient("s3").get_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        return None
+
+    entityMap = {}
+    reader = csv.DictReader(response["Body"].read().decode("utf-8", errors="ignore").splitlines())
+    try:
+        for row in reader:
+            origTerm = row.pop("Text")
+            checkTerm = origTerm.lower()
+            if not (checkTerm in entityMap):
+                entityMap[checkTerm] = { "Type": row.pop("Type"), "Original": origTerm }
+    except Exception as e:
+        print(e)
+    return entityMap
+
+def initialiseWorkerProcess():
+    """
+    Warms up a worker pool process, which keeps its configuration and lookups for a few minutes at a time
+    """
+    global WARM_CACHE
+    WARM_CACHE = WarmCache(WORKER_CACHE_SECONDS)
+    WARM_CACHE.read("configuration", cf.loadConfiguration)
+
+def processWorkerJob(jobName):
+    """
+    Processes one job for the worker, in the same way as the workflow does but with no time limit
+    """
+    WARM_CACHE.read("configuration", cf.loadConfiguration)
+    parseTranscribeJob({"jobName": jobName})
+
+def runWorker(options, once=False):
+    """
+    Runs the long-running worker, taking job names from "--queue-url <sqs-url>" or "--queue-file <file>", with
+    "--processes <count>" and "--health-file <file>"
+    """
+    if "--queue-url" in options:
+        queue = pcaworker.SQSJobQueue(boto3.client("sqs"), options["--queue-url"])
+    else:
+        queue = pcaworker.LocalFileJobQueue(options["--queue-file"])
+    pcaworker.runWorker(queue, processWorkerJob, initialiseWorkerProcess,
+                        int(options.get("--processes", pcaworker.WORKER_PROCESSES)),
+                        options.get("--health-file"), once)
+
+def createRollupStore():
+    """
+    Returns the store for the sentiment rollups, or None if they aren't being maintained
+    """
+    ddbClient = getClient("dynamodb") if ROLLUP_TABLE != "" else None
+    return pcarollup.createRollupStore(ddbClient, ROLLUP_TABLE, ROLLUP_DATABASE)
+
+def createLoadShedder():
+    """
+    Returns the load shedder for a new call, with its tier taken from the depth of the Transcribe backlog, or
+    None if we're not shedding load
+    """
+    if not cf.isLoadSheddingSet():
+        return None
+    thresholds = cf.appConfig[cf.CONF_SHEDDING_BACKLOG]
+    backlog = pcashedding.readTranscribeBacklog(getClient("transcribe"), max(thresholds), getClient("dynamodb"),
+                                                TRACKING_TABLE)
+    return pcashedding.LoadShedder(pcashedding.createBreakerStore(getClient("dynamodb"), TRACKING_TABLE),
+                                   pcashedding.calculateTier(backlog, thresholds))
+
+def backfillCall(s3Client, bucket, markerKey, shedder):
+    """
+    Adds the stages that were shed to a call's published results, unless the load shedder for this call says
+    that they're being shed again, returning the stages that are still outstanding.  The marker is removed once
+    there are none
+    """
+    marker = pcashedding.readBackfillMarker(s3Client, bucket, markerKey)
+    if marker is None:
+        return []
+    resultsKey = marker["ResultsKey"]
+    try:
+        data = pcaoutput.readParsedResults(s3Client, bucket, resultsKey)[0]
+    except s3Client.exceptions.NoSuchKey:
+        print(f"Dropping the backfill of {resultsKey} as the call has gone")
+        s3Client.delete_object(Bucket=bucket, Key=markerKey)
+        return []
+
+    # Rebuild the call, and only run the stages that were deferred
+    transcribeParser = TranscribeParser(cf.appConfig[cf.CONF_MINPOSITIVE],
+                                        cf.appConfig[cf.CONF_MINNEGATIVE],
+                                        cf.appConfig[cf.CONF_ENTITYENDPOINT])
+    transcribeParser.restoreFromResults(resultsKey, data)
+    otherStages = [stage for stage in pcashedding.STAGES if stage not in marker["Stages"]]
+    transcribeParser.shedder = shedder
+    transcribeParser.shedder.shedStages.update(otherStages)
+    transcribeParser.deferredStages = list(otherStages)
+
+    if not transcribeParser.isStageShed(pcashedding.STAGE_PLAYBACK):
+        transcribeParser.createPlaybackMP3Audio()
+    if transcribeParser.comprehendLanguageCode != "":
+        client = createComprehendClient()
+        for segment in transcribeParser.speechSegmentList:
+            if len(segment.segmentText) >= MIN_SENTIMENT_LENGTH:
+                transcribeParser.detectSegmentEntities(segment, client)
+    if transcribeParser.simpleEntityMatchingUsed and \
+            not transcribeParser.isStageShed(pcashedding.STAGE_SIMPLE_ENTITIES):
+        transcribeParser.loadSimpleEntityStringMap()
+        transcribeParser.matchSimpleEntities()
+        if transcribeParser.matchedSimpleEntities != {}:
+            transcribeParser.createSimpleEntityEntries(transcribeParser.speechSegmentList)
+
+    # Publish the enriched results, and only keep the marker for the stages that are still outstanding
+    outputJson = transcribeParser.publishResults(s3Client, bucket, resultsKey)
+    transcribeParser.recordFinalResults(s3Client, bucket, resultsKey, outputJson)
+    outstanding = [stage for stage in transcribeParser.deferredStages if stage in marker["Stages"]]
+    if outstanding != []:
+        pcashedding.writeBackfillMarker(s3Client, bucket, cf.appConfig[cf.CONF_PREFIX_BACKFILL], resultsKey,
+                                        outstanding)
+    else:
+        s3Client.delete_object(Bucket=bucket, Key=markerKey)
+    return outstanding
+
+def backfillEnrichment(isOutOfTime=None):
+    """
+    Works through the backfill markers, oldest first, for as long as there's capacity - we stop as soon as the
+    backlog or a circuit breaker means that stages are being shed again, or we run out of time.  Returns the
+    number of calls that were fully backfilled
+    """
+    cf.loadConfiguration()
+    if not cf.isLoadSheddingSet():
+        print("Load shedding isn't configured, so there's nothing to backfill")
+        return 0
+    s3Client = boto3.client("s3")
+    bucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+    markerKeys = pcashedding.listBackfillMarkers(s3Client, bucket, cf.appConfig[cf.CONF_PREFIX_BACKFILL])
+    print(f"Found {len(markerKeys)} calls waiting for backfill")
+
+    completed = 0
+    for markerKey in markerKeys:
+        shedder = createLoadShedder()
+        if ((isOutOfTime is not None) and isOutOfTime()) or not shedder.hasCapacity():
+            print("Stopping the backfill until there's more capacity or time")
+            break
+        if backfillCall(s3Client, bucket, markerKey, shedder) == []:
+            completed += 1
+
+    print(f"Backfilled {completed} calls")
+    return completed
+
+def backfill_handler(event, context):
+    """
+    Lambda entrypoint for the scheduled backfill of shed enrichment stages
+    """
+    isOutOfTime = lambda: context.get_remaining_time_in_millis() < NLP_DEADLINE_MARGIN_MS
+    return {"backfilled": backfillEnrichment(isOutOfTime)}
+
+def createComprehendClient():
+    """
+    Returns a Comprehend client, which takes its calls out of the shared rate limits if they're configured
+    """
+    global RATE_LIMITER
+    client = getClient("comprehend")
+    if not cf.isComprehendRateLimitSet():
+        return client
+    rates = {name: rate for name, rate in zip(pcaratelimit.LIMITS, cf.appConfig[cf.CONF_NLP_RATE_LIMITS])
+             if rate > 0}
+    with CLIENT_LOCK:
+        if (RATE_LIMITER is None) or (RATE_LIMITER.rates != rates):
+            RATE_LIMITER = pcaratelimit.RateLimiter(pcaratelimit.createTokenBucketStore(getClient("dynamodb"),
+                                                                                        TRACKING_TABLE), rates)
+        return pcaratelimit.RateLimitedComprehend(client, RATE_LIMITER)
+
+def createCheckpointStore(s3Client):
+    """
+    Returns the store for the processing checkpoints, or None if nothing is being checkpointed
+    """
+    return pcacheckpoint.createCheckpointStore(s3Client, cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                               cf.appConfig[cf.CONF_PREFIX_CHECKPOINTS], CHECKPOINT_FOLDER)
+
+def backfillRollups(workers=pcabatch.BATCH_WORKERS):
+    """
+    Adds every existing parsed-results file to the sentiment rollups without re-processing it.  Calls that are
+    already in the rollups with the same content are left alone, so this can safely be run more than once
+    """
+    cf.loadConfiguration()
+    rollupStore = createRollupStore()
+    if rollupStore is None:
+        raise Exception("No rollup store - set RollupTableName or RollupDatabase in the environment.")
+    s3Client = boto3.client("s3")
+    resultsBucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+    keys = pcabatch.listKeysParallel(s3Client, resultsBucket, cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS] + "/",
+                                     lambda key: not key.endswith("/"))
+    pcabatch.mapInPool(lambda key: pcarollup.recordCall(rollupStore, key,
+                                                        pcaoutput.readParsedResults(s3Client, resultsBucket, key)[0]),
+                       keys, workers, "Rollup: ")
 
 def lambda_handler(event, context):
     # Load our configuration data
     sfData = copy.deepcopy(event)
     cf.loadConfiguration()
 
-    # Instantiate our parser and write out our processed file
+    # Instantiate our parser and write out our processed file, keeping an eye on the time
+    isOutOfTime = None
+    if hasattr(context, "get_remaining_time_in_millis"):
+        isOutOfTime = lambda: context.get_remaining_time_in_millis() < NLP_DEADLINE_MARGIN_MS
+
+    # A batch of jobs is either our own "jobs" list or the "Items" of a Step Functions Map state's item batcher
+    if ("jobs" in sfData) or ("Items" in sfData):
+        return parseTranscribeJobs(sfData.get("jobs", sfData.get("Items")), isOutOfTime,
+                                   int(sfData.get("concurrency", BATCH_JOB_CONCURRENCY)))
+    return parseTranscribeJob(sfData, isOutOfTime)
+
+def parseTranscribeJobs(jobs, isOutOfTime=None, concurrency=BATCH_JOB_CONCURRENCY):
+    """
+    Parses a batch of Transcribe jobs, each either a job name or its workflow state, assuming that the
+    configuration is already loaded - it's loaded once for the whole batch, and none of the parsers reload it.
+    The parsers share their clients and a cache of endpoint lookups that lasts for just this batch, and up to
+    concurrency of them run at once.  Returns the workflow state of every job that was parsed, the jobs that
+    failed along with why, and the jobs that still have work to do - ones that weren't started before we ran out
+    of time, and ones whose NLP is only partly done, which carry their nlpContinuation - to be sent again
+    """
+    jobs = [{"jobName": job} if isinstance(job, str) else job for job in jobs]
+    batchCache = WarmCache(BATCH_CACHE_SECONDS)
+
+    def parseJob(sfData):
+        if (isOutOfTime is not None) and isOutOfTime():
+            return "unprocessed", sfData
+        try:
+            result = parseTranscribeJob(copy.deepcopy(sfData), isOutOfTime, batchCache)
+        except Exception as e:
+            print("Job {} failed ({})".format(sfData.get("jobName"), str(e)))
+            return "failures", {"jobName": sfData.get("jobName"), "error": str(e)}
+        return ("unprocessed" if "nlpContinuation" in result else "results"), result
+
+    batchResults = {"results": [], "failures": [], "unprocessed": []}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for outcome, value in pool.map(parseJob, jobs):
+            batchResults[outcome].append(value)
+
+    print("Batch of {} jobs: {} parsed, {} failed, {} unfinished".format(
+        len(jobs), len(batchResults["results"]), len(batchResults["failures"]), len(batchResults["unprocessed"])))
+    return batchResults
+
+def parseTranscribeJob(sfData, isOutOfTime=None, warmCache=None):
+    """
+    Parses the Transcribe job named in the workflow state, assuming that the configuration is already loaded.
+    If the NLP couldn't be finished in time then the state gets an nlpContinuation, which sends the workflow
+    back here to finish it
+    """
     jobName = sfData["jobName"]
     transcribeParser = TranscribeParser(cf.appConfig[cf.CONF_MINPOSITIVE],
                                         cf.appConfig[cf.CONF_MINNEGATIVE],
-                                        cf.appConfig[cf.CONF_ENTITYENDPOINT])
-    outputFilename = transcribeParser.parseTranscribeFile(jobName)
+                                        cf.appConfig[cf.CONF_ENTITYENDPOINT], warmCache)
+    outputFilename = transcribeParser.parseTranscribeFile(jobName, pcatranscribe.getJobDescriptor(sfData, jobName),
+                                                          isOutOfTime, sfData.pop("nlpContinuation", None))
+    if transcribeParser.nextContinuation is not None:
+        sfData["nlpContinuation"] = transcribeParser.nextContinuation
 
 
     # Get the object from the event and show its content type
     sfData["parsedJsonFile"] = outputFilename
     return sfData
 
-def fullRefresh(processNotPatch):
+def refreshParsedResult(s3Client, resultsBucket, key):
     """
-    Takes every file in the output results bucket and either re-processes it or just patches the JSON file.
-    Note, if the Transcribe job has expired (90 days) and we're doing full re-processing then the original
-    job may no longer exist and that file cannot be updated
+    Fully re-processes one parsed-results file from its original Transcribe job.  Note, if the Transcribe job
+    has expired (90 days) then the original job may no longer exist and that file cannot be updated
+    """
+    data, response = pcaoutput.readParsedResults(s3Client, resultsBucket, key)
+
+    # Build up the event structure for the standard file processor
+    nextRefreshEvent = {}
+    headerData = data["ConversationAnalytics"]
+    transcribeJobData = headerData["SourceInformation"][0]["TranscribeJobInfo"]
+    media = urlparse(transcribeJobData["MediaOriginalUri"])
+    nextRefreshEvent["bucket"] = media.netloc
+    nextRefreshEvent["key"] = media.path.lstrip("/")
+    nextRefreshEvent["contentType"] = transcribeJobData["MediaFormat"]
+    nextRefreshEvent["jobName"] = transcribeJobData["TranscriptionJobName"]
+    nextRefreshEvent["langCode"] = headerData["LanguageCode"]
+    nextRefreshEvent["transcribeStatus"] = "COMPLETED"
+
+    # Check original audio still exists
+    try:
+        s3Client.head_object(Bucket=nextRefreshEvent["bucket"], Key=nextRefreshEvent["key"])
+    except Exception as e:
+        raise Exception(f"no source audio file {nextRefreshEvent['key']}")
+
+    # Now process this "new" event
+    try:
+        parseTranscribeJob(nextRefreshEvent)
+    except Exception as e:
+        raise Exception(f"Transcribe job {nextRefreshEvent['jobName']} likely to be missing ({str(e)})")
+
+# Per-key processors for each kind of refresh run
+REFRESH_MODE_PROCESS = "process"
+REFRESH_MODE_PATCH = "patch"
+REFRESH_PROCESSORS = {REFRESH_MODE_PROCESS: refreshParsedResult, REFRESH_MODE_PATCH: pcapatch.patchObject}
+
+# Time left in a Lambda invocation at which a refresh shard stops and hands over to a new invocation
+REFRESH_LAMBDA_MARGIN_MS = 120000
+
+def createRefreshProcessor(s3Client, mode):
+    """
+    Returns the per-key function for the given kind of refresh
     """
-    # Build up our list of output files in S3
-    cf.loadConfiguration()
     resultsBucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
-    resultsPrefix = cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS]
+    return lambda key: REFRESH_PROCESSORS[mode](s3Client, resultsBucket, key)
+
+def fullRefresh(processNotPatch, runId=None, fanOutFunction=None, workers=pcarefresh.REFRESH_WORKERS):
+    """
+    Takes every file in the output results bucket and either re-processes it or just brings its JSON up to the
+    current schema version with the registered patches.  The files are split into shards and worked through
+    locally, or by fanning out the shards to the refresh Lambda, and completed files are checkpointed so that
+    passing the run ID of an earlier run resumes it
+    """
+    cf.loadConfiguration()
     s3Client = boto3.client("s3")
-    response = s3Client.list_objects_v2(Bucket=resultsBucket, Prefix=resultsPrefix)
-    s3Entries = response["Contents"]
-    while ("NextContinuationToken" in response):
-        response = s3Client.list_objects_v2(Bucket=resultsBucket, Prefix=resultsPrefix,
-                                            ContinuationToken=response["NextContinuationToken"])
-        s3Entries += response["Contents"]
-
-    # Now step through and re-process each one
-    jobNo = 1
-    for nextEvent in s3Entries:
-        # Download the results file and get it into a JSON structure
-        filename = TMP_DIR + "/" + nextEvent["Key"].split("/")[-1]
-        s3Client.download_file(resultsBucket, nextEvent["Key"], filename)
-        json_filepath = Path(filename)
-        data = json.load(open(json_filepath.absolute(), "r", encoding="utf-8"))
+    store = pcarefresh.S3CheckpointStore(s3Client, cf.appConfig[cf.CONF_SUPPORT_BUCKET],
+                                         pcarefresh.generateRunId() if runId is None else runId)
+
+    # Either pick up the existing run or partition the results into a new one
+    runInfo = store.loadRun()
+    if runInfo is None:
+        mode = REFRESH_MODE_PROCESS if processNotPatch else REFRESH_MODE_PATCH
+        keys = pcarefresh.listAllKeys(s3Client, cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                      cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS])
+        runInfo = pcarefresh.createRun(s3Client, store, keys, pcarefresh.REFRESH_SHARD_COUNT, mode)
+        print(f"Starting refresh run {store.runId} over {len(keys)} files")
+    else:
+        print(f"Resuming refresh run {store.runId}")
 
-        # Option 1 - try and fully reprocess the original file
-        if processNotPatch:
-            # Build up the event structure for the standard file processor
-            nextRefreshEvent = {}
-            headerData = data["ConversationAnalytics"]
-            transcribeJobData = headerData["SourceInformation"][0]["TranscribeJobInfo"]
-            media = urlparse(transcribeJobData["MediaOriginalUri"])
-            nextRefreshEvent["bucket"] = media.netloc
-            nextRefreshEvent["key"] = media.path.lstrip("/")
-            nextRefreshEvent["contentType"] = transcribeJobData["MediaFormat"]
-            nextRefreshEvent["jobName"] = transcribeJobData["TranscriptionJobName"]
-            nextRefreshEvent["langCode"] = headerData["LanguageCode"]
-            nextRefreshEvent["transcribeStatus"] = "COMPLETED"
-
-            # Check original audio still exists
-            try:
-                response = s3Client.head_object(Bucket=nextRefreshEvent["bucket"], Key=nextRefreshEvent["key"])
-
-                # Now call the lambda handler to process this "new" event
-                print(f"Re-processing job {jobNo} of {len(s3Entries)} - {nextRefreshEvent['key']}")
-                try:
-                    lambda_handler(nextRefreshEvent, "")
-                except Exception as e:
-                    print(f"Error re-processing job {jobNo} of {len(jobList)} - Transcribe job {nextEvent['jobName']} likely to be missing")
-            except Exception as e:
-                print(f"Cannot re-process job {jobNo} of {len(jobList)} - no source audio file {nextEvent['key']}")
-        # Option 2 - patch the JSON files with something quite specific
-        else:
-            # PATCH - this adds a call duration to the header level of the JSON structure
-            print(f"Re-processing job {jobNo} of {len(s3Entries)} - {nextEvent['Key'].split('/')[-1]}")
-            lastWordEnd = data["SpeechSegments"][-1]["WordConfidence"][-1]["EndTime"]
-            data["ConversationAnalytics"]["Duration"] = str(lastWordEnd)
-
-            # Write out the JSON data to our S3 location
-            s3Resource = boto3.resource('s3')
-            s3Object = s3Resource.Object(resultsBucket, nextEvent["Key"])
-            s3Object.put(
-                Body=(bytes(json.dumps(data).encode('UTF-8')))
-            )
-
-        # Ready for next file
-        jobNo += 1
-
-# Helper to pull out clip files from our list
-def extractClipEntries(s3List, searchTerm):
-    results = []
-    for eachEntry in s3List:
-        if searchTerm in eachEntry["Key"]:
-            results.append(eachEntry)
-    return results
+    if fanOutFunction is not None:
+        pcarefresh.fanOutShards(boto3.client("lambda"), fanOutFunction, runInfo)
+    else:
+        pcarefresh.runLocally(store, runInfo, createRefreshProcessor(s3Client, runInfo["mode"]), workers)
+
+def refresh_handler(event, context):
+    """
+    Lambda entrypoint for one shard of a fanned-out refresh run.  If the shard can't be finished in this
+    invocation then it stops taking new files and re-invokes itself, which resumes from the checkpoint
+    """
+    cf.loadConfiguration()
+    s3Client = boto3.client("s3")
+    store = pcarefresh.S3CheckpointStore(s3Client, cf.appConfig[cf.CONF_SUPPORT_BUCKET], event["refreshRunId"])
+    isOutOfTime = lambda: context.get_remaining_time_in_millis() < REFRESH_LAMBDA_MARGIN_MS
+    remaining = pcarefresh.runShard(store, event["refreshShard"],
+                                    createRefreshProcessor(s3Client, event["refreshMode"]),
+                                    isOutOfTime=isOutOfTime)
+
+    # Only carry on if we stopped because of the time limit - failures are left for a resume of the run
+    if (remaining > 0) and isOutOfTime():
+        pcarefresh.generateShardInvocation(boto3.client("lambda"), context.function_name,
+                                           store.loadRun(), event["refreshShard"])
+
+    return {"refreshRunId": event["refreshRunId"], "refreshShard": event["refreshShard"], "remaining": remaining}
 
 # Delete all _clip files in the S3 output bucket
-def removeClipOutputFiles():
+def removeClipOutputFiles(dryRun=False):
     cf.loadConfiguration()
 
-    # Get the list of S3 files in the output bucket containing "_clip,"
+    # Get the list of S3 files in the output bucket containing "_clip."
     resultsBucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
     s3Client = boto3.client("s3")
-    response = s3Client.list_objects_v2(Bucket=resultsBucket)
-    s3Entries = extractClipEntries(response["Contents"], "_clip.")
-    while ("NextContinuationToken" in response):
-        response = s3Client.list_objects_v2(Bucket=resultsBucket, ContinuationToken=response["NextContinuationToken"])
-        s3Entries += extractClipEntries(response["Contents"], "_clip.")
-
-    # Process each one
-    for eachEntry in s3Entries:
-        print(eachEntry["Key"])
-        s3Client.delete_object(Bucket=resultsBucket, Key=eachEntry["Key"])
-
-def moveFailedAudioFiles():
+    s3Entries = pcabatch.listKeysParallel(s3Client, resultsBucket, keyFilter=lambda key: "_clip." in key)
+
+    # Delete them in batches
+    print(f"Found {len(s3Entries)} clip files in {resultsBucket}")
+    pcabatch.deleteKeys(s3Client, resultsBucket, s3Entries, dryRun)
+
+def moveFailedAudioFiles(dryRun=False):
     cf.loadConfiguration()
     audioBucket = cf.appConfig[cf.CONF_S3BUCKET_INPUT]
-    audioPrefix = cf.appConfig[cf.CONF_PREFIX_RAW_AUDIO]
     failedPrefix = cf.appConfig[cf.CONF_PREFIX_FAILED_AUDIO]
     sfnClient = boto3.client('stepfunctions')
     s3Client = boto3.client("s3")
 
     # First, get our step function
     ourStepFunction = cf.appConfig[cf.COMP_SFN_NAME]
-    response = sfnMachinesResult = sfnClient.list_state_machines(maxResults = 1000)
+    sfnMachinesResult = sfnClient.list_state_machines(maxResults = 1000)
     sfnArnList = list(filter(lambda x: x["stateMachineArn"].endswith(ourStepFunction), sfnMachinesResult["stateMachines"]))
     if sfnArnList == []:
         # Doesn't exist
@@ -1020,51 +1718,99 @@ def moveFailedAudioFiles():
             'Cannot find configured Step Function \'{}\' in the AWS account in this region - cannot begin workflow.'.format(ourStepFunction))
     sfnArn = sfnArnList[0]['stateMachineArn']
 
-    # Now get a list of all failed Step Functions and their audio inputs
-    response = sfnClient.list_executions(stateMachineArn=sfnArn, statusFilter="FAILED")
-    failedExecutions = response["executions"]
-    while ("nextToken" in response):
-        response = sfnClient.list_executions(stateMachineArn=sfnArn, statusFilter="FAILED", nextToken=response["nextToken"])
-        failedExecutions += response["executions"]
-    print(len(failedExecutions))
-
-    # Now go through each one, and if the source audio is still there then move it
-    for failedExe in failedExecutions:
-        # Get file details
-        runDetails = sfnClient.describe_execution(executionArn=failedExe["executionArn"])
-        inputData = json.loads(runDetails["input"])
-        if "key" in inputData:
-            originalAudioKey = inputData["key"]
-
-            # Now try and move the original source audio file to the "failed" folder
-            try:
-                # Copy and delete file
-                copySourcePath = audioBucket + "/" + originalAudioKey
-                copyDestnKey = failedPrefix + "/" + originalAudioKey.split('/')[-1]
-                s3Client.copy_object(Bucket=audioBucket, CopySource=copySourcePath, Key=copyDestnKey)
-                s3Client.delete_object(Bucket=audioBucket, Key=originalAudioKey)
-                print("Moved failed audio file " + originalAudioKey)
-            except Exception as e:
-                # If it failed to copy then don't worry, it probably just didn't exist
-                print(str(e) + " : " + originalAudioKey)
-                pass
+    # Now get the audio inputs of all failed Step Functions - the same file may have failed more than once
+    failedInputs = [json.loads(inputData) for inputData in pcabatch.listExecutionInputs(sfnClient, sfnArn, "FAILED")]
+    originalAudioKeys = set([inputData["key"] for inputData in failedInputs if "key" in inputData])
+    print(f"Found {len(failedInputs)} failed executions covering {len(originalAudioKeys)} audio files")
+
+    # Now try and move each original source audio file to the "failed" folder.  If one
+    # fails to copy then don't worry, it probably just didn't exist any more
+    copies = [(key, failedPrefix + "/" + key.split('/')[-1]) for key in originalAudioKeys]
+    movedKeys = pcabatch.copyKeys(s3Client, audioBucket, copies, dryRun)
+    pcabatch.deleteKeys(s3Client, audioBucket, movedKeys, dryRun)
 
 # Main entrypoint for testing
 if __name__ == "__main__":
     # Check if we're doing a full refresh or similar
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2:
+        # Refresh runs can take "--resume <run-id>", "--fan-out <lambda-name>" and "--workers <count>"
+        options = dict(zip(sys.argv[2::2], sys.argv[3::2]))
         if sys.argv[1] == "--full-refresh":
             # Full refresh - do that then exit
-            fullRefresh(True)
+            fullRefresh(True, options.get("--resume"), options.get("--fan-out"),
+                        int(options.get("--workers", pcarefresh.REFRESH_WORKERS)))
         elif sys.argv[1] == "--patch-json":
             # Patching the output files
-            fullRefresh(False)
+            fullRefresh(False, options.get("--resume"), options.get("--fan-out"),
+                        int(options.get("--workers", pcarefresh.REFRESH_WORKERS)))
+        elif sys.argv[1] == "--refresh-status":
+            # Progress of a refresh run, which may be running locally or fanned out
+            cf.loadConfiguration()
+            pcarefresh.reportRunStatus(pcarefresh.S3CheckpointStore(boto3.client("s3"),
+                                                                    cf.appConfig[cf.CONF_SUPPORT_BUCKET],
+                                                                    sys.argv[2]))
+        elif sys.argv[1] == "--export-parquet":
+            # Bulk export of every call to the Parquet analytics tables, with "--workers <count>"
+            cf.loadConfiguration()
+            pcaexport.exportAll(boto3.client("s3"), cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                cf.appConfig[cf.CONF_PREFIX_PARSED_RESULTS], cf.appConfig[cf.CONF_PREFIX_PARSED_EXPORT],
+                                int(options.get("--workers", pcabatch.BATCH_WORKERS)))
+        elif sys.argv[1] == "--compact-export":
+            # Merge the small Parquet files left by per-call exports, optionally with "--dry-run"
+            cf.loadConfiguration()
+            pcaexport.compactExport(boto3.client("s3"), cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                    cf.appConfig[cf.CONF_PREFIX_PARSED_EXPORT], "--dry-run" in sys.argv)
+        elif sys.argv[1] == "--rollup-backfill":
+            # Add existing results to the sentiment rollups, with "--workers <count>"
+            backfillRollups(int(options.get("--workers", pcabatch.BATCH_WORKERS)))
+        elif sys.argv[1] == "--rollups":
+            # Query the sentiment rollups with "--granularity day|hour", "--from <date>", "--to <date>" and
+            # optionally "--language <code>"
+            rollupStore = createRollupStore()
+            if rollupStore is None:
+                raise Exception("No rollup store - set RollupTableName or RollupDatabase in the environment.")
+            pcarollup.reportRollups(pcarollup.queryRollups(rollupStore,
+                                                           options.get("--granularity", "day").upper(),
+                                                           datetime.fromisoformat(options["--from"]),
+                                                           datetime.fromisoformat(options["--to"]),
+                                                           options.get("--language", pcarollup.ALL_LANGUAGES)))
+        elif sys.argv[1] == "--build-search-index":
+            # Bring a local corpus index file up to date with the per-call word indexes, with
+            # "--index <file>" and "--workers <count>"
+            cf.loadConfiguration()
+            corpus = pcasearch.CorpusIndex(options["--index"])
+            workers = int(options.get("--workers", pcabatch.BATCH_WORKERS))
+            pcasearch.updateCorpusIndex(boto3.client("s3"), cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
+                                        cf.appConfig[cf.CONF_PREFIX_PARSED_INDEX], corpus,
+                                        lambda function, items: pcabatch.mapInPool(function, items, workers, "Index: "))
+            corpus.close()
+        elif sys.argv[1] == "--merge-search-index":
+            # Merge another corpus index file into this one, with "--index <file>" and "--merge <file>"
+            corpus = pcasearch.CorpusIndex(options["--index"])
+            corpus.merge(options["--merge"])
+            corpus.close()
+        elif sys.argv[1] == "--search":
+            # Phrase search of a local corpus index file, with "--phrase <text>" and "--index <file>"
+            corpus = pcasearch.CorpusIndex(options["--index"])
+            searchStart = time.time()
+            matches = corpus.search(options["--phrase"])
+            print(f"Found {len(matches)} calls in {(time.time() - searchStart) * 1000:.1f}ms")
+            for callKey, positions in matches:
+                print(f"{callKey}: {len(positions)} at {positions[:5]}")
+            corpus.close()
+        elif sys.argv[1] == "--backfill-enrichment":
+            # Add any shed enrichment stages to the stored results, while there's capacity
+            backfillEnrichment()
+        elif sys.argv[1] == "--worker":
+            # Long-running worker for bulk processing of the jobs on a queue - see runWorker() for the
+            # options, plus a final "--once" to stop when the queue is empty
+            runWorker(options, "--once" in sys.argv)
         elif sys.argv[1] == "--remove-clips":
-            # Remove redundant clip output files
-            removeClipOutputFiles()
+            # Remove redundant clip output files, optionally with "--dry-run"
+            removeClipOutputFiles("--dry-run" in sys.argv)
         elif sys.argv[1] == "--move-failures":
             # Temporary update - delete me when done
-            moveFailedAudioFiles()
+            moveFailedAudioFiles("--dry-run" in sys.argv)
     else:
         # Standard test event
         event = {
@@ -2,22 +2,17 @@ import copy
 import boto3
 import subprocess
 import pcaconfiguration as cf
+import pcachunking
+import pcalanes
+import pcatranscribe
+import time
 import os
 
 # Local temporary folder for file-based operations
 TMP_DIR = "/tmp/"
 
 ROLE_ARN = os.environ["RoleArn"]
-
-def checkExistingJobStatus(jobName, transcribe):
-    try:
-        # If it exists (e.g. doesn't exception) then we may want to delete iz
-        currentJobStatus = transcribe.get_transcription_job(TranscriptionJobName=jobName)["TranscriptionJob"]["TranscriptionJobStatus"]
-    except Exception as e:
-        # Job didn't already exist - carry on
-        currentJobStatus = ""
-
-    return currentJobStatus
+TABLE = os.environ["TableName"]
 
 def calculateAutoSpeakerSeparation(bucket, key):
     """
@@ -54,7 +49,68 @@ def calculateAutoSpeakerSeparation(bucket, key):
 
     return speakerMode
 
+def startChunkedTranscribeJobs(transcribe, bucket, key, jobSettings):
+    """
+    Splits a long recording into chunks that end at silences, uploads each one to the chunk folder and starts
+    its own Transcribe job, with the same settings as the job for the whole recording would have had.  Returns
+    the chunks with their job names, or None if the recording is too short to be worth splitting.  Transcribe
+    jobs can't be stopped, so if we fail part way through after starting some of them then the chunks are still
+    returned, and those that weren't started carry a StartError instead of a job name - the workflow then waits
+    for the others to finish before tidying up and failing the job
+    """
+    ffmpegInputFilename = TMP_DIR + key.split('/')[-1]
+    s3Client = boto3.client('s3')
+    s3Client.download_file(bucket, key, ffmpegInputFilename)
+    chunkFolder = cf.appConfig[cf.CONF_PREFIX_AUDIO_CHUNKS] + '/' + jobSettings["TranscriptionJobName"]
+    chunks = []
+    try:
+        duration = pcachunking.probeDuration(ffmpegInputFilename)
+        chunks = pcachunking.planChunks(duration, pcachunking.detectSilences(ffmpegInputFilename),
+                                        cf.appConfig[cf.CONF_CHUNK_MINUTES] * 60)
+        if chunks == []:
+            return None
+
+        # Only one chunk is ever in /tmp, as a multi-hour recording is already taking up much of it
+        print("Splitting {} seconds of audio into {} chunks".format(round(duration), len(chunks)))
+        for chunk in chunks:
+            chunkFilename = TMP_DIR + "chunk{:03d}.{}".format(chunk["Index"], pcachunking.CHUNK_MEDIA_FORMAT)
+            pcachunking.splitAudioChunk(ffmpegInputFilename, chunk, chunkFilename)
+            chunk["MediaKey"] = chunkFolder + '/' + chunkFilename.split('/')[-1]
+            s3Client.upload_file(chunkFilename, bucket, chunk["MediaKey"])
+            os.remove(chunkFilename)
+
+            chunkBaseName = cf.generateJobName(key)[:pcatranscribe.JOB_NAME_MAX_LENGTH // 2]
+            chunkJobName = pcatranscribe.generateVersionedJobName(
+                chunkBaseName + "-chunk{:03d}".format(chunk["Index"]))
+            chunkSettings = dict(jobSettings, TranscriptionJobName=chunkJobName,
+                                 Media={'MediaFileUri': 's3://' + bucket + '/' + chunk["MediaKey"]},
+                                 MediaFormat=pcachunking.CHUNK_MEDIA_FORMAT)
+            pcatranscribe.startTranscriptionJob(transcribe, **chunkSettings)
+            chunk["JobName"] = chunkJobName
+    except Exception as e:
+        if any(["JobName" in chunk for chunk in chunks]):
+            # Some jobs are already running, so they have to finish before we can tidy up after them
+            print("Unable to start every chunk of {} ({})".format(key, str(e)))
+            for chunk in chunks:
+                if "JobName" not in chunk:
+                    chunk["StartError"] = str(e)
+            return chunks
+
+        # Nothing was started, so just don't leave any chunks behind
+        uploaded = [{"Key": chunk["MediaKey"]} for chunk in chunks if "MediaKey" in chunk]
+        if uploaded != []:
+            s3Client.delete_objects(Bucket=bucket, Delete={"Objects": uploaded, "Quiet": True})
+        raise e
+    finally:
+        os.remove(ffmpegInputFilename)
+
+    return chunks
+
 def submitTranscribeJob(bucket, key, langCode, mediaFormat):
+    """
+    Starts the Transcribe job for the file, returning its name along with its chunks if it was long enough to
+    be split up, otherwise None
+    """
 
     # Get our clients first
     transcribe = boto3.client('transcribe')
@@ -69,20 +125,10 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
     elif channelMode == cf.SPEAKER_MODE_AUTO:
         channelIdent = (calculateAutoSpeakerSeparation(bucket, key) == cf.SPEAKER_MODE_CHANNEL)
 
-    # Generate job-name - delete if it already exists
-    jobName = cf.generateJobName(key)
-    currentJobStatus = checkExistingJobStatus(jobName, transcribe)
+    # Generate a unique job-name, so there's never an old job in the way
+    jobName = pcatranscribe.generateVersionedJobName(cf.generateJobName(key))
     uri = 's3://' + bucket + '/' + key
 
-    # If there's a job already running then the input file may have been copied - quit
-    if (currentJobStatus == "IN_PROGRESS") or (currentJobStatus == "QUEUED"):
-        # Return empty job name
-        print("A Transcription job named \'{}\' is already in progress - cannot continue.".format(jobName))
-        return ""
-    elif currentJobStatus != "":
-        # But if an old one exists we can delete it
-        transcribe.delete_transcription_job(TranscriptionJobName=jobName)
-
     # Sort out our settings blocks, but we need to verify custom vocab first
     mediaSettings = {
         'MediaFileUri': uri
@@ -98,17 +144,22 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
     if not channelIdent:
         jobSettings["MaxSpeakerLabels"] = int(cf.appConfig[cf.CONF_MAX_SPEAKERS])
 
-    # Double check that if we have a custom vocab that it actually exists
-    if cf.appConfig[cf.CONF_VOCABNAME] != "":
-        try:
-            vocabName = cf.appConfig[cf.CONF_VOCABNAME] + '-' + langCode.lower()
-            ourVocab = transcribe.get_vocabulary(VocabularyName = vocabName)
-            if ourVocab["VocabularyState"] == "READY":
-                # Only use it if it is ready for use
-                jobSettings["VocabularyName"] = vocabName
-        except:
-            # Doesn't exist - don't use it
-            pass
+    # If we're identifying the language on this job then Transcribe chooses from our language list,
+    # but custom vocabularies and content redaction both need a language up front, so neither is used
+    if langCode == cf.LANGCODE_IDENTIFY:
+        selectedLanguage = None
+        identifyLanguage = True
+        languageOptions = cf.appConfig[cf.CONF_TRANSCRIBE_LANG]
+    else:
+        selectedLanguage = langCode
+        identifyLanguage = None
+        languageOptions = None
+
+    # Double check that if we have a custom vocab that it actually exists and is ready for use
+    if (cf.appConfig[cf.CONF_VOCABNAME] != "") and not identifyLanguage:
+        vocabName = cf.appConfig[cf.CONF_VOCABNAME] + '-' + langCode.lower()
+        if pcatranscribe.isVocabularyReady(transcribe, vocabName):
+            jobSettings["VocabularyName"] = vocabName
 
     # Job execution settings - note, Role is the same as for this Lambda, which is Full S3 access
     executionSettings = {
@@ -117,29 +168,37 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
     }
 
     # Only enable content redaction if it's supported
-    if langCode in cf.appConfig[cf.CONF_REDACTION_LANGS]:
+    if (langCode in cf.appConfig[cf.CONF_REDACTION_LANGS]) and not identifyLanguage:
         contentRedaction = {'RedactionType': 'PII', 'RedactionOutput': 'redacted_and_unredacted'}
     else:
         contentRedaction = None
 
     # Should have a clear run at doing the job now
     kwargs = {'TranscriptionJobName': jobName,
-              'LanguageCode': langCode,
+              'LanguageCode': selectedLanguage,
               'Media': mediaSettings,
               'MediaFormat': mediaFormat,
               'OutputBucketName': cf.appConfig[cf.CONF_S3BUCKET_OUTPUT],
               'Settings': jobSettings,
               'JobExecutionSettings': executionSettings,
-              'ContentRedaction': contentRedaction
+              'ContentRedaction': contentRedaction,
+              'IdentifyLanguage': identifyLanguage,
+              'LanguageOptions': languageOptions
     }
 
-    # Start the Transcribe job, removing any 'None' values on the way
-    response = transcribe.start_transcription_job(
-        **{k: v for k, v in kwargs.items() if v is not None}
-    )
+    # A long recording can be transcribed as chunks side by side, but they all need to be in the same language,
+    # and the stitched transcript is written under the job name as if it had been one job.  The chunks would each
+    # need a Transcribe slot of their own, so there's no chunking if the slots are being shared out between lanes
+    if cf.isTranscribeChunkingSet() and not identifyLanguage and not cf.isTranscribeLaneSchedulingSet():
+        chunks = startChunkedTranscribeJobs(transcribe, bucket, key, kwargs)
+        if chunks is not None:
+            return jobName, chunks
+
+    # Start the Transcribe job, backing off if we're being throttled
+    response = pcatranscribe.startTranscriptionJob(transcribe, **kwargs)
 
     # Return our job name, as we need to track it
-    return jobName
+    return jobName, None
 
 def lambda_handler(event, context):
     # Load our configuration data
@@ -152,16 +211,45 @@ def lambda_handler(event, context):
     contentType = sfData["contentType"]
     langCode = sfData["langCode"]
 
+    # If Transcribe capacity is shared out between lanes then we need a slot before we can start
+    sfData["laneDeferred"] = False
+    if cf.isTranscribeLaneSchedulingSet():
+        ddbClient = boto3.client("dynamodb")
+        lane = sfData.setdefault("lane", pcalanes.LANE_REALTIME)
+        queuedAt = sfData.setdefault("laneQueuedAt", time.time())
+        capacity = cf.appConfig[cf.CONF_LANE_CAPACITY]
+        reserve = pcalanes.calculateLaneReserve(capacity, cf.appConfig[cf.CONF_LANE_RESERVE])
+        leaseId = pcalanes.requestTranscribeSlot(ddbClient, TABLE, lane, capacity, reserve)
+        if leaseId is None:
+            # No room at the moment - the Step Function will wait and then try again
+            pcalanes.reportLaneWait(lane, queuedAt, False)
+            sfData["laneDeferred"] = True
+            return sfData
+        sfData["laneWaitSeconds"] = pcalanes.reportLaneWait(lane, queuedAt, True)
+        sfData["laneAdmitted"] = lane
+        sfData["laneLease"] = leaseId
+        sfData.pop("laneQueuedAt", None)
+
+    # Any chunks that we're carrying belong to an earlier attempt
+    sfData.pop("chunkJobs", None)
     try:
-        jobName = submitTranscribeJob(event["bucket"], key, langCode, contentType)
+        jobName, chunks = submitTranscribeJob(event["bucket"], key, langCode, contentType)
         sfData["jobName"] = jobName
-        return sfData
+        if chunks is not None:
+            sfData["chunkJobs"] = chunks
     except Exception as e:
         print(e)
+        pcalanes.releaseAdmittedSlot(boto3.client("dynamodb"), TABLE, sfData)
         raise Exception(
             'Error submitting Transcribe job for file \'{}\' from bucket \'{}\'.'.format(
                 key, bucket))
 
+    # If no job was started then we must give back any slot that we took
+    if jobName == "":
+        pcalanes.releaseAdmittedSlot(boto3.client("dynamodb"), TABLE, sfData)
+
+    return sfData
+
 # Main entrypoint for testing
 if __name__ == "__main__":
     event = {
@@ -170,6 +258,7 @@ if __name__ == "__main__":
         "contentType": "wav",
         # "key": "nci/CAaad2c19c9c856e377620efab245e8d70.RE709d062d6466b413be36fdb88ac24ac9.mp3",
         # "contentType": "mp3",
-        "langCode": "en-US"
+        "langCode": "en-US",
+        "lane": "realtime"
     }
     lambda_handler(event, "")
@@ -0,0 +1,145 @@
+import copy
+import json
+import boto3
+import os
+import pcaconfiguration as cf
+import pcachunking
+import pcalanes
+import pcatracking
+import pcatranscribe
+
+TABLE = os.environ["TableName"]
+
+# Status of a chunked recording whose chunks haven't all finished yet - the Step Function waits and asks again
+STATUS_IN_PROGRESS = "IN_PROGRESS"
+
+def generateTranscriptKey(bucket, uri):
+    """
+    Returns the key in the output bucket of the transcript at the given Transcribe output URI
+    """
+    offset = uri.find(bucket) + len(bucket) + 1
+    return uri[offset:]
+
+def readTranscript(s3Client, bucket, uri):
+    """
+    Downloads the transcript at the given Transcribe output URI, returning the key that it was at too
+    """
+    key = generateTranscriptKey(bucket, uri)
+    return key, json.loads(s3Client.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+def stitchChunks(s3Client, sfData, chunks, descriptors):
+    """
+    Stitches the chunks' transcripts, and their redacted versions if the jobs used redaction, and writes them to
+    the output bucket where Transcribe would have written them for the job name.  The speakers are matched from
+    the unredacted transcripts, so that both versions agree.  Returns the job descriptor for the stitched
+    transcript and the keys of the chunks' transcripts
+    """
+    outputBucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+    jobName = sfData["jobName"]
+    transcriptKeys = []
+    transcripts = []
+    for descriptor in descriptors:
+        key, transcript = readTranscript(s3Client, outputBucket, descriptor["Transcript"]["TranscriptFileUri"])
+        transcriptKeys.append(key)
+        transcripts.append(transcript)
+    speakerMaps = pcachunking.matchChunkSpeakers(chunks, transcripts)
+
+    versions = [(jobName + ".json", "TranscriptFileUri")]
+    if "ContentRedaction" in descriptors[0]:
+        versions.append(("redacted-" + jobName + ".json", "RedactedTranscriptFileUri"))
+    uris = {}
+    for stitchedKey, uriField in versions:
+        if uriField != "TranscriptFileUri":
+            transcripts = []
+            for descriptor in descriptors:
+                key, transcript = readTranscript(s3Client, outputBucket, descriptor["Transcript"][uriField])
+                transcriptKeys.append(key)
+                transcripts.append(transcript)
+        stitched = pcachunking.stitchTranscripts(chunks, transcripts, speakerMaps, jobName)
+        s3Client.put_object(Bucket=outputBucket, Key=stitchedKey, ContentType="application/json",
+                            Body=json.dumps(stitched).encode("utf-8"))
+        uris[uriField] = "https://s3.amazonaws.com/" + outputBucket + "/" + stitchedKey
+
+    jobDescriptor = pcachunking.createStitchedDescriptor(descriptors, jobName,
+                                                         "s3://" + sfData["bucket"] + "/" + sfData["key"],
+                                                         sfData["contentType"], uris["TranscriptFileUri"],
+                                                         uris.get("RedactedTranscriptFileUri"))
+    return jobDescriptor, transcriptKeys
+
+def deleteObjects(s3Client, bucket, keys):
+    """
+    Deletes the given objects, which doesn't matter if it fails as they're only left-overs
+    """
+    try:
+        for offset in range(0, len(keys), 1000):
+            objects = [{"Key": key} for key in keys[offset:offset + 1000]]
+            s3Client.delete_objects(Bucket=bucket, Delete={"Objects": objects, "Quiet": True})
+    except Exception as e:
+        print("Unable to delete chunk files ({})".format(str(e)))
+
+def lambda_handler(event, context):
+    """
+    Checks on the Transcribe jobs for the chunks of a long recording.  Until they've all finished, one way or
+    another, the workflow waits and asks again - a job can't be stopped, so even if one has failed we still have
+    to wait for the others.  If they all completed then their transcripts are stitched into one, and the workflow
+    carries on as if that had come from a single job; if any of them failed, or were never started, then the
+    whole recording is treated as a failed job, which is retried if it was a Transcribe internal failure.  Either
+    way the chunks' files are tidied up and any Transcribe lane slot is given back
+    """
+    # Load our configuration data
+    cf.loadConfiguration()
+    sfData = copy.deepcopy(event)
+    chunks = sfData["chunkJobs"]
+
+    # See how each of the chunk jobs is getting on - a chunk that was never started has failed already
+    transcribe = boto3.client("transcribe")
+    descriptors = []
+    for chunk in chunks:
+        if "JobName" in chunk:
+            response = pcatranscribe.callWithBackoff(transcribe.get_transcription_job,
+                                                     TranscriptionJobName=chunk["JobName"])
+            descriptors.append(pcatranscribe.createJobDescriptor(response["TranscriptionJob"]))
+        else:
+            descriptors.append({"TranscriptionJobStatus": "FAILED", "FailureReason": chunk.get("StartError", "")})
+    statuses = [descriptor["TranscriptionJobStatus"] for descriptor in descriptors]
+    if not set(statuses).issubset({"COMPLETED", "FAILED"}):
+        print("Chunked job {}: {} of {} chunks completed, {} failed".format(
+            sfData["jobName"], statuses.count("COMPLETED"), len(statuses), statuses.count("FAILED")))
+        sfData["transcribeStatus"] = STATUS_IN_PROGRESS
+        return sfData
+
+    # Every chunk has finished one way or another, so the chunk audio has done its job
+    s3Client = boto3.client("s3")
+    deleteObjects(s3Client, sfData["bucket"], [chunk["MediaKey"] for chunk in chunks if "MediaKey" in chunk])
+    pcalanes.releaseAdmittedSlot(boto3.client("dynamodb"), TABLE, sfData)
+    sfData.pop("chunkJobs")
+    if "FAILED" in statuses:
+        # The transcripts of any chunks that did complete are no use on their own
+        outputBucket = cf.appConfig[cf.CONF_S3BUCKET_OUTPUT]
+        deleteObjects(s3Client, outputBucket, [generateTranscriptKey(outputBucket, uri)
+                                               for descriptor in descriptors
+                                               for uri in descriptor.get("Transcript", {}).values()])
+        return pcatracking.recordJobOutcome(sfData, "FAILED", descriptors[statuses.index("FAILED")])
+
+    jobDescriptor, transcriptKeys = stitchChunks(s3Client, sfData, chunks, descriptors)
+    deleteObjects(s3Client, cf.appConfig[cf.CONF_S3BUCKET_OUTPUT], transcriptKeys)
+    return pcatracking.recordJobOutcome(sfData, "COMPLETED", jobDescriptor)
+
+# Main entrypoint for testing
+if __name__ == "__main__":
+    event = {
+        "bucket": "pca-raw-audio-1234",
+        "key": "nci/0a.93.a0.3e.00.00 09.09.16.803 09-17-2019.wav",
+        "contentType": "wav",
+        "langCode": "en-US",
+        "jobName": "0a.93.a0.3e.00.00-09.09.16.803-09-17-2019.wav-v20191017090916803000",
+        "chunkJobs": [
+            {"Index": 0, "Start": 0.0, "End": 1815.0, "OwnStart": 0.0, "OwnEnd": 1800.0,
+             "MediaKey": "audioChunks/0a.93.a0.3e.00.00-09.09.16.803-09-17-2019.wav-v20191017090916803000/chunk000.flac",
+             "JobName": "0a.93.a0.3e.00.00-09.09.16.803-09-17-2019.wav-chunk000-v20191017090916803000"},
+            {"Index": 1, "Start": 1785.0, "End": 3600.0, "OwnStart": 1800.0, "OwnEnd": None,
+             "MediaKey": "audioChunks/0a.93.a0.3e.00.00-09.09.16.803-09-17-2019.wav-v20191017090916803000/chunk001.flac",
+             "JobName": "0a.93.a0.3e.00.00-09.09.16.803-09-17-2019.wav-chunk001-v20191017090916803000"}
+        ]
+    }
+    lambda_handler(event, "")
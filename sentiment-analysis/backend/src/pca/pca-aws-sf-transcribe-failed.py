@@ -1,12 +1,17 @@
 import boto3
+import os
 import pcaconfiguration as cf
 import pcacommon
+import pcalanes
+
+TABLE = os.environ["TableName"]
 
 def lambda_handler(event, context):
     """
     When a file has failed to transcribe then we need to do two things:
     1) Remove any temporary clip file left behind
     2) Move the original audio to the "failed" bucket
+    We also give back any Transcribe slot that the execution was still holding
     """
     # Extract params and ready our client
     cf.loadConfiguration()
@@ -32,6 +37,9 @@ def lambda_handler(event, context):
     except Exception as e:
         pass
 
+    # Release any Transcribe lane slot, as the job won't be telling us that it has finished
+    pcalanes.releaseAdmittedSlot(boto3.client("dynamodb"), TABLE, event)
+
     # Return our input data as the final result
     return event
 
@@ -1,6 +1,6 @@
-import json
 import boto3
 import os
+import pcatracking
 
 TABLE = os.environ["TableName"]
 
@@ -9,8 +9,10 @@ def lambda_handler(event, context):
     Create/update the task token for the given Transcribe job,
     and the Step Function should pause until that token is sent
     back by an EventBridge Lambda trigger when the Transcribe
-    job completes.  If no Transcribe job exists then throw an
-    exception, but we shouldn't be here if this is the case
+    job completes.  If the job has already completed then we
+    send the token back ourselves.  If no Transcribe job exists
+    then throw an exception, but we shouldn't be here if this
+    is the case
     """
     # Extract our parameters
     jobName = event["Input"]["jobName"]
@@ -21,14 +23,14 @@ def lambda_handler(event, context):
     if jobName == "":
         raise Exception('No Transcribe job called \'{}\' exists.'.format(jobName))
 
-    # Insert/Update tracking entry between Transcribe job and the Step Function
+    # Insert/Update tracking entry between Transcribe job and the Step Function, unless
+    # the job beat us to it, in which case we complete the handoff here and now
     ddbClient = boto3.client("dynamodb")
-    response = ddbClient.put_item(Item={
-                                    'PKJobId': {'S': jobName},
-                                    'taskToken': {'S': taskToken},
-                                    'taskState': {'S': json.dumps(event["Input"])}
-                                  },
-                                  TableName=TABLE)
+    completion = pcatracking.registerTaskToken(ddbClient, TABLE, jobName, taskToken, event["Input"])
+    if completion is not None:
+        jobStatus, jobDescriptor = completion
+        sfnClient = boto3.client("stepfunctions")
+        pcatracking.completeHandoff(ddbClient, TABLE, sfnClient, taskToken, event["Input"], jobStatus, jobDescriptor)
 
     return event
 
@@ -1,64 +1,35 @@
 import json
 import boto3
-import time
 import os
+import pcatracking
+import pcatranscribe
 
 TABLE = os.environ["TableName"]
 
-# Total number of retry attempts to make
-RETRY_LIMIT = 2
-
 
 def lambda_handler(event, context):
-    # Pick off our event values
-    transcribe = boto3.client("transcribe")
+    """
+    Hands the result of a finished Transcribe job back to the Step Function that is waiting for it.  This is the
+    only place in the workflow that fetches the job details, and it passes them on in the workflow state so that
+    the later stages don't have to fetch them again.  If the Step Function hasn't yet registered its task token
+    then we just record the completion, and the waiting side completes the handoff when it arrives
+    """
+    # Pick off our event values - the event already tells us how the job ended
     jobName = event["detail"]["TranscriptionJobName"]
+    jobStatus = event["detail"]["TranscriptionJobStatus"]
+
+    # Fetch the job details once, and carry them forward for the rest of the workflow
+    transcribe = boto3.client("transcribe")
     response = transcribe.get_transcription_job(TranscriptionJobName = jobName)["TranscriptionJob"]
-    jobStatus = response["TranscriptionJobStatus"]
+    jobDescriptor = pcatranscribe.createJobDescriptor(response)
 
-    # Read tracking entry between Transcribe job and its Step Function
+    # Meet up with the waiting Step Function, if it has got there first
     ddbClient = boto3.client("dynamodb")
-    tracking = ddbClient.get_item(Key={'PKJobId': {'S': jobName}},
-                                  TableName=TABLE)
-
-    # It's unlikely, but if we didn't get a value due to some race condition
-    # meaning that the job finishes before the token was written then wait
-    # for 5 seconds and try again.  Just once.  This may never happen
-    if "Item" not in tracking:
-        # Just sleep for a few seconds and try again
-        time.sleep(5)
-        tracking = ddbClient.get_item(Key={'PKJobId': {'S': jobName}},
-                                      TableName=TABLE)
-
-    # Did we have a result?
-    if "Item" in tracking:
-        # Delete entry in DDB table - there's no way we'll be processing this again
-        ddbClient.delete_item(Key={'PKJobId': {'S': jobName}},
-                              TableName=TABLE)
-
-        # Extract the Step Functions task and previous event status
-        taskToken = tracking["Item"]["taskToken"]['S']
-        eventStatus = json.loads(tracking["Item"]["taskState"]['S'])
-
-        # If the job has FAILED then we need to check if it's a service failure,
-        # as this can happen, then we want to re-try the job another time
-        finalResponse = jobStatus
-        if jobStatus == "FAILED":
-            errorMesg = response["FailureReason"]
-            if errorMesg.startswith("Internal"):
-                # Internal failure - we want to retry a few times, but only once
-                retryCount = eventStatus.pop("retryCount", 0)
-
-                # Not retried enough yet - let's try another time
-                if (retryCount < RETRY_LIMIT):
-                    eventStatus["retryCount"] = retryCount + 1
-                    finalResponse = "RETRY"
-
-        # All complete - continue our workflow with this status/retry count
-        eventStatus["transcribeStatus"] = finalResponse
+    waiting = pcatracking.registerJobCompletion(ddbClient, TABLE, jobName, jobStatus, jobDescriptor)
+    if waiting is not None:
+        taskToken, taskState = waiting
         sfnClient = boto3.client("stepfunctions")
-        sfnClient.send_task_success(taskToken=taskToken,
-                                    output=json.dumps(eventStatus))
+        pcatracking.completeHandoff(ddbClient, TABLE, sfnClient, taskToken, taskState, jobStatus, jobDescriptor)
 
     return {
         'statusCode': 200,
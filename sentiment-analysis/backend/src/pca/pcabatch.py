@@ -0,0 +1,122 @@
+"""
+Batch S3 and Step Functions operations for the maintenance commands.  Listings are split by prefix and run in
+parallel, deletes go in batches of 1000 keys, and per-item calls such as describe_execution and copy_object run
+on a thread pool.  Every operation can be run as a dry-run, and all of them report their progress as they go
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import pcarefresh
+
+# Pool size for the per-item calls, and the S3 limit on keys per delete_objects call
+BATCH_WORKERS = 16
+DELETE_BATCH_SIZE = 1000
+
+
+def discoverPrefixes(s3Client, bucket, prefix=""):
+    """
+    Splits the bucket below the given prefix into its immediate sub-folders, which can then be listed in
+    parallel.  Returns the sub-folder prefixes, plus any keys that sit directly at this level
+    """
+    prefixes = []
+    keys = []
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        prefixes += [entry["Prefix"] for entry in page.get("CommonPrefixes", [])]
+        keys += [entry["Key"] for entry in page.get("Contents", [])]
+    return prefixes, keys
+
+
+def listKeysParallel(s3Client, bucket, prefix="", keyFilter=None, workers=BATCH_WORKERS):
+    """
+    Lists every key below the prefix, listing each sub-folder on its own thread, and keeps the ones that pass the
+    optional keyFilter
+    """
+    prefixes, keys = discoverPrefixes(s3Client, bucket, prefix)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for folderKeys in pool.map(lambda folder: pcarefresh.listAllKeys(s3Client, bucket, folder), prefixes):
+            keys += folderKeys
+
+    return keys if keyFilter is None else [key for key in keys if keyFilter(key)]
+
+
+def mapInPool(function, items, workers=BATCH_WORKERS, label=""):
+    """
+    Calls the function for every item on a thread pool, reporting progress, and returns the results in item
+    order; any item whose call raised an exception gets None as its result
+    """
+    progress = pcarefresh.RefreshProgress(len(items), label)
+
+    def callFunction(item):
+        try:
+            result = function(item)
+            progress.recordResult(True)
+            return result
+        except Exception as e:
+            print("{}{} failed - {}".format(label, item, str(e)))
+            progress.recordResult(False)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(callFunction, items))
+    print(progress.generateReport())
+    return results
+
+
+def deleteKeys(s3Client, bucket, keys, dryRun=False, label="Delete: "):
+    """
+    Deletes the keys from the bucket in batches of 1000, and returns the number actually deleted
+    """
+    keys = sorted(set(keys))
+    if dryRun:
+        for key in keys:
+            print("{}would delete s3://{}/{}".format(label, bucket, key))
+        return 0
+
+    progress = pcarefresh.RefreshProgress(len(keys), label)
+    deleted = 0
+    for offset in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[offset:offset + DELETE_BATCH_SIZE]
+        response = s3Client.delete_objects(Bucket=bucket,
+                                           Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+        errors = response.get("Errors", [])
+        for error in errors:
+            print("{}{} failed - {}".format(label, error["Key"], error.get("Message", "")))
+            progress.recordResult(False)
+        for count in range(len(batch) - len(errors)):
+            progress.recordResult(True)
+        deleted += len(batch) - len(errors)
+
+    print(progress.generateReport())
+    return deleted
+
+
+def copyKeys(s3Client, bucket, copies, dryRun=False, label="Copy: "):
+    """
+    Copies objects within the bucket on a thread pool, where copies is a list of (sourceKey, destinationKey)
+    pairs; duplicates are dropped, and the source keys that were successfully copied are returned
+    """
+    copies = sorted(set(copies))
+    if dryRun:
+        for sourceKey, destnKey in copies:
+            print("{}would copy s3://{}/{} to {}".format(label, bucket, sourceKey, destnKey))
+        return []
+
+    def copyObject(copy):
+        s3Client.copy_object(Bucket=bucket, CopySource={"Bucket": bucket, "Key": copy[0]}, Key=copy[1])
+        return copy[0]
+
+    return [sourceKey for sourceKey in mapInPool(copyObject, copies, label=label) if sourceKey is not None]
+
+
+def listExecutionInputs(sfnClient, stateMachineArn, statusFilter, workers=BATCH_WORKERS):
+    """
+    Returns the input of every execution of the state machine with the given status, as the raw JSON string
+    that Step Functions gives back, fetching the execution details on a thread pool
+    """
+    executionArns = []
+    paginator = sfnClient.get_paginator("list_executions")
+    for page in paginator.paginate(stateMachineArn=stateMachineArn, statusFilter=statusFilter):
+        executionArns += [execution["executionArn"] for execution in page["executions"]]
+
+    return [result for result in mapInPool(lambda arn: sfnClient.describe_execution(executionArn=arn)["input"],
+                                           executionArns, workers, "Describe: ") if result is not None]
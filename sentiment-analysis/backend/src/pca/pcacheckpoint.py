@@ -0,0 +1,155 @@
+"""
+Checkpoints of the turn-by-turn parser's intermediate results, so that if an invocation fails partway through -
+Comprehend throttling or a timeout - the workflow's retry carries on from where it got to rather than starting
+again.  A checkpoint holds the parsed speech segments, the MP3 playback location and which segments have had
+their NLP done, and is keyed by the Transcribe job name and the ETag of its transcript, so a re-transcribed
+call never picks up the checkpoint of an earlier transcript.  They are held in S3, or in a local folder when
+running outside Lambda, and are deleted once the call's results are published
+"""
+
+from pathlib import Path
+import json
+import os
+
+# Version of the checkpoint format - a checkpoint of any other version is ignored
+CHECKPOINT_VERSION = 1
+
+# Stages that a checkpoint can record, in the order that the parser completes them
+STAGE_SEGMENTS = "SEGMENTS"
+STAGE_PLAYBACK = "PLAYBACK"
+
+# How many segments have their NLP done between checkpoints
+NLP_CHECKPOINT_SEGMENTS = 25
+
+
+def generateCheckpointKey(jobName, etag):
+    """
+    Returns the key of the checkpoint for a job's transcript, relative to the store's location
+    """
+    return "{}/{}.json".format(jobName, etag.strip('"'))
+
+
+class S3CheckpointStore:
+    """
+    Checkpoints held as JSON objects under a folder in an S3 bucket
+    """
+    def __init__(self, s3Client, bucket, prefix):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read(self, key):
+        try:
+            response = self.s3Client.get_object(Bucket=self.bucket, Key=self.prefix + "/" + key)
+        except self.s3Client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def write(self, key, checkpoint):
+        self.s3Client.put_object(Bucket=self.bucket, Key=self.prefix + "/" + key, ContentType="application/json",
+                                 Body=json.dumps(checkpoint, separators=(",", ":")).encode("utf-8"))
+
+    def deleteJob(self, jobName):
+        """
+        Deletes every checkpoint for the job, including those of any earlier transcripts
+        """
+        paginator = self.s3Client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + "/" + jobName + "/"):
+            keys = [{"Key": entry["Key"]} for entry in page.get("Contents", [])]
+            if keys != []:
+                self.s3Client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True})
+
+
+class LocalCheckpointStore:
+    """
+    Local stand-in for the S3 checkpoint store, holding the same checkpoints as files in a folder
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def read(self, key):
+        path = self.folder / key
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def write(self, key, checkpoint):
+        path = self.folder / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        workPath = path.with_suffix(".tmp")
+        workPath.write_text(json.dumps(checkpoint, separators=(",", ":")), encoding="utf-8")
+        os.replace(workPath, path)
+
+    def deleteJob(self, jobName):
+        """
+        Deletes every checkpoint for the job, including those of any earlier transcripts
+        """
+        for path in (self.folder / jobName).glob("*.json"):
+            path.unlink()
+
+
+def createCheckpointStore(s3Client=None, bucket="", prefix="", folder=""):
+    """
+    Returns the local stand-in if we have a folder, otherwise the S3 store if we have a prefix, otherwise None,
+    in which case nothing is checkpointed
+    """
+    if folder != "":
+        return LocalCheckpointStore(folder)
+    elif prefix != "":
+        return S3CheckpointStore(s3Client, bucket, prefix)
+    else:
+        return None
+
+
+class Checkpoint:
+    """
+    The checkpoint of one job's transcript.  The parser's state goes into the checkpoint's data, which is only
+    written to the store when save() is called
+    """
+    def __init__(self, store, jobName, etag):
+        self.store = store
+        self.jobName = jobName
+        self.key = generateCheckpointKey(jobName, etag)
+        self.data = None
+        if store is not None:
+            self.data = store.read(self.key)
+        if (self.data is not None) and (self.data.get("CheckpointVersion") != CHECKPOINT_VERSION):
+            self.data = None
+        if self.data is not None:
+            print("Resuming {} from its {} checkpoint".format(jobName, self.data["Stage"]))
+        else:
+            self.data = {"CheckpointVersion": CHECKPOINT_VERSION, "JobName": jobName, "TranscriptETag": etag,
+                         "Stage": None}
+
+    def hasReached(self, stage):
+        """
+        Returns True if the checkpoint records that the parser got as far as the given stage
+        """
+        stages = [STAGE_SEGMENTS, STAGE_PLAYBACK]
+        return (self.data["Stage"] in stages) and (stages.index(self.data["Stage"]) >= stages.index(stage))
+
+    def save(self, stage=None, **state):
+        """
+        Records any new state, and the stage if given, and writes the checkpoint.  Failing to write it only
+        means that a retry has more to do, so that never stops the parser
+        """
+        self.data.update(state)
+        if stage is not None:
+            self.data["Stage"] = stage
+        if self.store is None:
+            return
+        try:
+            self.store.write(self.key, self.data)
+        except Exception as e:
+            print("Unable to write checkpoint {} ({})".format(self.key, str(e)))
+
+    def discard(self):
+        """
+        Deletes the job's checkpoints now that its results are published
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.deleteJob(self.jobName)
+        except Exception as e:
+            print("Unable to delete the checkpoints for {} ({})".format(self.jobName, str(e)))
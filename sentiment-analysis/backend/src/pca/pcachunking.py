@@ -0,0 +1,273 @@
+"""
+Chunked transcription of long recordings.  A multi-hour call as one Transcribe job takes as long as Transcribe
+needs for the whole recording, so instead it can be split with ffmpeg into chunks that end at silences and
+overlap their neighbours by a few seconds, and the chunks are transcribed side by side.  Their transcripts are
+then stitched back into one transcript in Transcribe's format: times are moved back to where they are in the
+whole recording, each overlap keeps the words of just one of its chunks, and the speaker labels of each chunk
+are matched to those of the chunk before it from the words that both of them heard in their overlap, so the
+parser can't tell it apart from the transcript of a single job
+"""
+
+import subprocess
+import copy
+import re
+
+# ffmpeg silence detection - anything quieter than this for at least this long is a silence
+SILENCE_NOISE_DB = -35
+SILENCE_MIN_SECONDS = 0.4
+
+# How far either side of where a chunk would nominally end that we look for a silence to cut at, as a share
+# of the chunk length, and how much each chunk overlaps its neighbours
+CHUNK_SEARCH_SHARE = 0.2
+CHUNK_OVERLAP_SECONDS = 15.0
+
+# Chunks are re-encoded as FLAC, which is lossless, keeps the original channels and cuts at any sample
+CHUNK_MEDIA_FORMAT = "flac"
+
+# Two chunks heard the same word in their overlap if they agree on it and on when it started to within this
+OVERLAP_MATCH_SECONDS = 0.25
+
+# Parts of a Transcribe transcript that are rebuilt by stitching rather than copied from the first chunk
+STITCHED_RESULTS = ["transcripts", "items", "speaker_labels", "channel_labels", "audio_segments"]
+
+SILENCE_REGEX = re.compile(r"silence_(start|end): (-?[\d.]+)")
+
+
+def probeDuration(filename):
+    """
+    Uses ffprobe to find the length of the audio file in seconds
+    """
+    command = ['ffprobe', '-i', filename, '-show_entries', 'format=duration', '-of', 'compact=p=0:nk=1', '-v', '0']
+    return float(subprocess.check_output(command, stderr=subprocess.STDOUT).decode())
+
+
+def detectSilences(filename):
+    """
+    Uses ffmpeg's silencedetect filter to find the silences in the audio file, returning the start and end of
+    each one.  A silence that runs to the end of the file has no end, so it isn't returned
+    """
+    command = ['ffmpeg', '-nostats', '-i', filename, '-af',
+               'silencedetect=noise={}dB:d={}'.format(SILENCE_NOISE_DB, SILENCE_MIN_SECONDS), '-f', 'null', '-']
+    output = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode(errors="ignore")
+    silences = []
+    silenceStart = None
+    for event, value in SILENCE_REGEX.findall(output):
+        if event == "start":
+            silenceStart = max(0.0, float(value))
+        elif silenceStart is not None:
+            silences.append((silenceStart, float(value)))
+            silenceStart = None
+    return silences
+
+
+def planChunks(duration, silences, chunkSeconds, overlapSeconds=CHUNK_OVERLAP_SECONDS):
+    """
+    Works out how to split a recording into chunks of about chunkSeconds, returning an empty list if it's too
+    short to be worth splitting.  The cut between two chunks is at the middle of the silence nearest to where it
+    would nominally be, or right there if there's no silence close enough.  Each chunk "owns" the audio between
+    its cuts, which is where its words are kept from, but its audio runs on into its neighbours by the overlap
+    so that Transcribe has some context at the cut and so that speakers can be matched across it.  The last
+    chunk's ownership runs to the end of the recording, so it has no OwnEnd
+    """
+    count = int(round(duration / chunkSeconds)) if chunkSeconds > 0 else 0
+    if count < 2:
+        return []
+
+    step = duration / count
+    window = step * CHUNK_SEARCH_SHARE
+    cuts = [0.0]
+    for index in range(1, count):
+        nominal = step * index
+        candidates = [(start + end) / 2 for start, end in silences if abs((start + end) / 2 - nominal) <= window]
+        cuts.append(min(candidates, key=lambda cut: abs(cut - nominal)) if candidates != [] else nominal)
+    cuts.append(duration)
+
+    return [{"Index": index,
+             "Start": max(0.0, cuts[index] - overlapSeconds),
+             "End": min(duration, cuts[index + 1] + overlapSeconds),
+             "OwnStart": cuts[index],
+             "OwnEnd": cuts[index + 1] if index < count - 1 else None} for index in range(count)]
+
+
+def splitAudioChunk(filename, chunk, chunkFilename):
+    """
+    Uses ffmpeg to write one chunk of the audio file as FLAC
+    """
+    command = ['ffmpeg', '-y', '-v', 'error', '-ss', '{:.3f}'.format(chunk["Start"]),
+               '-t', '{:.3f}'.format(chunk["End"] - chunk["Start"]), '-i', filename, '-vn', '-c:a', 'flac',
+               chunkFilename]
+    subprocess.check_output(command, stderr=subprocess.STDOUT)
+
+
+def isOwned(chunk, time):
+    """
+    Returns True if the time, in the whole recording, is in the part of the recording that the chunk owns
+    """
+    return (time >= chunk["OwnStart"]) and ((chunk["OwnEnd"] is None) or (time < chunk["OwnEnd"]))
+
+
+def shiftTime(value, offset):
+    return "{:.3f}".format(float(value) + offset)
+
+
+def selectChunkItems(items, chunk, speakerMap):
+    """
+    Returns copies of the transcript items that the chunk owns, with their times in the whole recording and
+    their speakers relabelled.  Punctuation has no time, so it goes with the word before it
+    """
+    selected = []
+    keep = isOwned(chunk, chunk["Start"])
+    for item in items:
+        if "start_time" in item:
+            keep = isOwned(chunk, float(item["start_time"]) + chunk["Start"])
+        if keep:
+            item = copy.deepcopy(item)
+            item.pop("id", None)
+            for field in ["start_time", "end_time"]:
+                if field in item:
+                    item[field] = shiftTime(item[field], chunk["Start"])
+            if "speaker_label" in item:
+                item["speaker_label"] = speakerMap.get(item["speaker_label"], item["speaker_label"])
+            selected.append(item)
+    return selected
+
+
+def readChunkWords(results, chunk):
+    """
+    Returns the start time in the whole recording, the text and the speaker label of every word in a chunk's
+    speaker-separated transcript, taking the speaker from the speaker segments if the word doesn't have one
+    """
+    segmentSpeakers = {}
+    for segment in results["speaker_labels"]["segments"]:
+        for item in segment["items"]:
+            segmentSpeakers[item["start_time"]] = item["speaker_label"]
+
+    words = []
+    for item in results["items"]:
+        if item["type"] == "pronunciation":
+            speaker = item.get("speaker_label", segmentSpeakers.get(item["start_time"]))
+            if speaker is not None:
+                words.append((float(item["start_time"]) + chunk["Start"],
+                              item["alternatives"][0]["content"].lower(), speaker))
+    return words
+
+
+def matchSpeakers(previousWords, words, overlapStart, overlapEnd, knownSpeakers):
+    """
+    Maps the speaker labels of a chunk onto the labels already in use.  Each word that both chunks heard in
+    their overlap is a vote that its two labels are the same speaker, and the labels are paired off in order
+    of their votes.  A label with no votes is a guess - it keeps its own label if that's still free, otherwise
+    it takes the first free label already in use, and only if there are none does it become a new speaker
+    """
+    previous = [word for word in previousWords if overlapStart <= word[0] <= overlapEnd]
+    votes = {}
+    for start, text, speaker in words:
+        if overlapStart <= start <= overlapEnd:
+            for previousStart, previousText, previousSpeaker in previous:
+                if (abs(previousStart - start) <= OVERLAP_MATCH_SECONDS) and (previousText == text):
+                    votes[(speaker, previousSpeaker)] = votes.get((speaker, previousSpeaker), 0) + 1
+                    break
+
+    speakerMap = {}
+    for (speaker, previousSpeaker), count in sorted(votes.items(), key=lambda vote: -vote[1]):
+        if (speaker not in speakerMap) and (previousSpeaker not in speakerMap.values()):
+            speakerMap[speaker] = previousSpeaker
+
+    for speaker in sorted(set([word[2] for word in words]) - set(speakerMap)):
+        free = [known for known in knownSpeakers if known not in speakerMap.values()]
+        if speaker in free:
+            speakerMap[speaker] = speaker
+        elif free != []:
+            speakerMap[speaker] = free[0]
+        else:
+            speakerMap[speaker] = "spk_{}".format(len(knownSpeakers))
+        if speakerMap[speaker] not in knownSpeakers:
+            knownSpeakers.append(speakerMap[speaker])
+    return speakerMap
+
+
+def matchChunkSpeakers(chunks, transcripts):
+    """
+    Returns, for each chunk, the map from its speaker labels to the labels used in the stitched transcript.
+    Channel-separated transcripts need no mapping, as a channel is the same speaker all the way through
+    """
+    if "speaker_labels" not in transcripts[0]["results"]:
+        return [{} for chunk in chunks]
+
+    speakerMaps = []
+    knownSpeakers = []
+    previousWords = None
+    for index, (chunk, data) in enumerate(zip(chunks, transcripts)):
+        words = readChunkWords(data["results"], chunk)
+        if previousWords is None:
+            speakerMap = {speaker: speaker for speaker in sorted(set([word[2] for word in words]))}
+            knownSpeakers += list(speakerMap.values())
+        else:
+            speakerMap = matchSpeakers(previousWords, words, chunk["Start"], chunks[index - 1]["End"],
+                                       knownSpeakers)
+        speakerMaps.append(speakerMap)
+        previousWords = [(start, text, speakerMap[speaker]) for start, text, speaker in words]
+    return speakerMaps
+
+
+def stitchTranscripts(chunks, transcripts, speakerMaps, jobName):
+    """
+    Stitches the chunks' transcripts into one transcript for the whole recording, in the format that Transcribe
+    writes.  Item ids and audio segments aren't carried over, as they can't be stitched consistently
+    """
+    items = []
+    segments = []
+    channels = {}
+    for chunk, data, speakerMap in zip(chunks, transcripts, speakerMaps):
+        results = data["results"]
+        items += selectChunkItems(results["items"], chunk, speakerMap)
+        if "channel_labels" in results:
+            for channel in results["channel_labels"]["channels"]:
+                channels.setdefault(channel["channel_label"], []).extend(
+                    selectChunkItems(channel["items"], chunk, speakerMap))
+        else:
+            # A speaker segment that crosses a cut is trimmed to the words that this chunk owns
+            for segment in results["speaker_labels"]["segments"]:
+                segmentItems = selectChunkItems(segment["items"], chunk, speakerMap)
+                if segmentItems != []:
+                    segments.append({"start_time": segmentItems[0]["start_time"],
+                                     "end_time": segmentItems[-1]["end_time"],
+                                     "speaker_label": speakerMap.get(segment["speaker_label"],
+                                                                     segment["speaker_label"]),
+                                     "items": segmentItems})
+
+    # Rebuild the plain transcript from the words that we kept
+    transcript = ""
+    for item in items:
+        if (item["type"] == "pronunciation") and (transcript != ""):
+            transcript += " "
+        transcript += item["alternatives"][0]["content"]
+
+    stitched = {key: value for key, value in transcripts[0]["results"].items() if key not in STITCHED_RESULTS}
+    stitched.update({"transcripts": [{"transcript": transcript}], "items": items})
+    if "channel_labels" in transcripts[0]["results"]:
+        stitched["channel_labels"] = {"channels": [{"channel_label": label, "items": channelItems}
+                                                   for label, channelItems in sorted(channels.items())],
+                                      "number_of_channels": len(channels)}
+    else:
+        speakers = set([segment["speaker_label"] for segment in segments])
+        stitched["speaker_labels"] = {"speakers": len(speakers), "segments": segments}
+
+    return {"jobName": jobName, "accountId": transcripts[0].get("accountId", ""), "results": stitched,
+            "status": "COMPLETED"}
+
+
+def createStitchedDescriptor(chunkDescriptors, jobName, mediaUri, mediaFormat, transcriptUri, redactedUri=None):
+    """
+    Creates the job descriptor for the stitched transcript, as if it had come from one job over the original
+    recording with the same settings as the chunks' jobs
+    """
+    descriptor = copy.deepcopy(chunkDescriptors[0])
+    descriptor.update({"TranscriptionJobName": jobName, "MediaFormat": mediaFormat,
+                       "Media": {"MediaFileUri": mediaUri}, "Transcript": {"TranscriptFileUri": transcriptUri}})
+    if redactedUri is not None:
+        descriptor["Transcript"]["RedactedTranscriptFileUri"] = redactedUri
+    completionTimes = [chunk["CompletionTime"] for chunk in chunkDescriptors if "CompletionTime" in chunk]
+    if completionTimes != []:
+        descriptor["CompletionTime"] = max(completionTimes)
+    return descriptor
@@ -1,6 +1,7 @@
 import os
 import boto3
 import pcaconfiguration as cf
+import pcatranscribe
 
 # Folder within the InputBucket used to hold temporary clip files
 TMP_UPLOAD_PREFIX = "clip/"
@@ -36,21 +37,6 @@ def generateJobName(key):
     return response
 
 
-def checkExistingJobStatus(jobName, transcribeClient):
-    """
-    Checks the status of a Transcribe job with the specified name.  It will return the current
-    status of the job if it exists, and returns an empty string if it doesn't
-    """
-    try:
-        # If it exists (e.g. doesn't exception) then we may want to delete iz
-        currentJobStatus = transcribeClient.get_transcription_job(TranscriptionJobName=jobName)["TranscriptionJob"]["TranscriptionJobStatus"]
-    except Exception as e:
-        # Job didn't already exist - carry on
-        currentJobStatus = ""
-
-    return currentJobStatus
-
-
 def submitTranscribeJob(bucket, key, langCode, mediaFormat):
     """
     Submits a job to Transcribe based upon the supplied parameters.  If the language code
@@ -60,20 +46,10 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
     lambdaClient = boto3.client('lambda')
     transcribeClient = boto3.client('transcribe')
 
-    # Generate job-nam - delete if it already exists
-    jobName = generateJobName(key)
-    currentJobStatus = checkExistingJobStatus(jobName, transcribeClient)
+    # Generate a unique job-name, so there's never an old job in the way
+    jobName = pcatranscribe.generateVersionedJobName(generateJobName(key))
     uri = 's3://' + bucket + '/' + key
 
-    # If there's a job already running then the input file may have been copied - quit
-    if (currentJobStatus == "IN_PROGRESS") or (currentJobStatus == "QUEUED"):
-        # Return empty job name
-        print("A Transcription job named \'{}\' is already in progress - cannot continue.".format(jobName))
-        return ""
-    elif currentJobStatus != "":
-        # But if an old one exists we can delete it
-        transcribeClient.delete_transcription_job(TranscriptionJobName=jobName)
-
     # Start off our settings blocks
     mediaSettings = {'MediaFileUri': uri}
     jobSettings = {'ChannelIdentification': False}
@@ -92,18 +68,12 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
         selectedLanguage = langCode
         languageIdentList = None
 
-        # Double check that a custom-vocab exists for our language,
+        # Double check that a custom-vocab exists for our language and is ready,
         # and they aren't supported for language detection runs
         if cf.appConfig[cf.CONF_VOCABNAME] != "":
-            try:
-                vocabName = cf.appConfig[cf.CONF_VOCABNAME] + '-' + langCode.lower()
-                ourVocab = transcribe.get_vocabulary(VocabularyName = vocabName)
-                if ourVocab["VocabularyState"] == "READY":
-                    # Only use it if it is ready for use
-                    jobSettings["VocabularyName"] = vocabName
-            except:
-                # Doesn't exist - don't use it
-                pass
+            vocabName = cf.appConfig[cf.CONF_VOCABNAME] + '-' + langCode.lower()
+            if pcatranscribe.isVocabularyReady(transcribeClient, vocabName):
+                jobSettings["VocabularyName"] = vocabName
 
         # Only enable content redaction if it's supported
         if langCode in cf.appConfig[cf.CONF_REDACTION_LANGS]:
@@ -137,11 +107,8 @@ def submitTranscribeJob(bucket, key, langCode, mediaFormat):
               'LanguageOptions': languageIdentList
     }
 
-    # Start the Transcribe job, removing any 'None' values on the way
-    transcribeClient = boto3.client('transcribe')
-    response = transcribeClient.start_transcription_job(
-        **{k: v for k, v in kwargs.items() if v is not None}
-    )
+    # Start the Transcribe job, backing off if we're being throttled
+    response = pcatranscribe.startTranscriptionJob(transcribeClient, **kwargs)
 
     # Return our job name, as we need to track it
     return jobName
@@ -7,6 +7,7 @@ CONF_CONVO_LOCATION = "ConversationLocation"
 CONF_ENTITYENDPOINT = "EntityRecognizerEndpoint"
 CONF_ENTITY_FILE = "EntityStringMap"
 CONF_ENTITYCONF = "EntityThreshold"
+CONF_PREFIX_AUDIO_CHUNKS = "InputBucketAudioChunks"
 CONF_PREFIX_MP3_PLAYBACK = "InputBucketAudioPlayback"
 CONF_S3BUCKET_INPUT = "InputBucketName"
 CONF_PREFIX_RAW_AUDIO = "InputBucketRawAudio"
@@ -14,20 +15,36 @@ CONF_PREFIX_FAILED_AUDIO = "InputBucketFailedTranscriptions"
 CONF_MAX_SPEAKERS = "MaxSpeakers"
 CONF_MINNEGATIVE = "MinSentimentNegative"
 CONF_MINPOSITIVE = "MinSentimentPositive"
+CONF_NLP_PRIORITY = "ComprehendSegmentPriority"
+CONF_NLP_RATE_LIMITS = "ComprehendRateLimits"
 CONF_S3BUCKET_OUTPUT = "OutputBucketName"
 CONF_PREFIX_PARSED_RESULTS = "OutputBucketParsedResults"
+CONF_PREFIX_PARSED_HEADERS = "OutputBucketParsedHeaders"
+CONF_PREFIX_PARSED_SHARDS = "OutputBucketParsedShards"
+CONF_PARSED_ENCODING = "OutputBucketParsedEncoding"
+CONF_PREFIX_PARSED_EXPORT = "OutputBucketParsedExport"
+CONF_PREFIX_PARSED_INDEX = "OutputBucketParsedIndex"
+CONF_PREFIX_CHECKPOINTS = "OutputBucketCheckpoints"
+CONF_PREFIX_BACKFILL = "OutputBucketBackfill"
+CONF_SHEDDING_BACKLOG = "LoadSheddingBacklog"
+CONF_SEARCH_INDEX_TABLE = "SearchIndexTableName"
 CONF_SPEAKER_NAMES = "SpeakerNames"
 CONF_SPEAKER_SEPARATION = "SpeakerSeparationType"
 COMP_SFN_NAME = "StepFunctionName"
 CONF_SUPPORT_BUCKET = "SupportFilesBucketName"
 CONF_TRANSCRIBE_LANG = "TranscribeLanguages"
 CONF_TRANSCRIBE_ALTLANG = "TranscribeAlternateLanguage"
+CONF_CHUNK_MINUTES = "TranscribeChunkMinutes"
+CONF_LANE_CAPACITY = "TranscribeLaneCapacity"
+CONF_LANE_RESERVE = "TranscribeRealtimeReserve"
+CONF_LANGID_MODE = "TranscribeLanguageIdMode"
 CONF_VOCABNAME = "VocabularyName"
 
 # Parameter store fieldnames used by bulk import
 BULK_S3_BUCKET = "BulkUploadBucket"
 BULK_JOB_LIMIT = "BulkUploadMaxTranscribeJobs"
 BULK_MAX_DRIP_RATE = "BulkUploadMaxDripRate"
+BULK_MANIFEST = "BulkUploadManifest"
 
 # Speaker separation modes
 SPEAKER_MODE_SPEAKER = "speaker"
@@ -35,6 +52,26 @@ SPEAKER_MODE_CHANNEL = "channel"
 SPEAKER_MODE_AUTO = "auto"
 SPEAKER_MODES = [SPEAKER_MODE_SPEAKER, SPEAKER_MODE_CHANNEL, SPEAKER_MODE_AUTO]
 
+# Language identification modes - a separate job on a short clip, or a single pass over the full file
+LANGID_MODE_CLIP = "clip"
+LANGID_MODE_FULL = "full"
+LANGID_MODES = [LANGID_MODE_CLIP, LANGID_MODE_FULL]
+
+# Order in which segments are sent to Comprehend - longest first, so that if we run out of time it's the
+# shortest turns that are left, or in the order that they were spoken
+NLP_PRIORITY_LONGEST = "longest"
+NLP_PRIORITY_CHRONOLOGICAL = "chronological"
+NLP_PRIORITIES = [NLP_PRIORITY_LONGEST, NLP_PRIORITY_CHRONOLOGICAL]
+
+# Workflow language code that asks the main Transcribe job to identify the language itself
+LANGCODE_IDENTIFY = "identify"
+
+# Parsed results encodings - plain v1 JSON, or the compact v2 encoding with gzip compression.  The backend can
+# read zstd-compressed results too, but the web UI can't, so they can't be chosen here
+PARSED_ENCODING_V1 = "v1"
+PARSED_ENCODING_V2_GZIP = "v2-gzip"
+PARSED_ENCODINGS = [PARSED_ENCODING_V1, PARSED_ENCODING_V2_GZIP]
+
 # Configuration data
 appConfig = {}
 
@@ -53,30 +90,34 @@ def generateJobName(key):
 
     return response
 
-def extractParameters(ssmResponse, useTagName):
+def extractParameters(ssmResponse, useTagName, config):
     """
-    Picks out the Parameter Store results and appends the values to our
-    overall 'appConfig' variable.
+    Picks out the Parameter Store results and appends the values to the
+    given configuration.
     """
 
     # Good parameters first
     for param in ssmResponse["Parameters"]:
         name = param["Name"]
         value = param["Value"]
-        appConfig[name] = value
+        config[name] = value
 
     # Now the bad/missing
     for paramName in ssmResponse["InvalidParameters"]:
         if useTagName:
-            appConfig[paramName] = paramName
+            config[paramName] = paramName
         else:
-            appConfig[paramName] = ""
+            config[paramName] = ""
 
 def loadConfiguration():
     """
     Loads in the configuration values from Parameter Store.  Bulk loads them in batches of 10,
-    and any that are missing are set to an empty string or to the tag-name.
+    and any that are missing are set to an empty string or to the tag-name.  The new configuration
+    is built up separately and swapped in at the end, so that other threads that are reading the
+    current one never see a half-loaded one
     """
+    global appConfig
+    config = {}
 
     # Load the the core ones in from Parameter Store in batches of up to 10
     ssm = boto3.client('ssm')
@@ -88,34 +129,104 @@ def loadConfiguration():
                                                CONF_PREFIX_PARSED_RESULTS, CONF_SPEAKER_NAMES, CONF_SPEAKER_SEPARATION,
                                                COMP_SFN_NAME, CONF_SUPPORT_BUCKET, CONF_TRANSCRIBE_LANG,
                                                CONF_TRANSCRIBE_ALTLANG])
-    fullParamList3 = ssm.get_parameters(Names=[CONF_VOCABNAME, CONF_CONVO_LOCATION])
+    fullParamList3 = ssm.get_parameters(Names=[CONF_VOCABNAME, CONF_CONVO_LOCATION, CONF_LANE_CAPACITY,
+                                               CONF_LANE_RESERVE, CONF_LANGID_MODE, CONF_PREFIX_PARSED_HEADERS,
+                                               CONF_PREFIX_PARSED_SHARDS, CONF_PARSED_ENCODING, CONF_PREFIX_PARSED_EXPORT,
+                                               CONF_PREFIX_PARSED_INDEX])
+    fullParamList4 = ssm.get_parameters(Names=[CONF_SEARCH_INDEX_TABLE, CONF_NLP_PRIORITY,
+                                               CONF_PREFIX_CHECKPOINTS, CONF_PREFIX_BACKFILL,
+                                               CONF_SHEDDING_BACKLOG, CONF_NLP_RATE_LIMITS,
+                                               CONF_PREFIX_AUDIO_CHUNKS, CONF_CHUNK_MINUTES])
 
     # Extract our parameters into our config
-    extractParameters(fullParamList1, False)
-    extractParameters(fullParamList2, False)
-    extractParameters(fullParamList3, False)
+    extractParameters(fullParamList1, False, config)
+    extractParameters(fullParamList2, False, config)
+    extractParameters(fullParamList3, False, config)
+    extractParameters(fullParamList4, False, config)
 
     # If any important empty values to something
-    if (appConfig[CONF_MINNEGATIVE]) == "":
-        appConfig[CONF_MINNEGATIVE] = 0.5
-    if (appConfig[CONF_MINPOSITIVE]) == "":
-        appConfig[CONF_MINPOSITIVE] = 0.5
-    if (appConfig[CONF_ENTITYCONF]) == "":
-        appConfig[CONF_ENTITYCONF] = 0.5
+    if (config[CONF_MINNEGATIVE]) == "":
+        config[CONF_MINNEGATIVE] = 0.5
+    if (config[CONF_MINPOSITIVE]) == "":
+        config[CONF_MINPOSITIVE] = 0.5
+    if (config[CONF_ENTITYCONF]) == "":
+        config[CONF_ENTITYCONF] = 0.5
+    if (config[CONF_LANE_CAPACITY]) == "":
+        config[CONF_LANE_CAPACITY] = 0
+    if (config[CONF_LANE_RESERVE]) == "":
+        config[CONF_LANE_RESERVE] = 20
+    if (config[CONF_CHUNK_MINUTES]) == "":
+        config[CONF_CHUNK_MINUTES] = 0
+    if (config[CONF_PREFIX_PARSED_HEADERS]) == "undefined":
+        config[CONF_PREFIX_PARSED_HEADERS] = ""
+    if (config[CONF_PREFIX_PARSED_SHARDS]) == "undefined":
+        config[CONF_PREFIX_PARSED_SHARDS] = ""
+    if (config[CONF_PREFIX_PARSED_EXPORT]) == "undefined":
+        config[CONF_PREFIX_PARSED_EXPORT] = ""
+    if (config[CONF_PREFIX_PARSED_INDEX]) == "undefined":
+        config[CONF_PREFIX_PARSED_INDEX] = ""
+    if (config[CONF_SEARCH_INDEX_TABLE]) == "undefined":
+        config[CONF_SEARCH_INDEX_TABLE] = ""
+    if (config[CONF_PREFIX_CHECKPOINTS]) == "undefined":
+        config[CONF_PREFIX_CHECKPOINTS] = ""
+    if (config[CONF_PREFIX_BACKFILL]) == "undefined":
+        config[CONF_PREFIX_BACKFILL] = ""
+    if (config[CONF_SHEDDING_BACKLOG]) == "undefined":
+        config[CONF_SHEDDING_BACKLOG] = ""
+    if (config[CONF_NLP_RATE_LIMITS]) == "undefined":
+        config[CONF_NLP_RATE_LIMITS] = ""
+    if (config[CONF_PREFIX_AUDIO_CHUNKS]) == "undefined":
+        config[CONF_PREFIX_AUDIO_CHUNKS] = ""
 
     # Validate speaker-separation mode
-    appConfig[CONF_SPEAKER_SEPARATION] = appConfig[CONF_SPEAKER_SEPARATION].lower()
-    if (appConfig[CONF_SPEAKER_SEPARATION]) not in SPEAKER_MODES:
-        appConfig[CONF_SPEAKER_SEPARATION] = SPEAKER_MODE_SPEAKER
+    config[CONF_SPEAKER_SEPARATION] = config[CONF_SPEAKER_SEPARATION].lower()
+    if (config[CONF_SPEAKER_SEPARATION]) not in SPEAKER_MODES:
+        config[CONF_SPEAKER_SEPARATION] = SPEAKER_MODE_SPEAKER
+
+    # Validate language identification mode
+    config[CONF_LANGID_MODE] = config[CONF_LANGID_MODE].lower()
+    if (config[CONF_LANGID_MODE]) not in LANGID_MODES:
+        config[CONF_LANGID_MODE] = LANGID_MODE_CLIP
+
+    # Validate the Comprehend segment priority
+    config[CONF_NLP_PRIORITY] = config[CONF_NLP_PRIORITY].lower()
+    if (config[CONF_NLP_PRIORITY]) not in NLP_PRIORITIES:
+        config[CONF_NLP_PRIORITY] = NLP_PRIORITY_LONGEST
+
+    # Validate parsed results encoding
+    config[CONF_PARSED_ENCODING] = config[CONF_PARSED_ENCODING].lower()
+    if (config[CONF_PARSED_ENCODING]) not in PARSED_ENCODINGS:
+        config[CONF_PARSED_ENCODING] = PARSED_ENCODING_V1
 
     # Do any processing (casting, list expansion, etc) that we some parameters need
-    appConfig[CONF_MINNEGATIVE] = float(appConfig[CONF_MINNEGATIVE])
-    appConfig[CONF_MINPOSITIVE] = float(appConfig[CONF_MINPOSITIVE])
-    appConfig[CONF_ENTITYCONF] = float(appConfig[CONF_ENTITYCONF])
-    appConfig[CONF_COMP_LANGS] = appConfig[CONF_COMP_LANGS].split(" | ")
-    appConfig[CONF_REDACTION_LANGS] = appConfig[CONF_REDACTION_LANGS].split(" | ")
-    appConfig[CONF_TRANSCRIBE_LANG] = appConfig[CONF_TRANSCRIBE_LANG].split(" | ")
-    appConfig[CONF_SPEAKER_NAMES] = appConfig[CONF_SPEAKER_NAMES].split(" | ")
+    config[CONF_MINNEGATIVE] = float(config[CONF_MINNEGATIVE])
+    config[CONF_MINPOSITIVE] = float(config[CONF_MINPOSITIVE])
+    config[CONF_ENTITYCONF] = float(config[CONF_ENTITYCONF])
+    config[CONF_LANE_CAPACITY] = int(config[CONF_LANE_CAPACITY])
+    config[CONF_LANE_RESERVE] = int(config[CONF_LANE_RESERVE])
+    config[CONF_CHUNK_MINUTES] = float(config[CONF_CHUNK_MINUTES])
+    config[CONF_COMP_LANGS] = config[CONF_COMP_LANGS].split(" | ")
+    config[CONF_REDACTION_LANGS] = config[CONF_REDACTION_LANGS].split(" | ")
+    config[CONF_TRANSCRIBE_LANG] = config[CONF_TRANSCRIBE_LANG].split(" | ")
+    config[CONF_SPEAKER_NAMES] = config[CONF_SPEAKER_NAMES].split(" | ")
+
+    # Load-shedding tier thresholds must be whole numbers, and ignored if any aren't
+    try:
+        config[CONF_SHEDDING_BACKLOG] = [int(threshold) for threshold in
+                                         config[CONF_SHEDDING_BACKLOG].split(" | ") if threshold != ""]
+    except:
+        config[CONF_SHEDDING_BACKLOG] = []
+
+    # Comprehend rate limits are requests per second for sentiment, entities and the custom entity endpoint,
+    # where a zero or missing rate means that API isn't limited, and they're all ignored if any are invalid
+    try:
+        config[CONF_NLP_RATE_LIMITS] = [float(rate) for rate in
+                                        config[CONF_NLP_RATE_LIMITS].split(" | ") if rate != ""]
+    except:
+        config[CONF_NLP_RATE_LIMITS] = []
+
+    # Swap in the new configuration in one go
+    appConfig = config
 
 def isAutoLanguageDetectionSet():
     """
@@ -124,5 +235,76 @@ def isAutoLanguageDetectionSet():
     """
     return len(appConfig[CONF_TRANSCRIBE_LANG]) > 1
 
+def isSinglePassLanguageIdSet():
+    """
+    Returns flag to indicate if Auto Language Detection should be done by the main Transcribe job over the
+    full audio file, rather than by a separate Transcribe job on a short clip of it
+    """
+    return isAutoLanguageDetectionSet() and (appConfig[CONF_LANGID_MODE] == LANGID_MODE_FULL)
+
+def isParsedHeaderOutputSet():
+    """
+    Returns flag to indicate if a small header object is written alongside each parsed results file, which is
+    indicated by a folder being defined on the config parameter
+    """
+    return appConfig[CONF_PREFIX_PARSED_HEADERS] != ""
+
+def isSegmentShardOutputSet():
+    """
+    Returns flag to indicate if the speech segments of each call are also written as time-ordered shards with
+    a manifest, which is indicated by a folder being defined on the config parameter
+    """
+    return appConfig[CONF_PREFIX_PARSED_SHARDS] != ""
+
+def isParquetExportSet():
+    """
+    Returns flag to indicate if each call is also exported to the Parquet analytics tables as it is processed,
+    which is indicated by a folder being defined on the config parameter
+    """
+    return appConfig[CONF_PREFIX_PARSED_EXPORT] != ""
+
+def isCallIndexOutputSet():
+    """
+    Returns flag to indicate if a word index of each call's transcript is also written for full-text search,
+    which is indicated by a folder being defined on the config parameter
+    """
+    return appConfig[CONF_PREFIX_PARSED_INDEX] != ""
+
+def isSearchIndexTableSet():
+    """
+    Returns flag to indicate if the parser writes each call's items to the web UI's search table itself,
+    rather than leaving it to the indexer, which is indicated by the table name being defined on the config
+    parameter
+    """
+    return appConfig[CONF_SEARCH_INDEX_TABLE] != ""
+
+def isLoadSheddingSet():
+    """
+    Returns flag to indicate if optional enrichment stages are shed under load and backfilled later, which is
+    indicated by both the backlog thresholds and the backfill folder being defined on the config parameters
+    """
+    return (appConfig[CONF_SHEDDING_BACKLOG] != []) and (appConfig[CONF_PREFIX_BACKFILL] != "")
+
+def isComprehendRateLimitSet():
+    """
+    Returns flag to indicate if the Comprehend calls of every parser share a rate limit, which is indicated by
+    at least one non-zero rate being defined on the config parameter
+    """
+    return any([rate > 0 for rate in appConfig[CONF_NLP_RATE_LIMITS]])
+
+def isTranscribeChunkingSet():
+    """
+    Returns flag to indicate if long recordings are split into chunks that are transcribed side by side, which
+    is indicated by both a non-zero chunk length and the chunk folder being defined on the config parameters
+    """
+    return (appConfig[CONF_CHUNK_MINUTES] > 0) and (appConfig[CONF_PREFIX_AUDIO_CHUNKS] != "")
+
+def isTranscribeLaneSchedulingSet():
+    """
+    Returns flag to indicate if Transcribe capacity is being shared out between the real-time and bulk lanes,
+    which is indicated by a non-zero lane capacity being defined on the config parameter
+    """
+    return appConfig[CONF_LANE_CAPACITY] > 0
+
 if __name__ == "__main__":
     loadConfiguration()
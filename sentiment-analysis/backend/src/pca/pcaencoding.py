@@ -0,0 +1,187 @@
+"""
+Compact v2 encoding of the parsed-results files.  In v1 every word in WordConfidence is a 4-key dictionary, and
+each segment's text appears twice; v2 stores each segment's words as columns, with delta-encoded times in
+hundredths of a second and confidences as integers, only stores the segment text when it isn't just the words
+joined together, and compresses the result.  The conversion is lossless - any segment that wouldn't come back
+exactly as it went in is left in its v1 form - so readers can always convert back to v1
+"""
+
+import gzip
+import json
+
+# Optional faster serialisation and better compression, if those libraries are available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Field that marks a parsed-results document as v2, and the scales used to quantise the word columns
+FORMAT_VERSION_FIELD = "FormatVersion"
+TIME_SCALE = 100
+CONFIDENCE_SCALE = 10000
+
+# Supported Content-Encoding values
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+# Order of the fields in a v1 speech segment, used to rebuild them in their usual order
+V1_SEGMENT_FIELDS = ["SegmentStartTime", "SegmentEndTime", "SegmentSpeaker", "OriginalText", "DisplayText",
+                     "TextEdited", "SentimentIsPositive", "SentimentIsNegative", "SentimentScore",
+                     "BaseSentimentScores", "EntitiesDetected", "WordConfidence"]
+V1_WORD_FIELDS = ["Text", "Confidence", "StartTime", "EndTime"]
+
+
+def dumpJSON(data):
+    """
+    Serialises to compact UTF-8 JSON, using orjson if it's available
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loadJSON(body):
+    """
+    Deserialises UTF-8 JSON, using orjson if it's available
+    """
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def encodeWords(words):
+    """
+    Turns a v1 WordConfidence list into columns: the text of each word, each word's start as a delta from the
+    previous word's start, each word's length, and its confidence - all as integers
+    """
+    columns = {"Text": [], "Start": [], "Length": [], "Confidence": []}
+    lastStart = 0
+    for word in words:
+        start = round(word["StartTime"] * TIME_SCALE)
+        columns["Text"].append(word["Text"])
+        columns["Start"].append(start - lastStart)
+        columns["Length"].append(round(word["EndTime"] * TIME_SCALE) - start)
+        columns["Confidence"].append(round(word["Confidence"] * CONFIDENCE_SCALE))
+        lastStart = start
+    return columns
+
+
+def decodeWords(columns):
+    """
+    Turns the word columns back into a v1 WordConfidence list
+    """
+    words = []
+    start = 0
+    for text, startDelta, length, confidence in zip(columns["Text"], columns["Start"], columns["Length"],
+                                                    columns["Confidence"]):
+        start += startDelta
+        words.append({"Text": text, "Confidence": confidence / CONFIDENCE_SCALE,
+                      "StartTime": start / TIME_SCALE, "EndTime": (start + length) / TIME_SCALE})
+    return words
+
+
+def convertSegmentToV2(segment):
+    """
+    Converts one v1 speech segment to v2, or returns it unchanged if it wouldn't convert back exactly
+    """
+    try:
+        encoded = {k: v for k, v in segment.items() if k not in ["OriginalText", "DisplayText", "WordConfidence"]}
+        encoded["Words"] = encodeWords(segment["WordConfidence"])
+        joinedText = "".join(encoded["Words"]["Text"])
+        if segment["OriginalText"] != joinedText:
+            encoded["OriginalText"] = segment["OriginalText"]
+        if segment["DisplayText"] != segment["OriginalText"]:
+            encoded["DisplayText"] = segment["DisplayText"]
+        if convertSegmentToV1(encoded) == segment:
+            return encoded
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    return segment
+
+
+def convertSegmentToV1(segment):
+    """
+    Converts one v2 speech segment back to v1; a segment that was left in v1 form is returned unchanged
+    """
+    if "Words" not in segment:
+        return segment
+
+    decoded = {k: v for k, v in segment.items() if k != "Words"}
+    decoded["WordConfidence"] = decodeWords(segment["Words"])
+    decoded["OriginalText"] = segment.get("OriginalText", "".join(segment["Words"]["Text"]))
+    decoded["DisplayText"] = segment.get("DisplayText", decoded["OriginalText"])
+
+    # Put the fields back into their usual order
+    ordered = {k: decoded[k] for k in V1_SEGMENT_FIELDS if k in decoded}
+    ordered.update({k: v for k, v in decoded.items() if k not in ordered})
+    return ordered
+
+
+def convertToV2(data):
+    """
+    Converts a v1 parsed-results document to v2
+    """
+    if data.get(FORMAT_VERSION_FIELD) == 2:
+        return data
+    encoded = {FORMAT_VERSION_FIELD: 2}
+    encoded.update({k: v for k, v in data.items() if k != "SpeechSegments"})
+    encoded["SpeechSegments"] = [convertSegmentToV2(segment) for segment in data.get("SpeechSegments", [])]
+    return encoded
+
+
+def convertToV1(data):
+    """
+    Converts a parsed-results document of either version to v1
+    """
+    if data.get(FORMAT_VERSION_FIELD) != 2:
+        return data
+    decoded = {k: v for k, v in data.items() if k not in [FORMAT_VERSION_FIELD, "SpeechSegments"]}
+    decoded["SpeechSegments"] = [convertSegmentToV1(segment) for segment in data.get("SpeechSegments", [])]
+    return decoded
+
+
+def compressBody(body, compression):
+    """
+    Compresses the body, returning the compressed bytes and the Content-Encoding that describes them
+    """
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise Exception('The zstandard package is required for zstd compression.')
+        return zstandard.ZstdCompressor().compress(body), COMPRESSION_ZSTD
+    elif compression == COMPRESSION_GZIP:
+        return gzip.compress(body), COMPRESSION_GZIP
+    else:
+        return body, None
+
+
+def decompressBody(body, contentEncoding):
+    """
+    Decompresses a body according to its Content-Encoding
+    """
+    if contentEncoding == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise Exception('The zstandard package is required to read zstd-compressed results.')
+        return zstandard.ZstdDecompressor().decompress(body)
+    elif contentEncoding == COMPRESSION_GZIP:
+        return gzip.decompress(body)
+    else:
+        return body
+
+
+def encodeBody(data, formatVersion=1, compression=None):
+    """
+    Encodes a v1 parsed-results document for writing to S3, returning the body and its Content-Encoding
+    """
+    if formatVersion == 2:
+        data = convertToV2(data)
+    return compressBody(dumpJSON(data), compression)
+
+
+def decodeBody(body, contentEncoding=None):
+    """
+    Decodes a parsed-results object read from S3 into a v1 document, whatever its version and compression
+    """
+    return convertToV1(loadJSON(decompressBody(body, contentEncoding)))
@@ -0,0 +1,386 @@
+"""
+Columnar analytics export of the parsed results.  Each call is flattened into rows for three tables - calls,
+speech segments and entities - which are written as Parquet files partitioned by conversation date and language,
+so cross-call analysis becomes a columnar scan rather than parsing thousands of JSON files.  Calls can be exported
+one at a time as they are processed, or in bulk over the whole results bucket, and the small files that this
+leaves behind are compacted, keeping only the newest export of each call.  This needs the optional pyarrow
+package; without it the export is skipped
+"""
+
+from datetime import datetime, timezone
+import pcaoutput
+import pcabatch
+import re
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Table names, and the columns of each table as (name, type)
+TABLE_CALLS = "calls"
+TABLE_SEGMENTS = "segments"
+TABLE_ENTITIES = "entities"
+TABLE_COLUMNS = {
+    TABLE_CALLS: [("CallKey", "string"), ("JobName", "string"), ("ConversationTime", "string"),
+                  ("ConversationLocation", "string"), ("LanguageCode", "string"), ("ProcessTime", "string"),
+                  ("Duration", "float64"), ("AverageAccuracy", "float64"), ("SpeakerCount", "int32"),
+                  ("SegmentCount", "int32"), ("WordCount", "int32"), ("CallerAverageSentiment", "float64"),
+                  ("CallerSentimentChange", "float64"), ("AgentAverageSentiment", "float64"),
+                  ("AgentSentimentChange", "float64"), ("EntityRecognizerName", "string")],
+    TABLE_SEGMENTS: [("CallKey", "string"), ("SegmentIndex", "int32"), ("SegmentStartTime", "float64"),
+                     ("SegmentEndTime", "float64"), ("SegmentSpeaker", "string"), ("DisplayText", "string"),
+                     ("SentimentIsPositive", "int8"), ("SentimentIsNegative", "int8"), ("SentimentScore", "float64"),
+                     ("PositiveScore", "float64"), ("NegativeScore", "float64"), ("NeutralScore", "float64"),
+                     ("MixedScore", "float64"), ("WordCount", "int32"), ("AverageConfidence", "float64"),
+                     ("EntityCount", "int32")],
+    TABLE_ENTITIES: [("CallKey", "string"), ("SegmentIndex", "int32"), ("Type", "string"), ("Text", "string"),
+                     ("Score", "float64"), ("BeginOffset", "int32"), ("EndOffset", "int32")]
+}
+
+# Partition used when a call has no usable conversation date
+UNKNOWN_PARTITION = "unknown"
+
+# How many calls the bulk export flattens before it writes their files, and how many files a partition can have
+# before compaction merges them
+BULK_EXPORT_BATCH_CALLS = 1000
+COMPACTION_MIN_FILES = 2
+
+# Bulk and compacted file names start with the UTC time of the export that they hold
+EXPORT_TIME_PATTERN = re.compile(r"^(?:bulk|compacted)-(\d{14})(\d{6})?-")
+
+
+def isExportAvailable():
+    """
+    Returns True if the Parquet libraries are installed
+    """
+    return pyarrow is not None
+
+
+def createSchema(table):
+    """
+    Creates the Arrow schema for one of our tables
+    """
+    return pyarrow.schema([(name, getattr(pyarrow, typeName)()) for name, typeName in TABLE_COLUMNS[table]])
+
+
+def generatePartition(data):
+    """
+    Returns the (date, language) partition for a call, where the date is the day of the conversation
+    """
+    header = data["ConversationAnalytics"]
+    conversationTime = str(header.get("ConversationTime", ""))
+    date = conversationTime[:10] if re.match(r"\d{4}-\d{2}-\d{2}", conversationTime) else UNKNOWN_PARTITION
+    return date, header.get("LanguageCode", "") or UNKNOWN_PARTITION
+
+
+def generatePartitionName(partition):
+    """
+    Returns the Hive-style name of a partition, which is how it's recorded in the results metadata
+    """
+    return "date={}/language={}".format(partition[0], partition[1])
+
+
+def parsePartitionName(partitionName):
+    """
+    Returns the (date, language) partition for a partition name
+    """
+    date, language = partitionName.split("/")
+    return date[len("date="):], language[len("language="):]
+
+
+def generatePartitionPrefix(exportPrefix, table, partition):
+    """
+    Returns the Hive-style folder for a table partition
+    """
+    return "{}/{}/{}/".format(exportPrefix, table, generatePartitionName(partition))
+
+
+def flattenCall(key, data):
+    """
+    Flattens one call's parsed results into rows for each of the tables, returned as a dictionary of lists
+    """
+    header = data["ConversationAnalytics"]
+    segments = data.get("SpeechSegments", [])
+    jobInfo = header.get("SourceInformation", [{}])[0].get("TranscribeJobInfo", {})
+    trends = header.get("SentimentTrends", [])
+    rows = {TABLE_CALLS: [], TABLE_SEGMENTS: [], TABLE_ENTITIES: []}
+
+    rows[TABLE_CALLS].append({
+        "CallKey": key,
+        "JobName": jobInfo.get("TranscriptionJobName"),
+        "ConversationTime": header.get("ConversationTime"),
+        "ConversationLocation": header.get("ConversationLocation"),
+        "LanguageCode": header.get("LanguageCode"),
+        "ProcessTime": header.get("ProcessTime"),
+        "Duration": segments[-1]["SegmentEndTime"] if segments != [] else 0.0,
+        "AverageAccuracy": jobInfo.get("AverageAccuracy"),
+        "SpeakerCount": len(header.get("SpeakerLabels", [])),
+        "SegmentCount": len(segments),
+        "WordCount": sum([len(segment.get("WordConfidence", [])) for segment in segments]),
+        "CallerAverageSentiment": trends[0]["AverageSentiment"] if len(trends) > 0 else None,
+        "CallerSentimentChange": trends[0]["SentimentChange"] if len(trends) > 0 else None,
+        "AgentAverageSentiment": trends[1]["AverageSentiment"] if len(trends) > 1 else None,
+        "AgentSentimentChange": trends[1]["SentimentChange"] if len(trends) > 1 else None,
+        "EntityRecognizerName": header.get("EntityRecognizerName")
+    })
+
+    for index, segment in enumerate(segments):
+        words = segment.get("WordConfidence", [])
+        scores = segment.get("BaseSentimentScores", {}) or {}
+        entities = segment.get("EntitiesDetected", []) or []
+        rows[TABLE_SEGMENTS].append({
+            "CallKey": key,
+            "SegmentIndex": index,
+            "SegmentStartTime": segment["SegmentStartTime"],
+            "SegmentEndTime": segment["SegmentEndTime"],
+            "SegmentSpeaker": segment["SegmentSpeaker"],
+            "DisplayText": segment.get("DisplayText"),
+            "SentimentIsPositive": segment.get("SentimentIsPositive"),
+            "SentimentIsNegative": segment.get("SentimentIsNegative"),
+            "SentimentScore": segment.get("SentimentScore"),
+            "PositiveScore": scores.get("Positive"),
+            "NegativeScore": scores.get("Negative"),
+            "NeutralScore": scores.get("Neutral"),
+            "MixedScore": scores.get("Mixed"),
+            "WordCount": len(words),
+            "AverageConfidence": sum([word["Confidence"] for word in words]) / len(words) if words != [] else None,
+            "EntityCount": len(entities)
+        })
+        for entity in entities:
+            rows[TABLE_ENTITIES].append({
+                "CallKey": key,
+                "SegmentIndex": index,
+                "Type": entity.get("Type"),
+                "Text": entity.get("Text"),
+                "Score": entity.get("Score"),
+                "BeginOffset": entity.get("BeginOffset"),
+                "EndOffset": entity.get("EndOffset")
+            })
+
+    return rows
+
+
+def encodeParquet(table, rows):
+    """
+    Encodes the rows for one of our tables as a Parquet file
+    """
+    arrowTable = pyarrow.Table.from_pylist(rows, schema=createSchema(table))
+    buffer = pyarrow.BufferOutputStream()
+    pyarrow.parquet.write_table(arrowTable, buffer, compression="snappy")
+    return buffer.getvalue().to_pybytes()
+
+
+def writePartitionedFiles(s3Client, bucket, exportPrefix, partitionedRows, fileName):
+    """
+    Writes one Parquet file per table per partition, where partitionedRows maps each partition to the
+    dictionary of table rows that belong in it; tables with no rows in a partition get no file
+    """
+    for partition, rows in partitionedRows.items():
+        for table, tableRows in rows.items():
+            if tableRows != []:
+                s3Client.put_object(Bucket=bucket,
+                                    Key=generatePartitionPrefix(exportPrefix, table, partition) + fileName,
+                                    Body=encodeParquet(table, tableRows))
+
+
+def generateCallFileName(key):
+    """
+    Returns the per-call Parquet file name, which is the same every time the call is exported
+    """
+    return "call-" + re.sub(r"[^A-Za-z0-9._-]", "_", key.split("/")[-1]) + ".parquet"
+
+
+def exportCall(s3Client, bucket, exportPrefix, key, data):
+    """
+    Exports a single call to its own set of Parquet files, replacing any earlier export of just that call
+    """
+    if not isExportAvailable():
+        print("Skipping Parquet export of {} - pyarrow is not installed".format(key))
+        return False
+
+    writePartitionedFiles(s3Client, bucket, exportPrefix, {generatePartition(data): flattenCall(key, data)},
+                          generateCallFileName(key))
+    return True
+
+
+def removeCallExport(s3Client, bucket, exportPrefix, key, partitionName):
+    """
+    Takes a call out of a partition that it no longer belongs in, such as when its language has changed.  Its
+    own files are deleted, and its rows are filtered out of any bulk or compacted files in the partition, which
+    are written back under the same names so that they keep their place in the export order
+    """
+    partition = parsePartitionName(partitionName)
+    callFileName = generateCallFileName(key)
+    print("Removing the export of {} from {}".format(key, partitionName))
+    for table in TABLE_COLUMNS:
+        partitionPrefix = generatePartitionPrefix(exportPrefix, table, partition)
+        s3Client.delete_object(Bucket=bucket, Key=partitionPrefix + callFileName)
+        if not isExportAvailable():
+            continue
+
+        # Only the shared files can hold more than one call
+        paginator = s3Client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=partitionPrefix):
+            for entry in page.get("Contents", []):
+                if entry["Key"].endswith(".parquet") and not entry["Key"][len(partitionPrefix):].startswith("call-"):
+                    arrowTable = readParquet(s3Client, bucket, entry["Key"], entry["ETag"])
+                    kept = arrowTable.filter(pyarrow.compute.not_equal(arrowTable.column("CallKey"), key))
+                    if kept.num_rows < arrowTable.num_rows:
+                        buffer = pyarrow.BufferOutputStream()
+                        pyarrow.parquet.write_table(kept, buffer, compression="snappy")
+                        s3Client.put_object(Bucket=bucket, Key=entry["Key"], Body=buffer.getvalue().to_pybytes())
+
+
+def exportAll(s3Client, bucket, resultsPrefix, exportPrefix, workers=pcabatch.BATCH_WORKERS):
+    """
+    Exports every call in the results bucket, reading and flattening the files in parallel.  Calls are written
+    a batch at a time, so memory use stays bounded however big the bucket is, and the partitions are then
+    compacted so that analysts aren't left with thousands of small files
+    """
+    if not isExportAvailable():
+        raise Exception('The pyarrow package is required for the Parquet export.')
+
+    keys = pcabatch.listKeysParallel(s3Client, bucket, resultsPrefix)
+    runId = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    for batchNo, offset in enumerate(range(0, len(keys), BULK_EXPORT_BATCH_CALLS)):
+        batchKeys = keys[offset:offset + BULK_EXPORT_BATCH_CALLS]
+        readCall = lambda key: (key, pcaoutput.readParsedResults(s3Client, bucket, key)[0])
+        partitionedRows = {}
+        for result in pcabatch.mapInPool(readCall, batchKeys, workers, "Export: "):
+            if result is not None:
+                partitionRows = partitionedRows.setdefault(generatePartition(result[1]),
+                                                           {table: [] for table in TABLE_COLUMNS})
+                for table, rows in flattenCall(result[0], result[1]).items():
+                    partitionRows[table] += rows
+        writePartitionedFiles(s3Client, bucket, exportPrefix, partitionedRows,
+                              "bulk-{}-{:05d}.parquet".format(runId, batchNo))
+
+    compactExport(s3Client, bucket, exportPrefix)
+
+
+def readParquet(s3Client, bucket, key, eTag=None):
+    """
+    Reads a Parquet file from S3 into an Arrow table, failing if an ETag is given and the file no longer has it
+    """
+    objectArgs = {"IfMatch": eTag} if eTag is not None else {}
+    body = s3Client.get_object(Bucket=bucket, Key=key, **objectArgs)["Body"].read()
+    return pyarrow.parquet.read_table(pyarrow.BufferReader(body))
+
+
+def readExportTime(fileName, entry):
+    """
+    Returns when the rows in an export file were exported.  Bulk and compacted files are written some time after
+    their rows were read, so they carry that time in their name, whereas a call's own file is written as it's
+    exported, so its S3 write time is used
+    """
+    match = EXPORT_TIME_PATTERN.match(fileName)
+    if match is None:
+        return entry["LastModified"]
+    return datetime.strptime(match.group(1) + (match.group(2) or "000000"),
+                             "%Y%m%d%H%M%S%f").replace(tzinfo=timezone.utc)
+
+
+def compactPartition(s3Client, bucket, exportPrefix, partitionPath, fileSets):
+    """
+    Merges the files of one partition, across all three tables, into a single file per table.  Every export
+    writes a calls file, so the calls files decide which export owns each call - the most recently exported one
+    that has it - and only that export's rows are kept in every table, so re-exported calls are never
+    duplicated, even in a table where the newer export had no rows for the call.  The merged files are named
+    with the newest export time of their sources, so a call that's exported again while this runs still wins
+    next time.  Each file is only read if it's still the version that was listed, otherwise this fails and the
+    partition is left for the next compaction
+    """
+    exportTimes = {fileName: max([readExportTime(fileName, entry) for entry in entries.values()])
+                   for fileName, entries in fileSets.items()}
+    ordered = sorted(fileSets.items(), key=lambda fileSet: exportTimes[fileSet[0]], reverse=True)
+    callTables = {}
+    owners = {}
+    for fileName, entries in ordered:
+        if TABLE_CALLS in entries:
+            callTables[fileName] = readParquet(s3Client, bucket, entries[TABLE_CALLS]["Key"],
+                                               entries[TABLE_CALLS]["ETag"])
+            for callKey in callTables[fileName].column("CallKey").to_pylist():
+                owners.setdefault(callKey, fileName)
+
+    # Everything is read before anything is written, so a file that fails its ETag check leaves nothing behind
+    mergedTables = {}
+    for table in TABLE_COLUMNS:
+        tables = [pyarrow.Table.from_pylist([], schema=createSchema(table))]
+        for fileName, entries in ordered:
+            if table in entries:
+                arrowTable = callTables[fileName] if table == TABLE_CALLS else \
+                    readParquet(s3Client, bucket, entries[table]["Key"], entries[table]["ETag"])
+                ownedKeys = [callKey for callKey, owner in owners.items() if owner == fileName]
+                tables.append(arrowTable.filter(pyarrow.compute.is_in(arrowTable.column("CallKey"),
+                                                                      value_set=pyarrow.array(ownedKeys,
+                                                                                              pyarrow.string()))))
+        mergedTables[table] = pyarrow.concat_tables(tables)
+
+    compactedName = "compacted-{}-{}.parquet".format(
+        max(exportTimes.values()).astimezone(timezone.utc).strftime("%Y%m%d%H%M%S%f"),
+        datetime.utcnow().strftime("%Y%m%d%H%M%S%f"))
+    for table, mergedTable in mergedTables.items():
+        buffer = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(mergedTable, buffer, compression="snappy")
+        s3Client.put_object(Bucket=bucket, Key="{}/{}/{}/{}".format(exportPrefix, table, partitionPath, compactedName),
+                            Body=buffer.getvalue().to_pybytes())
+
+
+def deleteUnchangedFiles(s3Client, bucket, entries):
+    """
+    Deletes the listed files that still have the ETag that they were listed with.  A file that has been written
+    again since then, such as a call that was re-exported while we were compacting, is kept for the next
+    compaction, as its rows aren't in the merged files
+    """
+    keys = []
+    changed = 0
+    for entry in entries:
+        try:
+            currentETag = s3Client.head_object(Bucket=bucket, Key=entry["Key"])["ETag"]
+        except Exception as e:
+            # Already gone
+            continue
+        if currentETag == entry["ETag"]:
+            keys.append(entry["Key"])
+        else:
+            changed += 1
+    if changed > 0:
+        print("Keeping {} files that changed while they were being compacted".format(changed))
+    pcabatch.deleteKeys(s3Client, bucket, keys)
+
+
+def compactExport(s3Client, bucket, exportPrefix, dryRun=False):
+    """
+    Compacts every partition that has more than one export in it.  The merged files are written before the
+    originals are removed, so an interrupted compaction just leaves older copies of some rows behind, which
+    the next compaction drops.  Only the versions of the files that were merged are removed
+    """
+    if not isExportAvailable():
+        raise Exception('The pyarrow package is required for the Parquet export.')
+
+    # Group the files by partition, and then by file name, which each export shares across the three tables
+    partitions = {}
+    for table in TABLE_COLUMNS:
+        tablePrefix = "{}/{}/".format(exportPrefix, table)
+        paginator = s3Client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=tablePrefix):
+            for entry in page.get("Contents", []):
+                if entry["Key"].endswith(".parquet"):
+                    partitionPath, fileName = entry["Key"][len(tablePrefix):].rsplit("/", 1)
+                    partitions.setdefault(partitionPath, {}).setdefault(fileName, {})[table] = entry
+
+    for partitionPath, fileSets in partitions.items():
+        if len(fileSets) < COMPACTION_MIN_FILES:
+            continue
+        print("Compacting {} exports in {}".format(len(fileSets), partitionPath))
+        if not dryRun:
+            try:
+                compactPartition(s3Client, bucket, exportPrefix, partitionPath, fileSets)
+            except Exception as e:
+                print("Unable to compact {} - leaving it for next time ({})".format(partitionPath, str(e)))
+                continue
+            deleteUnchangedFiles(s3Client, bucket, [entry for entries in fileSets.values()
+                                                    for entry in entries.values()])
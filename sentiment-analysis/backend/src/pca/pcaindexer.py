@@ -0,0 +1,109 @@
+"""
+Items for the web UI's search table, built by the parser from the results that it has just created.  These are
+exactly the call, sentiment, entity and language items that the UI's indexer Lambda would derive from the
+published file, so writing them here means that the indexer doesn't have to download and parse every file again,
+and calls become searchable as soon as they're published.  The results file records the content hash that its
+items were built from, and the indexer skips any file where that matches the file's own content hash
+"""
+
+from datetime import datetime, timedelta
+import json
+import time
+
+# DynamoDB limit on items per batch_write_item call, and how we retry any items that it doesn't process
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_ATTEMPTS = 8
+BATCH_WRITE_BACKOFF_SECONDS = 0.1
+
+# Start of the epoch, for turning conversation times into the millisecond timestamps used by the UI
+EPOCH = datetime(1970, 1, 1)
+
+
+def generateTimestamp(conversationTime):
+    """
+    Returns the conversation time as milliseconds since the epoch, matching how the UI parses it
+    """
+    return (datetime.fromisoformat(str(conversationTime)) - EPOCH) // timedelta(milliseconds=1)
+
+
+def makeItem(pk, sk, tk, data):
+    """
+    Returns one search-table item in DynamoDB form
+    """
+    return {"PK": {"S": pk}, "SK": {"S": sk}, "TK": {"N": str(tk)}, "Data": {"S": data}}
+
+
+def createIndexItems(key, data):
+    """
+    Creates the search-table items for one call's parsed results, in the same form as the UI's indexer.
+    Entity values found under more than one entity type would give duplicate keys, so only the last is kept
+    """
+    analytics = data["ConversationAnalytics"]
+    segments = data.get("SpeechSegments", [])
+    jobInfo = analytics["SourceInformation"][0]["TranscribeJobInfo"]
+    timestamp = generateTimestamp(analytics["ConversationTime"])
+    callData = json.dumps({
+        "key": key,
+        "jobName": jobInfo["TranscriptionJobName"],
+        "accuracy": jobInfo["AverageAccuracy"],
+        "lang": analytics["LanguageCode"],
+        "duration": segments[-1]["SegmentEndTime"] if segments != [] else 0.0,
+        "timestamp": timestamp,
+        "location": analytics["ConversationLocation"]
+    }, separators=(",", ":"), ensure_ascii=False)
+    callId = "call#" + key
+
+    # Call and sentiment items - the first two speakers are the caller and the agent
+    items = [makeItem(callId, "call", timestamp, callData)]
+    for role, trend in zip(["caller", "agent"], analytics["SentimentTrends"]):
+        items.append(makeItem(callId, "sentiment#{}#average".format(role), trend["AverageSentiment"], callData))
+        items.append(makeItem(callId, "sentiment#{}#trend".format(role), trend["SentimentChange"], callData))
+
+    # Entity items, and the entity search item for this call
+    for entity in analytics["CustomEntities"]:
+        for value in entity["Values"]:
+            entityId = "entity#" + value
+            items.append(makeItem(entityId, "entity", 0, entity["Name"]))
+            items.append(makeItem(callId, entityId, 0, callData))
+
+    # Language items
+    languageId = "language#" + analytics["LanguageCode"]
+    items.append(makeItem(languageId, "language", 0, analytics["LanguageCode"]))
+    items.append(makeItem(callId, languageId, 0, callData))
+
+    return list({(item["PK"]["S"], item["SK"]["S"]): item for item in items}.values())
+
+
+def batchWrite(ddbClient, table, requests):
+    """
+    Runs the write requests through batch_write_item in batches of 25, retrying any unprocessed items with an
+    exponential backoff, and raises an exception if some still can't be written
+    """
+    for offset in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = {table: requests[offset:offset + BATCH_WRITE_SIZE]}
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            pending = ddbClient.batch_write_item(RequestItems=pending).get("UnprocessedItems", {})
+            if pending == {}:
+                break
+            time.sleep(BATCH_WRITE_BACKOFF_SECONDS * (2 ** attempt))
+        else:
+            raise Exception("Unable to write {} items to {}".format(len(pending[table]), table))
+
+
+def writeIndexItems(ddbClient, table, key, data):
+    """
+    Writes the search-table items for a call, and deletes any of the call's items from an earlier version of
+    it that are no longer wanted, such as entities that are no longer detected
+    """
+    items = createIndexItems(key, data)
+    wanted = set([item["SK"]["S"] for item in items if item["PK"]["S"] == "call#" + key])
+
+    staleKeys = []
+    paginator = ddbClient.get_paginator("query")
+    for page in paginator.paginate(TableName=table, KeyConditionExpression="PK = :pk",
+                                   ExpressionAttributeValues={":pk": {"S": "call#" + key}},
+                                   ProjectionExpression="PK, SK"):
+        staleKeys += [item for item in page["Items"] if item["SK"]["S"] not in wanted]
+
+    batchWrite(ddbClient, table, [{"PutRequest": {"Item": item}} for item in items] +
+               [{"DeleteRequest": {"Key": staleKey}} for staleKey in staleKeys])
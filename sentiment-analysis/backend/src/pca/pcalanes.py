@@ -0,0 +1,162 @@
+"""
+Capacity scheduler that shares the Transcribe job slots between the real-time lane (files dropped directly into
+the input bucket) and the bulk lane (files moved in by the bulk import workflow).  A configurable share of the
+slots is held back for real-time calls, and bulk work may use everything else.  Each job that is admitted takes
+a lease on a slot, and the leases are held in a single item in the workflow tracking table, which is updated with
+optimistic locking.  A lease expires on its own, so a slot is never lost for good if an execution is stopped or
+crashes, or the event that would have given it back never arrives
+"""
+
+import json
+import math
+import time
+import uuid
+
+# Lane names, and the S3 object tag used by the bulk workflow to mark the files that it moves
+LANE_REALTIME = "realtime"
+LANE_BULK = "bulk"
+LANES = [LANE_REALTIME, LANE_BULK]
+LANE_TAG_NAME = "PCALane"
+
+# Tracking table item that holds the leases, and how often we retry a contended update
+LANE_COUNTER_KEY = "lanes#transcribe"
+LANE_UPDATE_RETRIES = 5
+
+# How long a lease lasts if it isn't given back - long enough for Transcribe to finish the longest recording
+LANE_LEASE_SECONDS = 6 * 60 * 60
+
+
+def calculateLaneReserve(capacity, reservePercent):
+    """
+    Returns the number of slots that are held back for the real-time lane
+    """
+    return min(capacity, int(math.ceil(capacity * reservePercent / 100.0)))
+
+
+def isLaneAdmissible(lane, inFlight, capacity, reserve):
+    """
+    Decides whether a job in the given lane can start.  Real-time jobs can use any free slot, but bulk jobs must
+    leave enough free slots to cover whatever part of the real-time reserve isn't already in use
+    """
+    totalInFlight = sum(inFlight.values())
+    if lane == LANE_BULK:
+        reserveHeadroom = max(0, reserve - inFlight[LANE_REALTIME])
+        return totalInFlight < (capacity - reserveHeadroom)
+    else:
+        return totalInFlight < capacity
+
+
+def readLaneLeases(ddbClient, table):
+    """
+    Reads the leases on the Transcribe slots, returning them as a map of lease ID to its lane and expiry time,
+    along with the version of the lease item that they were read from, which is 0 if it doesn't yet exist
+    """
+    response = ddbClient.get_item(Key={'PKJobId': {'S': LANE_COUNTER_KEY}}, TableName=table, ConsistentRead=True)
+    item = response.get("Item", {})
+    leases = {}
+    for leaseId, lease in item.get("leases", {}).get('M', {}).items():
+        leases[leaseId] = (lease['M']["lane"]['S'], int(lease['M']["expiresAt"]['N']))
+    return leases, int(item.get("leaseVersion", {}).get('N', '0'))
+
+
+def countLaneLeases(leases, now):
+    """
+    Returns the number of unexpired leases held by each lane
+    """
+    inFlight = {lane: 0 for lane in LANES}
+    for lane, expiresAt in leases.values():
+        if (expiresAt > now) and (lane in inFlight):
+            inFlight[lane] += 1
+    return inFlight
+
+
+def requestTranscribeSlot(ddbClient, table, lane, capacity, reserve):
+    """
+    Tries to take a Transcribe slot for the given lane, returning the ID of its lease if the job may start now,
+    otherwise None.  Expired leases are dropped as the new one is written, and the write only happens if no other
+    caller has changed the leases since we read them; if we keep losing that race then we give up for this
+    cycle, and the caller should try again later
+    """
+    for attempt in range(LANE_UPDATE_RETRIES):
+        now = int(time.time())
+        leases, version = readLaneLeases(ddbClient, table)
+        if not isLaneAdmissible(lane, countLaneLeases(leases, now), capacity, reserve):
+            return None
+
+        leaseId = uuid.uuid4().hex
+        leases = {existingId: existing for existingId, existing in leases.items() if existing[1] > now}
+        leases[leaseId] = (lane, now + LANE_LEASE_SECONDS)
+        try:
+            if version == 0:
+                condition = "attribute_not_exists(#version)"
+                values = {}
+            else:
+                condition = "#version = :version"
+                values = {':version': {'N': str(version)}}
+            values[':next'] = {'N': str(version + 1)}
+            values[':leases'] = {'M': {existingId: {'M': {"lane": {'S': existingLane},
+                                                          "expiresAt": {'N': str(expiresAt)}}}
+                                       for existingId, (existingLane, expiresAt) in leases.items()}}
+            ddbClient.update_item(Key={'PKJobId': {'S': LANE_COUNTER_KEY}}, TableName=table,
+                                  UpdateExpression="SET #leases = :leases, #version = :next",
+                                  ConditionExpression=condition,
+                                  ExpressionAttributeNames={'#leases': "leases", '#version': "leaseVersion"},
+                                  ExpressionAttributeValues=values)
+            return leaseId
+        except ddbClient.exceptions.ConditionalCheckFailedException:
+            # Leases changed underneath us - re-read and try again
+            pass
+
+    return None
+
+
+def releaseTranscribeSlot(ddbClient, table, leaseId):
+    """
+    Gives back a Transcribe slot by removing its lease, which does nothing if it has already been given back or
+    has expired and been dropped.  The version is bumped so that nobody can write back a copy of the leases that
+    was read before this one went
+    """
+    try:
+        ddbClient.update_item(Key={'PKJobId': {'S': LANE_COUNTER_KEY}}, TableName=table,
+                              UpdateExpression="REMOVE #leases.#lease ADD #version :one",
+                              ConditionExpression="attribute_exists(#leases.#lease)",
+                              ExpressionAttributeNames={'#leases': "leases", '#lease': leaseId,
+                                                        '#version': "leaseVersion"},
+                              ExpressionAttributeValues={':one': {'N': '1'}})
+    except ddbClient.exceptions.ConditionalCheckFailedException:
+        # Already gone, so nothing to give back
+        pass
+
+
+def releaseAdmittedSlot(ddbClient, table, sfData):
+    """
+    If the workflow state shows that this execution is holding a Transcribe slot then give it back, and remove
+    the markers so that it can never be given back twice
+    """
+    sfData.pop("laneAdmitted", None)
+    leaseId = sfData.pop("laneLease", None)
+    if leaseId is not None:
+        releaseTranscribeSlot(ddbClient, table, leaseId)
+
+
+def reportLaneWait(lane, queuedAt, admitted):
+    """
+    Logs the time that this job has spent waiting in its lane using the CloudWatch embedded metric format,
+    which means that CloudWatch turns it into a per-lane metric without any extra API calls, and returns it
+    """
+    waitSeconds = round(max(0.0, time.time() - queuedAt), 3)
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": "PostCallAnalytics",
+                "Dimensions": [["Lane", "Admitted"]],
+                "Metrics": [{"Name": "TranscribeLaneWait", "Unit": "Seconds"}]
+            }]
+        },
+        "Lane": lane,
+        "Admitted": str(admitted),
+        "TranscribeLaneWait": waitSeconds
+    }))
+
+    return waitSeconds
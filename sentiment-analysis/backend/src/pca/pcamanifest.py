@@ -0,0 +1,170 @@
+"""
+Manifest-driven ordering for the bulk import workflow.  A manifest lists the audio files that should be imported,
+optionally with a priority and a date for each one.  It is read once at the start of a bulk run, sorted into
+priority order and written out as fixed-size pages, so each later cycle of the workflow only has to read the page
+that its cursor points at rather than listing the whole bulk bucket again
+"""
+
+from datetime import datetime
+import urllib.parse
+import json
+import gzip
+import csv
+import io
+
+# Number of manifest entries held in each page object
+MANIFEST_PAGE_SIZE = 1000
+
+# Folder within the support bucket used to hold the sorted manifest pages - the bulk template only lets the
+# workflow write to the support bucket within this folder
+MANIFEST_PAGE_PREFIX = "bulk-manifest/"
+
+
+def createManifestEntry(key, priority="", date=""):
+    """
+    Creates a single manifest entry, defaulting the priority to 0 if it is missing or isn't a number
+    """
+    try:
+        priorityValue = int(priority)
+    except (TypeError, ValueError):
+        priorityValue = 0
+
+    return {"Key": key, "Priority": priorityValue, "Date": (date or "").strip()}
+
+
+def parseCSVManifest(body, sourceBucket):
+    """
+    Parses a CSV manifest.  If the first row is a header containing a "Key" column then the optional "Priority"
+    and "Date" columns are also used; otherwise the rows are taken to be S3 Inventory-style, which means that
+    they are [Bucket, Key, Size, LastModifiedDate] with URL-encoded keys, and only rows for our bucket are kept
+    """
+    entries = []
+    rows = list(csv.reader(io.StringIO(body)))
+    if rows == []:
+        return entries
+
+    header = [column.strip().lower() for column in rows[0]]
+    if "key" in header:
+        # Header-based manifest - map the columns that we know about
+        keyCol = header.index("key")
+        priorityCol = header.index("priority") if "priority" in header else -1
+        dateCol = header.index("date") if "date" in header else -1
+        for row in rows[1:]:
+            if len(row) > keyCol and row[keyCol].strip() != "":
+                priority = row[priorityCol] if 0 <= priorityCol < len(row) else ""
+                date = row[dateCol] if 0 <= dateCol < len(row) else ""
+                entries.append(createManifestEntry(row[keyCol].strip(), priority, date))
+    else:
+        # Inventory-style manifest - no priority, but we can order by the last-modified date
+        for row in rows:
+            if (len(row) >= 2) and (row[0] == sourceBucket):
+                date = row[3] if len(row) >= 4 else ""
+                entries.append(createManifestEntry(urllib.parse.unquote_plus(row[1]), "", date))
+
+    return entries
+
+
+def parseInventoryManifest(s3Client, body, sourceBucket):
+    """
+    Parses an S3 Inventory manifest.json file, reading each of the (gzipped) CSV data files that it references
+    and using the declared file schema to find the key and last-modified date columns
+    """
+    entries = []
+    manifest = json.loads(body)
+    schema = [column.strip() for column in manifest["fileSchema"].split(",")]
+    keyCol = schema.index("Key")
+    dateCol = schema.index("LastModifiedDate") if "LastModifiedDate" in schema else -1
+    dataBucket = manifest["destinationBucket"].split(":::")[-1]
+
+    for dataFile in manifest["files"]:
+        data = s3Client.get_object(Bucket=dataBucket, Key=dataFile["key"])["Body"].read()
+        if dataFile["key"].endswith(".gz"):
+            data = gzip.decompress(data)
+        for row in csv.reader(io.StringIO(data.decode("utf-8"))):
+            if (len(row) > keyCol) and (row[0] == sourceBucket):
+                date = row[dateCol] if 0 <= dateCol < len(row) else ""
+                entries.append(createManifestEntry(urllib.parse.unquote_plus(row[keyCol]), "", date))
+
+    return entries
+
+
+def sortManifestEntries(entries):
+    """
+    Orders the manifest so that higher priorities come first, and within a priority the oldest dated files come
+    first; undated files go to the back of their priority, and otherwise the original manifest order is kept
+    """
+    return sorted(entries, key=lambda x: (-x["Priority"], x["Date"] == "", x["Date"]))
+
+
+def loadManifest(s3Client, sourceBucket, manifestKey):
+    """
+    Reads the manifest file from the bulk bucket and returns its entries in priority order.  The manifest itself
+    is never part of the import, and if the manifest does not exist then None is returned
+    """
+    try:
+        body = s3Client.get_object(Bucket=sourceBucket, Key=manifestKey)["Body"].read()
+    except Exception as e:
+        print("No bulk manifest {} found in bucket {} - listing the bucket instead".format(manifestKey, sourceBucket))
+        return None
+
+    if manifestKey.endswith(".gz"):
+        body = gzip.decompress(body)
+    body = body.decode("utf-8-sig")
+
+    if manifestKey.endswith(".json"):
+        entries = parseInventoryManifest(s3Client, body, sourceBucket)
+    else:
+        entries = parseCSVManifest(body, sourceBucket)
+
+    return sortManifestEntries([entry for entry in entries if entry["Key"] != manifestKey])
+
+
+def writeManifestPages(s3Client, pageBucket, entries):
+    """
+    Writes the sorted manifest keys out as a set of page objects, and returns the page prefix that the workflow
+    should carry around along with its cursor
+    """
+    pagePrefix = MANIFEST_PAGE_PREFIX + datetime.utcnow().strftime("%Y%m%d%H%M%S%f") + "/"
+    for pageNo, offset in enumerate(range(0, len(entries), MANIFEST_PAGE_SIZE)):
+        pageKeys = [entry["Key"] for entry in entries[offset:offset + MANIFEST_PAGE_SIZE]]
+        s3Client.put_object(Bucket=pageBucket, Key=generatePageKey(pagePrefix, pageNo),
+                            Body=json.dumps(pageKeys).encode("utf-8"))
+
+    return pagePrefix
+
+
+def generatePageKey(pagePrefix, pageNo):
+    """
+    Generates the S3 key for a given manifest page
+    """
+    return pagePrefix + "page-{:06d}.json".format(pageNo)
+
+
+def readManifestEntries(s3Client, pageBucket, pagePrefix, cursor, count, total):
+    """
+    Returns up to count manifest keys starting at the cursor position, only reading the pages that cover them
+    """
+    keys = []
+    lastEntry = min(cursor + count, total)
+    if lastEntry <= cursor:
+        return keys
+
+    firstPage = cursor // MANIFEST_PAGE_SIZE
+    lastPage = (lastEntry - 1) // MANIFEST_PAGE_SIZE
+    for pageNo in range(firstPage, lastPage + 1):
+        pageBody = s3Client.get_object(Bucket=pageBucket, Key=generatePageKey(pagePrefix, pageNo))["Body"].read()
+        pageKeys = json.loads(pageBody)
+        pageStart = pageNo * MANIFEST_PAGE_SIZE
+        keys += pageKeys[max(cursor - pageStart, 0):(lastEntry - pageStart)]
+
+    return keys
+
+
+def removeManifestPages(s3Client, pageBucket, pagePrefix, total):
+    """
+    Removes the page objects once the bulk run has worked its way through the whole manifest
+    """
+    pageKeys = [{"Key": generatePageKey(pagePrefix, pageNo)}
+                for pageNo in range((total + MANIFEST_PAGE_SIZE - 1) // MANIFEST_PAGE_SIZE)]
+    for offset in range(0, len(pageKeys), 1000):
+        s3Client.delete_objects(Bucket=pageBucket, Delete={"Objects": pageKeys[offset:offset + 1000]})
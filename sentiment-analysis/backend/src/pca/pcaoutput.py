@@ -0,0 +1,289 @@
+"""
+Publishing of the parsed-results files.  Every object is written with a hash of its canonical content in its S3
+metadata, and the hash ignores fields like ProcessTime that change on every run.  Re-publishing a file whose
+content hasn't changed is then skipped, so a full refresh only writes - and only triggers the downstream indexing
+of - the calls whose results are actually different
+
+Long calls can also have their speech segments published as time-ordered shards with a manifest, so that a client
+can show the first page straight away and jump directly to the shard for any playback position, and each call can
+have a word index of its transcript published for full-text search
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import pcaencoding
+import pcasearch
+import hashlib
+import json
+
+# S3 user-metadata keys that hold the content hash, the location of any companion objects and any non-v1 encoding
+CONTENT_HASH_METADATA = "pca-content-hash"
+HEADER_KEY_METADATA = "pca-header-key"
+SHARD_MANIFEST_METADATA = "pca-shard-manifest"
+INDEX_KEY_METADATA = "pca-index-key"
+
+# S3 user-metadata key that holds the content hash that the search-table items were built from, if the parser
+# wrote them itself
+INDEXED_HASH_METADATA = "pca-indexed-hash"
+ENCODING_METADATA = "pca-encoding"
+
+# S3 user-metadata key that holds the Parquet export partition that the final results were exported to
+EXPORT_PARTITION_METADATA = "pca-export-partition"
+
+# Length of call covered by each segment shard, the name of the shard manifest and how many shards we upload at once
+SEGMENT_SHARD_SECONDS = 300
+SHARD_MANIFEST_NAME = "manifest.json"
+SHARD_UPLOAD_WORKERS = 8
+
+# Header fields that change every time a file is processed, so are left out of the hash
+VOLATILE_HEADER_FIELDS = ["ProcessTime"]
+
+
+def computeContentHash(data):
+    """
+    Returns a SHA-256 hash of the parsed results in canonical form - sorted keys, no whitespace and without the
+    volatile header fields
+    """
+    canonical = data
+    if isinstance(data, dict) and ("ConversationAnalytics" in data):
+        canonical = dict(data)
+        canonical["ConversationAnalytics"] = {k: v for k, v in data["ConversationAnalytics"].items()
+                                              if k not in VOLATILE_HEADER_FIELDS}
+    body = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def readStoredMetadata(s3Client, bucket, key):
+    """
+    Returns the user metadata held on the existing object, or None if there's no object
+    """
+    try:
+        return s3Client.head_object(Bucket=bucket, Key=key).get("Metadata", {})
+    except Exception as e:
+        return None
+
+
+def generateMetadata(data, metadata=None):
+    """
+    Returns a copy of the given object metadata with the content hash of this data added or updated
+    """
+    newMetadata = dict(metadata or {})
+    newMetadata[CONTENT_HASH_METADATA] = computeContentHash(data)
+    return newMetadata
+
+
+def createHeaderDocument(data):
+    """
+    Creates the header object for a parsed results file, which is the conversation analytics plus some summary
+    statistics about the speech segments - enough to list and index a call without reading its transcript
+    """
+    segments = data.get("SpeechSegments", [])
+    return {
+        "ConversationAnalytics": data["ConversationAnalytics"],
+        "Summary": {
+            "Duration": segments[-1]["SegmentEndTime"] if segments != [] else 0.0,
+            "SegmentCount": len(segments),
+            "WordCount": sum([len(segment.get("WordConfidence", [])) for segment in segments])
+        }
+    }
+
+
+def parseEncoding(encoding):
+    """
+    Splits an encoding name such as "v2-gzip" into its format version and compression; None or "v1" is plain
+    v1 JSON
+    """
+    if (encoding is None) or (encoding == "v1"):
+        return 1, None
+    version, compression = encoding.split("-")
+    return int(version[1:]), compression
+
+
+def readParsedResults(s3Client, bucket, key):
+    """
+    Reads a parsed results file in whatever encoding it was written in, returning the v1 document along with
+    the S3 response (without its body), so that the caller can see the ETag and metadata
+    """
+    response = s3Client.get_object(Bucket=bucket, Key=key)
+    data = pcaencoding.decodeBody(response.pop("Body").read(), response.get("ContentEncoding"))
+    return data, response
+
+
+def readStoredConversationTime(s3Client, bucket, key):
+    """
+    Returns the conversation time in the stored parsed results, or None if it can't be read
+    """
+    try:
+        return readParsedResults(s3Client, bucket, key)[0]["ConversationAnalytics"]["ConversationTime"]
+    except Exception as e:
+        print("Unable to read the stored conversation time for {} ({})".format(key, str(e)))
+        return None
+
+
+def generateObjectArgs(data, metadata=None, encoding=None):
+    """
+    Returns the put_object arguments for the data in the given encoding, including its metadata.  Only non-v1
+    encodings are recorded in the metadata, so v1 objects look exactly like they always have
+    """
+    metadata = generateMetadata(data, metadata)
+    metadata.pop(ENCODING_METADATA, None)
+    formatVersion, compression = parseEncoding(encoding)
+    if formatVersion == 1 and compression is None:
+        body = bytes(json.dumps(data).encode('UTF-8'))
+        return {"Body": body, "Metadata": metadata}
+
+    metadata[ENCODING_METADATA] = encoding
+    body, contentEncoding = pcaencoding.encodeBody(data, formatVersion, compression)
+    args = {"Body": body, "Metadata": metadata, "ContentType": "application/json"}
+    if contentEncoding is not None:
+        args["ContentEncoding"] = contentEncoding
+    return args
+
+
+def publishJSON(s3Client, bucket, key, data, metadata=None, encoding=None):
+    """
+    Writes the parsed results to S3 unless the object that's already there has the same content hash, encoding
+    and metadata, and returns True if the object was written
+    """
+    objectArgs = generateObjectArgs(data, metadata, encoding)
+    if readStoredMetadata(s3Client, bucket, key) == objectArgs["Metadata"]:
+        print("Parsed results for {} are unchanged - not re-publishing".format(key))
+        return False
+
+    s3Client.put_object(Bucket=bucket, Key=key, **objectArgs)
+    return True
+
+
+def createSegmentShards(speechSegments, shardSeconds=SEGMENT_SHARD_SECONDS):
+    """
+    Splits the speech segments into time-ordered shards, where each segment goes into the shard for the time
+    period in which it starts.  Periods with no speech get no shard, and a shard's end time is the end of its
+    last segment, so it may run a little past the period boundary
+    """
+    shards = []
+    for segment in speechSegments:
+        shardNo = int(segment["SegmentStartTime"] // shardSeconds)
+        if (shards == []) or (shards[-1][0] != shardNo):
+            shards.append((shardNo, []))
+        shards[-1][1].append(segment)
+    return [segments for shardNo, segments in shards]
+
+
+def publishSegmentShards(s3Client, bucket, shardFolder, resultsKey, speechSegments):
+    """
+    Publishes the speech segments as a set of shards with concurrent uploads, followed by a manifest that lists
+    each shard's time range, size and speakers.  Any shards left over from an earlier, longer version of the
+    call are removed, and the manifest key is returned
+    """
+    shardList = []
+    shardBodies = []
+    for shardNo, segments in enumerate(createSegmentShards(speechSegments)):
+        shardKey = shardFolder + "/shard-{:04d}.json".format(shardNo)
+        shardBodies.append((shardKey, segments))
+        shardList.append({
+            "Key": shardKey,
+            "StartTime": segments[0]["SegmentStartTime"],
+            "EndTime": max([segment["SegmentEndTime"] for segment in segments]),
+            "Size": len(json.dumps(segments).encode("utf-8")),
+            "SegmentCount": len(segments),
+            "Speakers": sorted(set([segment["SegmentSpeaker"] for segment in segments]))
+        })
+
+    with ThreadPoolExecutor(max_workers=SHARD_UPLOAD_WORKERS) as pool:
+        list(pool.map(lambda shard: publishJSON(s3Client, bucket, shard[0], shard[1]), shardBodies))
+
+    # The manifest goes last, so it never lists a shard that isn't there yet
+    manifestKey = shardFolder + "/" + SHARD_MANIFEST_NAME
+    publishJSON(s3Client, bucket, manifestKey, {
+        "ParsedResults": resultsKey,
+        "ShardSeconds": SEGMENT_SHARD_SECONDS,
+        "SegmentCount": len(speechSegments),
+        "Shards": shardList
+    })
+
+    # Tidy up any shards that the call no longer has
+    response = s3Client.list_objects_v2(Bucket=bucket, Prefix=shardFolder + "/shard-")
+    staleKeys = [{"Key": entry["Key"]} for entry in response.get("Contents", [])
+                 if entry["Key"] not in [shard["Key"] for shard in shardList]]
+    if staleKeys != []:
+        s3Client.delete_objects(Bucket=bucket, Delete={"Objects": staleKeys, "Quiet": True})
+
+    return manifestKey
+
+
+def publishCompanions(s3Client, bucket, key, data, headerKey=None, shardFolder=None, indexKey=None):
+    """
+    Publishes the optional companion objects of a parsed results file - its header object, its segment shards
+    and its word index - and returns the metadata that the results file should carry to point at them
+    """
+    metadata = {}
+    if headerKey is not None:
+        publishJSON(s3Client, bucket, headerKey, createHeaderDocument(data))
+        metadata[HEADER_KEY_METADATA] = headerKey
+    if shardFolder is not None:
+        metadata[SHARD_MANIFEST_METADATA] = publishSegmentShards(s3Client, bucket, shardFolder, key,
+                                                                 data.get("SpeechSegments", []))
+    if indexKey is not None:
+        publishJSON(s3Client, bucket, indexKey, pcasearch.createCallIndex(key, data))
+        metadata[INDEX_KEY_METADATA] = indexKey
+    return metadata
+
+
+def republishCompanions(s3Client, bucket, key, data, metadata):
+    """
+    Re-publishes whichever companion objects the existing results file's metadata says that it has
+    """
+    manifestKey = metadata.get(SHARD_MANIFEST_METADATA)
+    shardFolder = manifestKey[:-(len(SHARD_MANIFEST_NAME) + 1)] if manifestKey is not None else None
+    return publishCompanions(s3Client, bucket, key, data, metadata.get(HEADER_KEY_METADATA), shardFolder,
+                             metadata.get(INDEX_KEY_METADATA))
+
+
+def publishParsedResults(s3Client, bucket, key, data, headerKey=None, shardFolder=None, encoding=None,
+                         indexKey=None, metadata=None):
+    """
+    Publishes a parsed results file in the given encoding, first publishing any companion objects, which are
+    always plain JSON.  They go first, and the results file records where they are, so anyone triggered by the
+    results file being written will always find them.  Any other metadata given is added to the results file
+    """
+    metadata = dict(metadata or {})
+    metadata.update(publishCompanions(s3Client, bucket, key, data, headerKey, shardFolder, indexKey))
+    return publishJSON(s3Client, bucket, key, data, metadata, encoding)
+
+
+# Main entrypoint for testing - re-publishes a call against a local stand-in for S3
+if __name__ == "__main__":
+    from datetime import datetime
+    import io
+    import time
+
+    class LocalS3:
+        def __init__(self):
+            self.objects = {}
+
+        def put_object(self, Bucket, Key, **kwargs):
+            self.objects[Key] = kwargs
+
+        def head_object(self, Bucket, Key):
+            return {"Metadata": dict(self.objects[Key]["Metadata"])}
+
+        def get_object(self, Bucket, Key):
+            stored = self.objects[Key]
+            return {"Body": io.BytesIO(stored["Body"]), "Metadata": dict(stored["Metadata"]),
+                    "ContentEncoding": stored.get("ContentEncoding")}
+
+    def createResults(conversationTime):
+        # As the parser builds them for a filename without a conversation time in it
+        processTime = str(datetime.now())
+        return {"ConversationAnalytics": {"ConversationTime": conversationTime or processTime,
+                                          "ProcessTime": processTime, "LanguageCode": "en-US"},
+                "SpeechSegments": [{"SegmentStartTime": 0.0, "SegmentEndTime": 1.5, "OriginalText": "Hello"}]}
+
+    s3 = LocalS3()
+    key = "parsedFiles/call-without-a-time.wav.json"
+    for encoding in ["v1", "v2-gzip"]:
+        s3.objects = {}
+        assert publishParsedResults(s3, "", key, createResults(None), encoding=encoding)
+        time.sleep(0.01)
+        storedTime = readStoredConversationTime(s3, "", key)
+        assert not publishParsedResults(s3, "", key, createResults(storedTime), encoding=encoding)
+    print("Unchanged call was not re-published")
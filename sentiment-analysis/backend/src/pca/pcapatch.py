@@ -0,0 +1,210 @@
+"""
+Schema migrations for the parsed-results files.  Each patch has a schema version, and is either a function that
+modifies the parsed results in place or a list of declarative rules over paths in the parsed-results schema.  A
+file records the schema version that it conforms to in ConversationAnalytics, so only the patches newer than
+that are applied, and files that are already current are never rewritten
+"""
+
+import pcaoutput
+import re
+
+# Header field that records which schema version a parsed-results file conforms to
+SCHEMA_VERSION_FIELD = "SchemaVersion"
+
+# Registered patches as (version, description, function), in version order
+patchRegistry = []
+
+# Conversions that a declarative rule may apply to a value
+RULE_TRANSFORMS = {"str": str, "int": int, "float": float}
+PATH_TOKEN_REGEX = re.compile(r"([^.\[\]]+)|\[(\*|-?\d+)\]")
+
+
+class PatchConflictError(Exception):
+    """ The object was changed by someone else while we were patching it """
+    pass
+
+
+def registerPatch(version, description):
+    """
+    Decorator that registers a function as the patch for the given schema version; the function is passed the
+    full parsed-results structure and modifies it in place
+    """
+    def decorator(patchFunction):
+        if version in [patch[0] for patch in patchRegistry]:
+            raise Exception('Schema version {} already has a patch registered.'.format(version))
+        patchRegistry.append((version, description, patchFunction))
+        patchRegistry.sort(key=lambda patch: patch[0])
+        return patchFunction
+    return decorator
+
+
+def registerRules(version, description, rules):
+    """
+    Registers a list of declarative rules as the patch for the given schema version.  Each rule is a dictionary
+    with an "op" of "set", "default", "rename" or "remove" and a "path" such as "SpeechSegments[*].Field";
+    "set" and "default" take either a literal "value" or a "from" path plus an optional "transform", and
+    "rename" takes the new field name in "to"
+    """
+    registerPatch(version, description)(lambda data: [applyRule(data, rule) for rule in rules])
+
+
+def getCurrentSchemaVersion():
+    """
+    Returns the schema version that newly parsed results conform to
+    """
+    return patchRegistry[-1][0] if patchRegistry != [] else 0
+
+
+def parsePath(path):
+    """
+    Splits a path such as "SpeechSegments[-1].WordConfidence[*].EndTime" into keys, indexes and wildcards
+    """
+    tokens = []
+    for name, index in PATH_TOKEN_REGEX.findall(path):
+        if name != "":
+            tokens.append(name)
+        elif index == "*":
+            tokens.append("*")
+        else:
+            tokens.append(int(index))
+    return tokens
+
+
+def findTargets(data, path):
+    """
+    Returns a (container, key) pair for every place in the data that the path refers to, expanding wildcards;
+    the key itself doesn't have to exist yet, but everything above it does
+    """
+    tokens = parsePath(path)
+    containers = [data]
+    for token in tokens[:-1]:
+        nextContainers = []
+        for container in containers:
+            if token == "*":
+                nextContainers += container if isinstance(container, list) else []
+            elif isinstance(container, dict) and (token in container):
+                nextContainers.append(container[token])
+            elif isinstance(container, list) and isinstance(token, int) and (-len(container) <= token < len(container)):
+                nextContainers.append(container[token])
+        containers = nextContainers
+
+    return [(container, tokens[-1]) for container in containers]
+
+
+def readPath(data, path):
+    """
+    Returns the single value that the path refers to, raising a KeyError if there isn't one
+    """
+    for container, key in findTargets(data, path):
+        try:
+            return container[key]
+        except (KeyError, IndexError, TypeError):
+            pass
+    raise KeyError(path)
+
+
+def applyRule(data, rule):
+    """
+    Applies a single declarative rule to the data
+    """
+    for container, key in findTargets(data, rule["path"]):
+        if not isinstance(container, dict):
+            continue
+        if rule["op"] in ["set", "default"]:
+            if (rule["op"] == "default") and (key in container):
+                continue
+            value = readPath(data, rule["from"]) if "from" in rule else rule["value"]
+            container[key] = RULE_TRANSFORMS[rule["transform"]](value) if "transform" in rule else value
+        elif (rule["op"] == "rename") and (key in container):
+            container[rule["to"]] = container.pop(key)
+        elif rule["op"] == "remove":
+            container.pop(key, None)
+
+
+def applyPatches(data):
+    """
+    Applies every patch that is newer than the file's schema version, in version order, and returns True if
+    anything was applied
+    """
+    header = data["ConversationAnalytics"]
+    fileVersion = header.get(SCHEMA_VERSION_FIELD, 0)
+    pending = [patch for patch in patchRegistry if patch[0] > fileVersion]
+    for version, description, patchFunction in pending:
+        patchFunction(data)
+        header[SCHEMA_VERSION_FIELD] = version
+
+    return pending != []
+
+
+def patchObject(s3Client, bucket, key):
+    """
+    Brings a single parsed-results object up to the current schema version.  The write only happens if the
+    object's ETag is still the one that we read - see writeIfUnchanged - so a file that was re-processed in the
+    meantime is left alone, as its newer output will already be current; returns "patched", "current" or
+    "conflict"
+    """
+    data, response = pcaoutput.readParsedResults(s3Client, bucket, key)
+    if not applyPatches(data):
+        return "current"
+
+    # Write it back in the same encoding that it was read in
+    metadata = response.get("Metadata", {})
+    objectArgs = pcaoutput.generateObjectArgs(data, metadata, metadata.get(pcaoutput.ENCODING_METADATA))
+    objectArgs.setdefault("ContentType", response.get("ContentType", "binary/octet-stream"))
+    try:
+        writeIfUnchanged(s3Client, bucket, key, response["ETag"], **objectArgs)
+    except PatchConflictError:
+        print("Skipping {} - it has been re-written since we read it".format(key))
+        return "conflict"
+
+    # Keep any header object and segment shards in step with the patched file
+    pcaoutput.republishCompanions(s3Client, bucket, key, data, response.get("Metadata", {}))
+
+    return "patched"
+
+
+def supportsConditionalPut(s3Client):
+    """
+    Returns True if the SDK that we're running with can send S3 conditional PUTs, which came long after the
+    version that we pin
+    """
+    try:
+        return "IfMatch" in s3Client.meta.service_model.operation_model("PutObject").input_shape.members
+    except Exception as e:
+        return False
+
+
+def writeIfUnchanged(s3Client, bucket, key, expectedETag, **kwargs):
+    """
+    Writes the object only if it still has the ETag that we read it with.  If the SDK supports S3 conditional
+    PUTs then S3 itself makes that check as part of the write; otherwise it's only best-effort, as we check the
+    ETag immediately before the write but someone else could still write in between the two
+    """
+    if supportsConditionalPut(s3Client):
+        try:
+            s3Client.put_object(Bucket=bucket, Key=key, IfMatch=expectedETag, **kwargs)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ["PreconditionFailed", "NoSuchKey"]:
+                raise PatchConflictError(key)
+            raise e
+        return
+
+    try:
+        currentETag = s3Client.head_object(Bucket=bucket, Key=key)["ETag"]
+    except Exception as e:
+        currentETag = None
+    if currentETag != expectedETag:
+        raise PatchConflictError(key)
+
+    s3Client.put_object(Bucket=bucket, Key=key, **kwargs)
+
+
+# Schema version 1 - adds a call duration to the header level of the JSON structure
+registerRules(1, "Add the call duration to the header", [
+    {"op": "set", "path": "ConversationAnalytics.Duration",
+     "from": "SpeechSegments[-1].WordConfidence[-1].EndTime", "transform": "str"}
+])
+
+registerRules(2, "Mark files from before two-phase publication as fully processed", [
+    {"op": "default", "path": "ConversationAnalytics.Status", "value": "COMPLETE"}
+])
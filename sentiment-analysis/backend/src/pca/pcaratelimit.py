@@ -0,0 +1,175 @@
+"""
+Rate limiting of the Comprehend calls made by every concurrent parser, so that together they stay just under the
+service limits rather than all being throttled and retrying at once.  Each API has a token bucket that refills at
+its configured rate, held in a single item in the workflow tracking table and updated with optimistic locking.
+A parser leases a small batch of tokens at a time, so it only touches the table every few calls, and if the
+bucket is empty it waits until enough tokens will have built up, which queues the callers instead of letting
+them storm the service.  An in-memory bucket is the stand-in when there's no table
+"""
+
+import threading
+import random
+import time
+
+# Comprehend APIs that are limited, which match the order of their rates in the configuration
+LIMIT_SENTIMENT = "sentiment"
+LIMIT_ENTITIES = "entities"
+LIMIT_CUSTOM_ENDPOINT = "custom"
+LIMITS = [LIMIT_SENTIMENT, LIMIT_ENTITIES, LIMIT_CUSTOM_ENDPOINT]
+
+# Tracking table key prefix of the bucket items, and how often we retry a contended update
+BUCKET_KEY_PREFIX = "ratelimit#"
+BUCKET_UPDATE_RETRIES = 5
+
+# Most tokens leased at once, as a share of a second's worth of the rate, and how long a lease stays usable -
+# tokens that are held for longer than that would let a burst through above the rate, so they're dropped
+LEASE_SHARE = 0.25
+LEASE_SECONDS = 1.0
+
+# Longest that a caller will wait for a token before giving up
+MAX_WAIT_SECONDS = 60.0
+
+
+def calculateLeaseSize(rate):
+    """
+    Returns how many tokens are leased at once for the given rate
+    """
+    return max(1, int(rate * LEASE_SHARE))
+
+
+def refillTokens(tokens, refilled, rate, now):
+    """
+    Returns the tokens in a bucket that held the given tokens when it was last refilled, which can never be more
+    than a second's worth
+    """
+    return min(float(rate), tokens + max(0.0, now - refilled) * rate)
+
+
+class DynamoTokenBucketStore:
+    """
+    Token buckets held in the workflow tracking table, with one item per API holding its tokens and when they
+    were last refilled
+    """
+    def __init__(self, ddbClient, table):
+        self.ddbClient = ddbClient
+        self.table = table
+
+    def lease(self, name, rate, count):
+        """
+        Tries to take the given number of tokens, returning 0.0 if they were taken, otherwise how long to wait
+        before there will be enough
+        """
+        key = {"PKJobId": {"S": BUCKET_KEY_PREFIX + name}}
+        for attempt in range(BUCKET_UPDATE_RETRIES):
+            response = self.ddbClient.get_item(Key=key, TableName=self.table, ConsistentRead=True)
+            now = time.time()
+            if "Item" in response:
+                refilled = response["Item"]["Refilled"]["N"]
+                tokens = refillTokens(float(response["Item"]["Tokens"]["N"]), float(refilled), rate, now)
+                condition = "Refilled = :refilled"
+                values = {":refilled": {"N": refilled}}
+            else:
+                tokens = float(rate)
+                condition = "attribute_not_exists(PKJobId)"
+                values = {}
+            if tokens < count:
+                return (count - tokens) / rate
+
+            # Only take them if nobody else has changed the bucket since we read it
+            values.update({":tokens": {"N": str(tokens - count)}, ":now": {"N": repr(now)}})
+            try:
+                self.ddbClient.update_item(Key=key, TableName=self.table,
+                                           UpdateExpression="SET Tokens = :tokens, Refilled = :now",
+                                           ConditionExpression=condition, ExpressionAttributeValues=values)
+                return 0.0
+            except self.ddbClient.exceptions.ConditionalCheckFailedException:
+                time.sleep(random.uniform(0.0, 0.05))
+
+        # We kept losing the race, so the bucket is busy - come back shortly
+        return count / rate
+
+
+class LocalTokenBucketStore:
+    """
+    Local stand-in for the DynamoDB token buckets, holding the same buckets in memory for this process
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def lease(self, name, rate, count):
+        with self.lock:
+            now = time.time()
+            tokens, refilled = self.buckets.get(name, (float(rate), now))
+            tokens = refillTokens(tokens, refilled, rate, now)
+            if tokens < count:
+                return (count - tokens) / rate
+            self.buckets[name] = (tokens - count, now)
+            return 0.0
+
+
+def createTokenBucketStore(ddbClient=None, table=""):
+    """
+    Returns the DynamoDB store if we have a tracking table, otherwise the in-memory stand-in
+    """
+    if table != "":
+        return DynamoTokenBucketStore(ddbClient, table)
+    else:
+        return LocalTokenBucketStore()
+
+
+class RateLimiter:
+    """
+    Hands out tokens from leased batches, leasing another batch from the store when the current one has run out
+    or gone stale, and waiting if the store's bucket is empty
+    """
+    def __init__(self, store, rates):
+        self.store = store
+        self.rates = rates
+        self.leases = {name: (0, 0.0) for name in rates}
+        self.locks = {name: threading.Lock() for name in rates}
+
+    def acquire(self, name):
+        """
+        Takes one token for the API, waiting for one if need be.  APIs without a rate aren't limited
+        """
+        if name not in self.rates:
+            return
+        with self.locks[name]:
+            tokens, expiry = self.leases[name]
+            if (tokens > 0) and (time.time() < expiry):
+                self.leases[name] = (tokens - 1, expiry)
+                return
+
+            rate = self.rates[name]
+            count = calculateLeaseSize(rate)
+            waited = 0.0
+            wait = self.store.lease(name, rate, count)
+            while wait > 0.0:
+                if waited + wait > MAX_WAIT_SECONDS:
+                    raise Exception("Waited too long for a {} rate limit token".format(name))
+                wait += random.uniform(0.0, wait / 4)
+                time.sleep(wait)
+                waited += wait
+                wait = self.store.lease(name, rate, count)
+            self.leases[name] = (count - 1, time.time() + LEASE_SECONDS)
+
+
+class RateLimitedComprehend:
+    """
+    Wraps a Comprehend client so that the calls that we make take a token first
+    """
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def detect_sentiment(self, **kwargs):
+        self.limiter.acquire(LIMIT_SENTIMENT)
+        return self.client.detect_sentiment(**kwargs)
+
+    def detect_entities(self, **kwargs):
+        self.limiter.acquire(LIMIT_CUSTOM_ENDPOINT if "EndpointArn" in kwargs else LIMIT_ENTITIES)
+        return self.client.detect_entities(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,247 @@
+"""
+Reprocessing engine for the parsed-results files.  A refresh run lists the key space once, partitions it into a
+fixed number of shards and writes each shard's key list to the support bucket.  Shards are then worked through
+by a pool of workers - either locally or by fanning out one Lambda invocation per shard - and the keys that each
+shard has finished are checkpointed alongside its key list, so a run that is interrupted or crashes can be
+resumed from where it stopped rather than starting over
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import threading
+import json
+import time
+import zlib
+
+# Folder within the support bucket used to hold the shard lists and checkpoints of each refresh run
+REFRESH_RUN_PREFIX = "refresh-runs/"
+
+# Default shape of a run
+REFRESH_SHARD_COUNT = 16
+REFRESH_WORKERS = 8
+
+# How often a shard saves its checkpoint, and how often progress is reported
+CHECKPOINT_INTERVAL_KEYS = 50
+CHECKPOINT_INTERVAL_SECONDS = 30
+REPORT_INTERVAL_SECONDS = 15
+
+
+def generateRunId():
+    """
+    Generates a new refresh run identifier, which is also the run's folder name
+    """
+    return datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+
+
+def calculateShard(key, shardCount):
+    """
+    Returns the shard that a key belongs to; this is stable, so a key always lands in the same shard of a run
+    """
+    return zlib.crc32(key.encode("utf-8")) % shardCount
+
+
+def partitionKeys(keys, shardCount):
+    """
+    Partitions the keys into shardCount lists, preserving the original order within each shard
+    """
+    shards = [[] for shard in range(shardCount)]
+    for key in keys:
+        shards[calculateShard(key, shardCount)].append(key)
+    return shards
+
+
+def listAllKeys(s3Client, bucket, prefix):
+    """
+    Lists every object key under the given prefix, ignoring any folder placeholders
+    """
+    keys = []
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys += [entry["Key"] for entry in page.get("Contents", []) if not entry["Key"].endswith("/")]
+    return keys
+
+
+class RefreshProgress:
+    """ Thread-safe counters for a refresh, which periodically report throughput and an ETA """
+    def __init__(self, total, label=""):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.startTime = time.monotonic()
+        self.lastReport = self.startTime
+        self.lock = threading.Lock()
+
+    def recordSkipped(self, count):
+        with self.lock:
+            self.skipped += count
+
+    def recordResult(self, success):
+        with self.lock:
+            if success:
+                self.done += 1
+            else:
+                self.failed += 1
+            if time.monotonic() - self.lastReport >= REPORT_INTERVAL_SECONDS:
+                self.lastReport = time.monotonic()
+                print(self.generateReport())
+
+    def generateReport(self):
+        """
+        Returns a one-line summary; throughput only counts keys processed in this session, not resumed ones
+        """
+        elapsed = max(time.monotonic() - self.startTime, 0.001)
+        rate = (self.done + self.failed) / elapsed
+        remaining = self.total - self.done - self.failed - self.skipped
+        eta = "unknown" if rate == 0 else "{:.0f}s".format(remaining / rate)
+        return "{}{} done, {} failed, {} already complete, {} remaining of {} - {:.2f} keys/sec, ETA {}".format(
+            self.label, self.done, self.failed, self.skipped, remaining, self.total, rate, eta)
+
+
+class S3CheckpointStore:
+    """ Holds the shard key lists and per-shard completion checkpoints of a refresh run in the support bucket """
+    def __init__(self, s3Client, bucket, runId):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.runId = runId
+        self.prefix = REFRESH_RUN_PREFIX + runId + "/"
+
+    def readJSON(self, key, default):
+        try:
+            return json.loads(self.s3Client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read())
+        except self.s3Client.exceptions.NoSuchKey:
+            return default
+
+    def writeJSON(self, key, data):
+        self.s3Client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=json.dumps(data).encode("utf-8"))
+
+    def saveRun(self, runInfo, shards):
+        for shard, shardKeys in enumerate(shards):
+            self.writeJSON("shard-{:04d}.json".format(shard), shardKeys)
+        self.writeJSON("run.json", runInfo)
+
+    def loadRun(self):
+        return self.readJSON("run.json", None)
+
+    def loadShardKeys(self, shard):
+        return self.readJSON("shard-{:04d}.json".format(shard), [])
+
+    def loadCompleted(self, shard):
+        return set(self.readJSON("done-{:04d}.json".format(shard), []))
+
+    def saveCompleted(self, shard, completed):
+        self.writeJSON("done-{:04d}.json".format(shard), sorted(completed))
+
+
+def createRun(s3Client, store, keys, shardCount, mode):
+    """
+    Partitions the keys into shards and saves them, along with the run information, to the checkpoint store
+    """
+    runInfo = {"runId": store.runId, "mode": mode, "shardCount": shardCount, "total": len(keys),
+               "startTime": time.time()}
+    store.saveRun(runInfo, partitionKeys(keys, shardCount))
+    return runInfo
+
+
+def runShard(store, shard, processor, workers=REFRESH_WORKERS, progress=None, isOutOfTime=None):
+    """
+    Processes every key in the shard that isn't already checkpointed as complete, using a pool of worker threads.
+    Keys that fail are reported and left out of the checkpoint, so the next resume of the run tries them again.
+    If isOutOfTime says that we have to stop then no new keys are started; returns the number of keys that are
+    still to be processed in this shard
+    """
+    shardKeys = store.loadShardKeys(shard)
+    completed = store.loadCompleted(shard)
+    pending = [key for key in shardKeys if key not in completed]
+    if progress is None:
+        progress = RefreshProgress(len(shardKeys), "Shard {}: ".format(shard))
+    progress.recordSkipped(len(shardKeys) - len(pending))
+
+    unsaved = 0
+    lastSave = time.monotonic()
+    inFlight = {}
+    keyIterator = iter(pending)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Keep the pool busy, unless we've run out of keys or out of time
+            while (len(inFlight) < workers * 2) and not (isOutOfTime is not None and isOutOfTime()):
+                key = next(keyIterator, None)
+                if key is None:
+                    break
+                inFlight[pool.submit(processor, key)] = key
+            if inFlight == {}:
+                break
+
+            finished, notFinished = wait(inFlight.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = inFlight.pop(future)
+                try:
+                    future.result()
+                    completed.add(key)
+                    unsaved += 1
+                    progress.recordResult(True)
+                except Exception as e:
+                    print("Failed to refresh {} - {}".format(key, str(e)))
+                    progress.recordResult(False)
+
+            # Checkpoint every so often
+            if (unsaved >= CHECKPOINT_INTERVAL_KEYS) or \
+                    ((unsaved > 0) and (time.monotonic() - lastSave >= CHECKPOINT_INTERVAL_SECONDS)):
+                store.saveCompleted(shard, completed)
+                unsaved = 0
+                lastSave = time.monotonic()
+
+    if unsaved > 0:
+        store.saveCompleted(shard, completed)
+
+    return len([key for key in shardKeys if key not in completed])
+
+
+def runLocally(store, runInfo, processor, workers=REFRESH_WORKERS):
+    """
+    Works through every shard of the run in this process, sharing one overall progress report
+    """
+    progress = RefreshProgress(runInfo["total"])
+    remaining = 0
+    for shard in range(runInfo["shardCount"]):
+        remaining += runShard(store, shard, processor, workers, progress)
+    print(progress.generateReport())
+    return remaining
+
+
+def fanOutShards(lambdaClient, functionName, runInfo, shards=None):
+    """
+    Asynchronously invokes the refresh Lambda once per shard of the run (or just for the listed shards)
+    """
+    for shard in (range(runInfo["shardCount"]) if shards is None else shards):
+        generateShardInvocation(lambdaClient, functionName, runInfo, shard)
+    print("Refresh run {} fanned out to {} across {} shards".format(runInfo["runId"], functionName,
+                                                                    runInfo["shardCount"]))
+
+
+def generateShardInvocation(lambdaClient, functionName, runInfo, shard):
+    """
+    Invokes the refresh Lambda for a single shard of the run, without waiting for it
+    """
+    payload = {"refreshRunId": runInfo["runId"], "refreshMode": runInfo["mode"], "refreshShard": shard}
+    lambdaClient.invoke(FunctionName=functionName, InvocationType="Event", Payload=json.dumps(payload).encode("utf-8"))
+
+
+def reportRunStatus(store):
+    """
+    Totals up the checkpoints of every shard in a run, and reports overall progress, throughput and ETA
+    """
+    runInfo = store.loadRun()
+    if runInfo is None:
+        print("Refresh run {} does not exist".format(store.runId))
+        return None
+
+    done = sum([len(store.loadCompleted(shard)) for shard in range(runInfo["shardCount"])])
+    elapsed = max(time.time() - runInfo["startTime"], 0.001)
+    rate = done / elapsed
+    remaining = runInfo["total"] - done
+    eta = "unknown" if rate == 0 else "{:.0f}s".format(remaining / rate)
+    print("Refresh run {} ({}): {} of {} complete, {} remaining - {:.2f} keys/sec, ETA {}".format(
+        runInfo["runId"], runInfo["mode"], done, runInfo["total"], remaining, rate, eta))
+    return remaining
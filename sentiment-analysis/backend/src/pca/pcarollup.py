@@ -0,0 +1,344 @@
+"""
+Incremental rollups of the parsed results, so that dashboards can chart sentiment, duration and entities per day
+or per hour without reading every call.  Each call contributes a count, sum and sum of squares of its statistics
+to the day and hour buckets for its language, and to the same buckets across all languages.  The contribution
+that each call last made is stored alongside the buckets, so reprocessing a call only adds the difference between
+its old and new contributions - nothing is ever counted twice - and a version check on the contribution makes
+concurrent updates of the same call safe.  The shared store is DynamoDB, with SQLite as a local stand-in
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import sqlite3
+import json
+import re
+
+# Bucket granularities, the format of their periods, and the language used for the all-language buckets
+GRANULARITY_DAY = "DAY"
+GRANULARITY_HOUR = "HOUR"
+PERIOD_FORMATS = {GRANULARITY_DAY: "%Y-%m-%d", GRANULARITY_HOUR: "%Y-%m-%dT%H"}
+PERIOD_STEPS = {GRANULARITY_DAY: timedelta(days=1), GRANULARITY_HOUR: timedelta(hours=1)}
+ALL_LANGUAGES = "*"
+
+# Key prefix of the per-call contribution records, and the suffixes of each statistic's metrics
+CONTRIBUTION_PREFIX = "CALL#"
+METRIC_COUNT = "#Count"
+METRIC_SUM = "#Sum"
+METRIC_SUM_SQUARES = "#SumSq"
+METRIC_CALLS = "Calls"
+METRIC_ENTITY_PREFIX = "Entity."
+
+# How many times we re-read and retry if another update of the same call gets in first
+ROLLUP_ATTEMPTS = 5
+
+# DynamoDB limit on keys per batch_get_item call
+BATCH_GET_SIZE = 100
+
+
+def generatePeriod(granularity, timestamp):
+    """
+    Returns the period of the given granularity that a datetime falls in
+    """
+    return timestamp.strftime(PERIOD_FORMATS[granularity])
+
+
+def generateBucketKey(granularity, period, language):
+    """
+    Returns the key of a rollup bucket, such as "DAY#2020-08-05#en-US"
+    """
+    return "{}#{}#{}".format(granularity, period, language)
+
+
+def addStatistic(metrics, name, value):
+    """
+    Adds a value to the count, sum and sum of squares metrics of a statistic
+    """
+    value = Decimal(repr(float(value)))
+    metrics[name + METRIC_COUNT] = metrics.get(name + METRIC_COUNT, Decimal(0)) + 1
+    metrics[name + METRIC_SUM] = metrics.get(name + METRIC_SUM, Decimal(0)) + value
+    metrics[name + METRIC_SUM_SQUARES] = metrics.get(name + METRIC_SUM_SQUARES, Decimal(0)) + value * value
+
+
+def createContribution(data):
+    """
+    Works out what one call adds to each of its rollup buckets, as a dictionary of bucket keys to metrics.  The
+    sentiment statistics are per speaker role, using the speaker's display name, and a call with no usable
+    conversation time contributes nothing
+    """
+    header = data["ConversationAnalytics"]
+    match = re.match(r"\d{4}-\d{2}-\d{2}[ T]\d{2}", str(header.get("ConversationTime", "")))
+    if match is None:
+        return {}
+    conversationTime = datetime.strptime(match.group().replace("T", " "), "%Y-%m-%d %H")
+
+    metrics = {METRIC_CALLS: Decimal(1)}
+    segments = data.get("SpeechSegments", [])
+    duration = header.get("Duration", segments[-1]["SegmentEndTime"] if segments != [] else 0.0)
+    addStatistic(metrics, "Duration", duration)
+
+    roles = {label["Speaker"]: label["DisplayText"] for label in header.get("SpeakerLabels", [])}
+    for trend in header.get("SentimentTrends", []):
+        role = roles.get(trend["Speaker"], trend["Speaker"])
+        addStatistic(metrics, role + ".AverageSentiment", trend["AverageSentiment"])
+        addStatistic(metrics, role + ".SentimentChange", trend["SentimentChange"])
+
+    for segment in segments:
+        for entity in segment.get("EntitiesDetected", []) or []:
+            name = METRIC_ENTITY_PREFIX + str(entity.get("Type"))
+            metrics[name] = metrics.get(name, Decimal(0)) + 1
+
+    contribution = {}
+    for granularity in PERIOD_FORMATS:
+        period = generatePeriod(granularity, conversationTime)
+        for language in sorted(set([header.get("LanguageCode") or "unknown", ALL_LANGUAGES])):
+            contribution[generateBucketKey(granularity, period, language)] = dict(metrics)
+    return contribution
+
+
+def calculateDeltas(oldContribution, newContribution):
+    """
+    Returns what has to be added to each bucket to replace the old contribution with the new one, leaving out
+    anything that hasn't changed
+    """
+    deltas = {}
+    for bucket in set(oldContribution) | set(newContribution):
+        oldMetrics = oldContribution.get(bucket, {})
+        newMetrics = newContribution.get(bucket, {})
+        bucketDeltas = {}
+        for metric in set(oldMetrics) | set(newMetrics):
+            delta = newMetrics.get(metric, Decimal(0)) - oldMetrics.get(metric, Decimal(0))
+            if delta != 0:
+                bucketDeltas[metric] = delta
+        if bucketDeltas != {}:
+            deltas[bucket] = bucketDeltas
+    return deltas
+
+
+def encodeContribution(contribution):
+    """
+    Serialises a contribution to JSON, keeping the decimals exact
+    """
+    return json.dumps({bucket: {metric: str(value) for metric, value in metrics.items()}
+                       for bucket, metrics in contribution.items()}, sort_keys=True)
+
+
+def decodeContribution(body):
+    """
+    Deserialises a contribution that was written by encodeContribution
+    """
+    return {bucket: {metric: Decimal(value) for metric, value in metrics.items()}
+            for bucket, metrics in json.loads(body).items()}
+
+
+class DynamoRollupStore:
+    """
+    Rollups held in a DynamoDB table, with one item per bucket and one per call contribution.  A contribution is
+    replaced in a single transaction with the ADDs to its buckets, conditional on the version that we read
+    """
+    def __init__(self, ddbClient, table):
+        self.ddbClient = ddbClient
+        self.table = table
+
+    def readContribution(self, callKey):
+        """
+        Returns the call's current contribution and its version, which is None if the call has never been seen
+        """
+        response = self.ddbClient.get_item(Key={"PKRollupId": {"S": CONTRIBUTION_PREFIX + callKey}},
+                                           TableName=self.table, ConsistentRead=True)
+        if "Item" not in response:
+            return {}, None
+        return decodeContribution(response["Item"]["Contribution"]["S"]), int(response["Item"]["Version"]["N"])
+
+    def writeContribution(self, callKey, contribution, version, deltas):
+        """
+        Stores the call's new contribution and applies the bucket deltas, unless the contribution has changed
+        since it was read, in which case nothing is written and False is returned
+        """
+        put = {"TableName": self.table,
+               "Item": {"PKRollupId": {"S": CONTRIBUTION_PREFIX + callKey},
+                        "Contribution": {"S": encodeContribution(contribution)},
+                        "Version": {"N": str(0 if version is None else version + 1)}}}
+        if version is None:
+            put["ConditionExpression"] = "attribute_not_exists(PKRollupId)"
+        else:
+            put["ConditionExpression"] = "Version = :version"
+            put["ExpressionAttributeValues"] = {":version": {"N": str(version)}}
+        actions = [{"Put": put}]
+
+        for bucket, metrics in sorted(deltas.items()):
+            names = {}
+            values = {}
+            for metricNo, (metric, delta) in enumerate(sorted(metrics.items())):
+                names["#m{}".format(metricNo)] = metric
+                values[":m{}".format(metricNo)] = {"N": str(delta)}
+            actions.append({"Update": {"TableName": self.table, "Key": {"PKRollupId": {"S": bucket}},
+                                       "UpdateExpression": "ADD " + ", ".join(["{} {}".format(name, name.replace("#", ":"))
+                                                                               for name in names]),
+                                       "ExpressionAttributeNames": names,
+                                       "ExpressionAttributeValues": values}})
+        try:
+            self.ddbClient.transact_write_items(TransactItems=actions)
+            return True
+        except self.ddbClient.exceptions.TransactionCanceledException:
+            return False
+
+    def readBuckets(self, bucketKeys):
+        """
+        Returns the metrics of each of the buckets that exist
+        """
+        buckets = {}
+        for offset in range(0, len(bucketKeys), BATCH_GET_SIZE):
+            request = {self.table: {"Keys": [{"PKRollupId": {"S": key}}
+                                             for key in bucketKeys[offset:offset + BATCH_GET_SIZE]]}}
+            while request:
+                response = self.ddbClient.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self.table, []):
+                    buckets[item["PKRollupId"]["S"]] = {name: Decimal(value["N"]) for name, value in item.items()
+                                                        if "N" in value}
+                request = response.get("UnprocessedKeys", {})
+        return buckets
+
+
+class SQLiteRollupStore:
+    """
+    Local stand-in for the DynamoDB rollup store, holding the same buckets and contributions in a SQLite file.
+    Values are stored as decimal text so that they stay exact, and each update runs in its own transaction
+    """
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS contributions "
+                               "(callKey TEXT PRIMARY KEY, contribution TEXT NOT NULL, version INTEGER NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS rollups "
+                               "(bucket TEXT, metric TEXT, value TEXT NOT NULL, PRIMARY KEY (bucket, metric))")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def readContribution(self, callKey):
+        with self.connect() as connection:
+            row = connection.execute("SELECT contribution, version FROM contributions WHERE callKey = ?",
+                                     (callKey,)).fetchone()
+        return ({}, None) if row is None else (decodeContribution(row[0]), row[1])
+
+    def writeContribution(self, callKey, contribution, version, deltas):
+        connection = self.connect()
+        try:
+            connection.isolation_level = None
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT version FROM contributions WHERE callKey = ?", (callKey,)).fetchone()
+            if (row[0] if row is not None else None) != version:
+                connection.execute("ROLLBACK")
+                return False
+
+            connection.execute("INSERT OR REPLACE INTO contributions VALUES (?, ?, ?)",
+                               (callKey, encodeContribution(contribution), 0 if version is None else version + 1))
+            for bucket, metrics in deltas.items():
+                for metric, delta in metrics.items():
+                    row = connection.execute("SELECT value FROM rollups WHERE bucket = ? AND metric = ?",
+                                             (bucket, metric)).fetchone()
+                    value = (Decimal(row[0]) if row is not None else Decimal(0)) + delta
+                    connection.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?)", (bucket, metric, str(value)))
+            connection.execute("COMMIT")
+            return True
+        finally:
+            connection.close()
+
+    def readBuckets(self, bucketKeys):
+        buckets = {}
+        with self.connect() as connection:
+            for offset in range(0, len(bucketKeys), BATCH_GET_SIZE):
+                batch = bucketKeys[offset:offset + BATCH_GET_SIZE]
+                rows = connection.execute("SELECT bucket, metric, value FROM rollups WHERE bucket IN ({})".format(
+                    ",".join(["?"] * len(batch))), batch).fetchall()
+                for bucket, metric, value in rows:
+                    buckets.setdefault(bucket, {})[metric] = Decimal(value)
+        return buckets
+
+
+def createRollupStore(ddbClient=None, table="", databasePath=""):
+    """
+    Returns the DynamoDB store if we have a table, otherwise the SQLite stand-in if we have a database file,
+    otherwise None, in which case rollups are not maintained
+    """
+    if table != "":
+        return DynamoRollupStore(ddbClient, table)
+    elif databasePath != "":
+        return SQLiteRollupStore(databasePath)
+    else:
+        return None
+
+
+def recordCall(store, callKey, data):
+    """
+    Brings the rollups up to date with the latest parsed results for a call, or removes the call from them if
+    data is None.  Returns True if any bucket changed
+    """
+    newContribution = {} if data is None else createContribution(data)
+    for attempt in range(ROLLUP_ATTEMPTS):
+        oldContribution, version = store.readContribution(callKey)
+        deltas = calculateDeltas(oldContribution, newContribution)
+        if (deltas == {}) and ((version is not None) or (newContribution == {})):
+            return False
+        if store.writeContribution(callKey, newContribution, version, deltas):
+            return deltas != {}
+
+    raise Exception("Unable to update the rollups for {} - too many concurrent updates".format(callKey))
+
+
+def generatePeriods(granularity, start, end):
+    """
+    Returns every period of the given granularity from the start to the end datetime, inclusive
+    """
+    periods = []
+    current = datetime.strptime(generatePeriod(granularity, start), PERIOD_FORMATS[granularity])
+    while current <= end:
+        periods.append(generatePeriod(granularity, current))
+        current += PERIOD_STEPS[granularity]
+    return periods
+
+
+def summariseMetrics(metrics):
+    """
+    Turns a bucket's raw metrics into the number of calls, the count, mean and standard deviation of each
+    statistic, and the count of each entity type
+    """
+    summary = {METRIC_CALLS: int(metrics.get(METRIC_CALLS, 0)), "Entities": {}}
+    for metric, value in metrics.items():
+        if metric.endswith(METRIC_COUNT) and value > 0:
+            name = metric[:-len(METRIC_COUNT)]
+            mean = metrics.get(name + METRIC_SUM, Decimal(0)) / value
+            variance = max(metrics.get(name + METRIC_SUM_SQUARES, Decimal(0)) / value - mean * mean, Decimal(0))
+            summary[name] = {"Count": int(value), "Mean": float(mean), "StdDev": float(variance.sqrt())}
+        elif metric.startswith(METRIC_ENTITY_PREFIX) and value > 0:
+            summary["Entities"][metric[len(METRIC_ENTITY_PREFIX):]] = int(value)
+    return summary
+
+
+def queryRollups(store, granularity, start, end, language=ALL_LANGUAGES):
+    """
+    Returns the summary of each period in the range that has any calls, as a list of (period, summary) pairs.
+    This reads one bucket per period, however many calls there are
+    """
+    periods = generatePeriods(granularity, start, end)
+    buckets = store.readBuckets([generateBucketKey(granularity, period, language) for period in periods])
+    results = []
+    for period in periods:
+        metrics = buckets.get(generateBucketKey(granularity, period, language), {})
+        if metrics.get(METRIC_CALLS, 0) > 0:
+            results.append((period, summariseMetrics(metrics)))
+    return results
+
+
+def reportRollups(results):
+    """
+    Prints the results of a rollup query
+    """
+    for period, summary in results:
+        statistics = ", ".join(["{} {:.3f} (sd {:.3f})".format(name, value["Mean"], value["StdDev"])
+                                for name, value in sorted(summary.items()) if isinstance(value, dict) and
+                                "Mean" in value])
+        print("{}: {} calls - {}".format(period, summary[METRIC_CALLS], statistics))
+        if summary["Entities"] != {}:
+            print("    Entities: " + ", ".join(["{} {}".format(entityType, count) for entityType, count
+                                                in sorted(summary["Entities"].items())]))
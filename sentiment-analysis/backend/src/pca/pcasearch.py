@@ -0,0 +1,243 @@
+"""
+Full-text search of the call transcripts.  Each call gets a small inverted index - every normalised term mapped to
+the segment and word positions where it was said - which is published alongside its parsed results.  These are
+merged into a corpus index, a local SQLite file holding a posting list per term per call, that is updated
+incrementally as calls arrive.  A phrase query reads the posting lists of its rarest term first, narrows the
+candidate calls with each of the other terms, and then checks the word positions, so it only ever touches the
+calls that contain every term of the phrase
+"""
+
+import sqlite3
+import json
+import re
+
+# Version of the per-call index format
+CALL_INDEX_VERSION = 1
+
+# Calls fetched and added to the corpus index per transaction, and how many calls go into each IN clause
+CORPUS_BATCH_CALLS = 500
+QUERY_BATCH_CALLS = 500
+
+# Default number of calls returned by a search
+SEARCH_LIMIT = 100
+
+
+def normaliseTerm(text):
+    """
+    Normalises a transcript word or query word to an index term - case-folded, with any surrounding punctuation
+    removed but keeping inner apostrophes and hyphens, so "Don't," becomes "don't"
+    """
+    return re.sub(r"^[\W_]+|[\W_]+$", "", text.strip().casefold())
+
+
+def tokenise(text):
+    """
+    Splits some query text into its index terms
+    """
+    return [term for term in [normaliseTerm(word) for word in text.split()] if term != ""]
+
+
+def createCallIndex(resultsKey, data):
+    """
+    Creates the inverted index for one call, where each term maps to a flat list of [segment, word] position
+    pairs and the word positions are indexes into that segment's WordConfidence list
+    """
+    terms = {}
+    wordCount = 0
+    for segmentNo, segment in enumerate(data.get("SpeechSegments", [])):
+        for wordNo, word in enumerate(segment.get("WordConfidence", [])):
+            term = normaliseTerm(word["Text"])
+            if term != "":
+                terms.setdefault(term, []).extend([segmentNo, wordNo])
+                wordCount += 1
+
+    return {"IndexVersion": CALL_INDEX_VERSION, "ParsedResults": resultsKey, "WordCount": wordCount,
+            "Terms": terms}
+
+
+def decodePositions(flatPositions):
+    """
+    Turns a flat list of position pairs into a set of (segment, word) tuples
+    """
+    return set(zip(flatPositions[0::2], flatPositions[1::2]))
+
+
+def findPhrase(termPositions):
+    """
+    Returns the (segment, word) start positions where the terms appear consecutively within a segment, given
+    the position set of each term in phrase order
+    """
+    return sorted([(segmentNo, wordNo) for segmentNo, wordNo in termPositions[0]
+                   if all([(segmentNo, wordNo + offset) in positions
+                           for offset, positions in enumerate(termPositions) if offset > 0])])
+
+
+class CorpusIndex:
+    """
+    Corpus-level index in a SQLite file.  Each call is recorded against the key of the per-call index that it
+    came from, along with that object's version, so that rebuilding only has to fetch the calls that changed
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (callId INTEGER PRIMARY KEY, sourceKey TEXT UNIQUE NOT NULL,
+                                              callKey TEXT NOT NULL, version TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, callCount INTEGER NOT NULL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (term TEXT, callId INTEGER, positions TEXT NOT NULL,
+                                                 PRIMARY KEY (term, callId)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postingsByCall ON postings (callId);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def readVersions(self):
+        """
+        Returns the version of every call in the index, keyed by its source key
+        """
+        return dict(self.connection.execute("SELECT sourceKey, version FROM calls").fetchall())
+
+    def deleteCall(self, sourceKey):
+        """
+        Removes a call and its postings, as part of the caller's transaction
+        """
+        row = self.connection.execute("SELECT callId FROM calls WHERE sourceKey = ?", (sourceKey,)).fetchone()
+        if row is None:
+            return
+        terms = self.connection.execute("SELECT term FROM postings WHERE callId = ?", row).fetchall()
+        self.connection.executemany("UPDATE terms SET callCount = callCount - 1 WHERE term = ?", terms)
+        self.connection.executemany("DELETE FROM terms WHERE term = ? AND callCount <= 0", terms)
+        self.connection.execute("DELETE FROM postings WHERE callId = ?", row)
+        self.connection.execute("DELETE FROM calls WHERE callId = ?", row)
+
+    def insertCall(self, sourceKey, version, callIndex):
+        """
+        Adds a call's postings, replacing any earlier version of it, as part of the caller's transaction
+        """
+        self.deleteCall(sourceKey)
+        callId = self.connection.execute("INSERT INTO calls (sourceKey, callKey, version) VALUES (?, ?, ?)",
+                                         (sourceKey, callIndex["ParsedResults"], version)).lastrowid
+        self.connection.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                    [(term, callId, json.dumps(positions, separators=(",", ":")))
+                                     for term, positions in callIndex["Terms"].items()])
+        self.connection.executemany("INSERT INTO terms VALUES (?, 1) "
+                                    "ON CONFLICT (term) DO UPDATE SET callCount = callCount + 1",
+                                    [(term,) for term in callIndex["Terms"]])
+
+    def addCalls(self, calls):
+        """
+        Adds or replaces a batch of calls in one transaction, where each is a (sourceKey, version, callIndex)
+        """
+        with self.connection:
+            for sourceKey, version, callIndex in calls:
+                self.insertCall(sourceKey, version, callIndex)
+
+    def removeCalls(self, sourceKeys):
+        """
+        Removes a batch of calls in one transaction
+        """
+        with self.connection:
+            for sourceKey in sourceKeys:
+                self.deleteCall(sourceKey)
+
+    def merge(self, otherPath):
+        """
+        Merges another corpus index into this one, such as one built separately over a different set of calls.
+        Calls in both are replaced by the other index's version
+        """
+        other = CorpusIndex(otherPath)
+        try:
+            for callId, sourceKey, callKey, version in other.connection.execute("SELECT * FROM calls").fetchall():
+                terms = {term: json.loads(positions) for term, positions in other.connection.execute(
+                    "SELECT term, positions FROM postings WHERE callId = ?", (callId,)).fetchall()}
+                self.addCalls([(sourceKey, version, {"ParsedResults": callKey, "Terms": terms})])
+        finally:
+            other.close()
+
+    def readPostings(self, term, callIds=None):
+        """
+        Returns the positions of a term in each call that has it, optionally only looking in the given calls
+        """
+        if callIds is None:
+            rows = self.connection.execute("SELECT callId, positions FROM postings WHERE term = ?",
+                                           (term,)).fetchall()
+        else:
+            rows = []
+            callIds = sorted(callIds)
+            for offset in range(0, len(callIds), QUERY_BATCH_CALLS):
+                batch = callIds[offset:offset + QUERY_BATCH_CALLS]
+                rows += self.connection.execute("SELECT callId, positions FROM postings WHERE term = ? AND "
+                                                "callId IN ({})".format(",".join(["?"] * len(batch))),
+                                                [term] + batch).fetchall()
+        return {callId: decodePositions(json.loads(positions)) for callId, positions in rows}
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """
+        Finds the calls that contain the phrase, returning a list of (callKey, positions) for up to limit calls,
+        with the calls that say it most often first
+        """
+        phrase = tokenise(text)
+        if phrase == []:
+            return []
+        counts = dict(self.connection.execute("SELECT term, callCount FROM terms WHERE term IN ({})".format(
+            ",".join(["?"] * len(set(phrase)))), sorted(set(phrase))).fetchall())
+        if len(counts) < len(set(phrase)):
+            return []
+
+        # Narrow down the candidate calls, starting with the rarest term
+        postings = {}
+        candidates = None
+        for term in sorted(set(phrase), key=lambda term: counts[term]):
+            postings[term] = self.readPostings(term, candidates)
+            candidates = set(postings[term])
+            if candidates == set():
+                return []
+
+        matches = []
+        for callId in candidates:
+            positions = findPhrase([postings[term][callId] for term in phrase])
+            if positions != []:
+                matches.append((callId, positions))
+        matches = sorted(matches, key=lambda match: (-len(match[1]), match[0]))[:limit]
+
+        callKeys = {}
+        for offset in range(0, len(matches), QUERY_BATCH_CALLS):
+            batch = [callId for callId, positions in matches[offset:offset + QUERY_BATCH_CALLS]]
+            callKeys.update(self.connection.execute("SELECT callId, callKey FROM calls WHERE callId IN ({})".format(
+                ",".join(["?"] * len(batch))), batch).fetchall())
+        return [(callKeys[callId], positions) for callId, positions in matches]
+
+
+def listCallIndexes(s3Client, bucket, indexPrefix):
+    """
+    Returns the ETag of every per-call index below the prefix, keyed by object key
+    """
+    versions = {}
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=indexPrefix + "/"):
+        versions.update({entry["Key"]: entry["ETag"] for entry in page.get("Contents", [])
+                         if not entry["Key"].endswith("/")})
+    return versions
+
+
+def updateCorpusIndex(s3Client, bucket, indexPrefix, corpus, mapFunction):
+    """
+    Brings the corpus index up to date with the per-call indexes in S3, fetching only those that are new or
+    have changed since they were added, and removing calls whose index has gone.  The fetches are run through
+    mapFunction, which maps a function over a list and returns None for any item that failed
+    """
+    latest = listCallIndexes(s3Client, bucket, indexPrefix)
+    current = corpus.readVersions()
+    changed = sorted([key for key, version in latest.items() if current.get(key) != version])
+    removed = sorted([key for key in current if key not in latest])
+    print("Corpus index has {} calls - {} to add or update and {} to remove".format(len(current), len(changed),
+                                                                                     len(removed)))
+    corpus.removeCalls(removed)
+
+    def fetchCallIndex(key):
+        response = s3Client.get_object(Bucket=bucket, Key=key)
+        return key, response["ETag"], json.loads(response["Body"].read())
+
+    for offset in range(0, len(changed), CORPUS_BATCH_CALLS):
+        calls = mapFunction(fetchCallIndex, changed[offset:offset + CORPUS_BATCH_CALLS])
+        corpus.addCalls([call for call in calls if call is not None])
@@ -0,0 +1,296 @@
+"""
+Load shedding for the optional enrichment stages of the turn-by-turn parser - the MP3 playback file, standard and
+custom entity detection and simple entity matching - so that transcripts and their sentiment keep flowing at full
+speed during a peak or an incident.  The tier comes from the depth of the Transcribe backlog, which is counted
+every few seconds and shared by every call, and each higher tier sheds more stages.  Comprehend and the custom entity endpoint also have circuit breakers, held in the workflow
+tracking table, which shed their stage for every call once it has failed too often.  A shed stage is recorded in
+a backfill marker in S3, and the backfill worker enriches the stored results once there is capacity again
+"""
+
+from datetime import datetime
+import threading
+import json
+import time
+
+# The optional stages, and the stages that are shed at each tier - tier 0 runs everything
+STAGE_PLAYBACK = "playback"
+STAGE_STANDARD_ENTITIES = "standardEntities"
+STAGE_CUSTOM_ENTITIES = "customEntities"
+STAGE_SIMPLE_ENTITIES = "simpleEntities"
+STAGES = [STAGE_PLAYBACK, STAGE_STANDARD_ENTITIES, STAGE_CUSTOM_ENTITIES, STAGE_SIMPLE_ENTITIES]
+TIER_STAGES = [[],
+               [STAGE_PLAYBACK],
+               [STAGE_PLAYBACK, STAGE_CUSTOM_ENTITIES, STAGE_SIMPLE_ENTITIES],
+               [STAGE_PLAYBACK, STAGE_CUSTOM_ENTITIES, STAGE_SIMPLE_ENTITIES, STAGE_STANDARD_ENTITIES]]
+
+# Circuit breakers and the stages that they shed when open
+BREAKER_COMPREHEND = "comprehend"
+BREAKER_CUSTOM_ENDPOINT = "customEndpoint"
+BREAKER_STAGES = {BREAKER_COMPREHEND: [STAGE_STANDARD_ENTITIES], BREAKER_CUSTOM_ENDPOINT: [STAGE_CUSTOM_ENTITIES]}
+
+# A breaker opens after this many failures within the window, and stays open for a while before letting calls
+# through again - the first failure after that opens it again straight away
+BREAKER_FAILURE_LIMIT = 5
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_OPEN_SECONDS = 300
+
+# Tracking table key prefix of the breaker items
+BREAKER_KEY_PREFIX = "breaker#"
+
+# Tracking table item that shares the last count of the Transcribe backlog, and how long that count is used for
+# before someone counts again
+BACKLOG_KEY = "backlog#transcribe"
+BACKLOG_CACHE_SECONDS = 45
+
+# The last count of the backlog when there's no tracking table to share it through, as (time, backlog)
+localBacklog = {}
+localBacklogLock = threading.Lock()
+
+
+def calculateTier(backlog, thresholds):
+    """
+    Returns the tier for the backlog, which is the number of tier thresholds that it has reached
+    """
+    return min(len(TIER_STAGES) - 1, len([threshold for threshold in thresholds if backlog >= threshold]))
+
+
+def countTranscribeBacklog(transcribeClient, limit, lastBacklog=None):
+    """
+    Counts the IN_PROGRESS and QUEUED Transcribe jobs, stopping once we reach the limit as more doesn't change
+    anything.  If Transcribe throttles us then we carry on with the last count if we have one, otherwise we're
+    clearly busy, so we say the backlog is at the limit
+    """
+    try:
+        found = 0
+        for status in ["IN_PROGRESS", "QUEUED"]:
+            response = transcribeClient.list_transcription_jobs(Status=status, MaxResults=100)
+            found += len(response["TranscriptionJobSummaries"])
+            while ("NextToken" in response) and (found < limit):
+                response = transcribeClient.list_transcription_jobs(Status=status, MaxResults=100,
+                                                                    NextToken=response["NextToken"])
+                found += len(response["TranscriptionJobSummaries"])
+        return min(found, limit)
+    except Exception as e:
+        if lastBacklog is not None:
+            print("Unable to count the Transcribe backlog, keeping the last count ({})".format(str(e)))
+            return min(lastBacklog, limit)
+        print("Unable to count the Transcribe backlog, assuming that it's full ({})".format(str(e)))
+        return limit
+
+
+def readTranscribeBacklog(transcribeClient, limit, ddbClient=None, table=""):
+    """
+    Returns the depth of the Transcribe backlog, which is only counted once every BACKLOG_CACHE_SECONDS however
+    many calls want it.  The count is shared through the tracking table if we have one: once it's due to be
+    counted again the first caller to claim the refresh does the counting, and everyone else carries on with the
+    last count in the meantime.  Without a tracking table the count is only shared within this process
+    """
+    now = time.time()
+    if table == "":
+        with localBacklogLock:
+            if ("time" in localBacklog) and (now - localBacklog["time"] < BACKLOG_CACHE_SECONDS):
+                return min(localBacklog["backlog"], limit)
+            localBacklog["backlog"] = countTranscribeBacklog(transcribeClient, limit, localBacklog.get("backlog"))
+            localBacklog["time"] = now
+            return localBacklog["backlog"]
+
+    key = {"PKJobId": {"S": BACKLOG_KEY}}
+    item = ddbClient.get_item(Key=key, TableName=table).get("Item", {})
+    lastBacklog = int(item["Backlog"]["N"]) if "Backlog" in item else None
+    if ("CountedAt" in item) and (now - float(item["CountedAt"]["N"]) < BACKLOG_CACHE_SECONDS) and \
+            (lastBacklog is not None):
+        return min(lastBacklog, limit)
+
+    # Claim the refresh, so that only one of us goes to Transcribe - the claim counts as the count until the
+    # new count is written, and if someone else already has it then we use the last count
+    try:
+        ddbClient.update_item(Key=key, TableName=table, UpdateExpression="SET CountedAt = :now",
+                              ConditionExpression="attribute_not_exists(CountedAt) OR CountedAt < :stale",
+                              ExpressionAttributeValues={":now": {"N": str(now)},
+                                                         ":stale": {"N": str(now - BACKLOG_CACHE_SECONDS)}})
+    except ddbClient.exceptions.ConditionalCheckFailedException:
+        if lastBacklog is not None:
+            return min(lastBacklog, limit)
+
+    backlog = countTranscribeBacklog(transcribeClient, limit, lastBacklog)
+    ddbClient.update_item(Key=key, TableName=table, UpdateExpression="SET Backlog = :backlog",
+                          ExpressionAttributeValues={":backlog": {"N": str(backlog)}})
+    return backlog
+
+
+class DynamoBreakerStore:
+    """
+    Circuit breaker state held in the workflow tracking table, with one item per breaker holding its failure
+    count, when its current failure window started and, once it has opened, when it can let calls through again
+    """
+    def __init__(self, ddbClient, table):
+        self.ddbClient = ddbClient
+        self.table = table
+
+    def read(self, breaker):
+        response = self.ddbClient.get_item(Key={"PKJobId": {"S": BREAKER_KEY_PREFIX + breaker}},
+                                           TableName=self.table)
+        item = response.get("Item", {})
+        return {name: float(item[name]["N"]) for name in ["Failures", "WindowStart", "OpenUntil"] if name in item}
+
+    def recordFailure(self, breaker, now):
+        """
+        Counts a failure in the breaker's current window, or starts a new window, and returns the new state
+        """
+        key = {"PKJobId": {"S": BREAKER_KEY_PREFIX + breaker}}
+        try:
+            response = self.ddbClient.update_item(Key=key, TableName=self.table,
+                                                  UpdateExpression="ADD Failures :one",
+                                                  ConditionExpression="WindowStart >= :windowStart",
+                                                  ExpressionAttributeValues={
+                                                      ":one": {"N": "1"},
+                                                      ":windowStart": {"N": str(now - BREAKER_WINDOW_SECONDS)}},
+                                                  ReturnValues="ALL_NEW")
+        except self.ddbClient.exceptions.ConditionalCheckFailedException:
+            response = self.ddbClient.update_item(Key=key, TableName=self.table,
+                                                  UpdateExpression="SET Failures = :one, WindowStart = :now",
+                                                  ExpressionAttributeValues={":one": {"N": "1"},
+                                                                             ":now": {"N": str(now)}},
+                                                  ReturnValues="ALL_NEW")
+        item = response["Attributes"]
+        return {name: float(item[name]["N"]) for name in ["Failures", "WindowStart", "OpenUntil"] if name in item}
+
+    def open(self, breaker, now):
+        self.ddbClient.update_item(Key={"PKJobId": {"S": BREAKER_KEY_PREFIX + breaker}}, TableName=self.table,
+                                   UpdateExpression="SET OpenUntil = :openUntil, Failures = :zero",
+                                   ExpressionAttributeValues={":openUntil": {"N": str(now + BREAKER_OPEN_SECONDS)},
+                                                              ":zero": {"N": "0"}})
+
+    def close(self, breaker):
+        self.ddbClient.delete_item(Key={"PKJobId": {"S": BREAKER_KEY_PREFIX + breaker}}, TableName=self.table)
+
+
+class LocalBreakerStore:
+    """
+    Local stand-in for the DynamoDB breaker store, holding the same state in memory for this process
+    """
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def read(self, breaker):
+        with self.lock:
+            return dict(self.breakers.get(breaker, {}))
+
+    def recordFailure(self, breaker, now):
+        with self.lock:
+            state = self.breakers.setdefault(breaker, {})
+            if state.get("WindowStart", 0.0) >= now - BREAKER_WINDOW_SECONDS:
+                state["Failures"] = state.get("Failures", 0.0) + 1
+            else:
+                state.update({"Failures": 1.0, "WindowStart": now})
+            return dict(state)
+
+    def open(self, breaker, now):
+        with self.lock:
+            self.breakers.setdefault(breaker, {}).update({"OpenUntil": now + BREAKER_OPEN_SECONDS, "Failures": 0.0})
+
+    def close(self, breaker):
+        with self.lock:
+            self.breakers.pop(breaker, None)
+
+
+def createBreakerStore(ddbClient=None, table=""):
+    """
+    Returns the DynamoDB store if we have a tracking table, otherwise the in-memory stand-in
+    """
+    if table != "":
+        return DynamoBreakerStore(ddbClient, table)
+    else:
+        return LocalBreakerStore()
+
+
+class LoadShedder:
+    """
+    Decides which optional stages are shed for a call, from the tier and the state of the circuit breakers when
+    the call started.  Any other stages to shed, such as those that a backfill isn't doing, can also be given
+    """
+    def __init__(self, breakerStore, tier=0, extraStages=()):
+        self.breakerStore = breakerStore
+        self.tier = tier
+        self.now = time.time()
+        self.breakers = {breaker: breakerStore.read(breaker) for breaker in BREAKER_STAGES}
+        self.shedStages = set(TIER_STAGES[tier]) | set(extraStages)
+        for breaker in self.openBreakers():
+            self.shedStages.update(BREAKER_STAGES[breaker])
+        if self.shedStages != set(extraStages):
+            print("Load shedding at tier {} with open breakers {} - shedding {}".format(
+                tier, self.openBreakers(), sorted(self.shedStages - set(extraStages))))
+
+    def openBreakers(self):
+        return sorted([breaker for breaker, state in self.breakers.items() if state.get("OpenUntil", 0.0) > self.now])
+
+    def hasCapacity(self):
+        """
+        Returns True if nothing is being shed because of load, so there's capacity for backfilling
+        """
+        return (self.tier == 0) and (self.openBreakers() == [])
+
+    def isShed(self, stage):
+        return stage in self.shedStages
+
+    def recordSuccess(self, breaker):
+        """
+        Closes a breaker that was letting calls through again after being open, now that one has succeeded
+        """
+        if "OpenUntil" in self.breakers[breaker]:
+            self.breakerStore.close(breaker)
+            self.breakers[breaker] = {}
+
+    def recordFailure(self, breaker):
+        """
+        Records a failure of the breaker's service, opening the breaker if it has now failed too often, and sheds
+        its stages for the rest of this call either way
+        """
+        now = time.time()
+        state = self.breakerStore.recordFailure(breaker, now)
+        if ("OpenUntil" in self.breakers[breaker]) or (state["Failures"] >= BREAKER_FAILURE_LIMIT):
+            print("Opening the {} circuit breaker".format(breaker))
+            self.breakerStore.open(breaker, now)
+        self.shedStages.update(BREAKER_STAGES[breaker])
+
+
+def generateMarkerKey(backfillPrefix, resultsKey):
+    """
+    Returns the key of the backfill marker for a parsed results file
+    """
+    return backfillPrefix + "/" + resultsKey.split("/")[-1] + ".json"
+
+
+def writeBackfillMarker(s3Client, bucket, backfillPrefix, resultsKey, stages):
+    """
+    Records the stages that the call's results are missing, adding to any that an earlier run deferred
+    """
+    markerKey = generateMarkerKey(backfillPrefix, resultsKey)
+    marker = readBackfillMarker(s3Client, bucket, markerKey)
+    if marker is not None:
+        stages = set(stages) | set(marker["Stages"])
+    marker = {"ResultsKey": resultsKey, "Stages": sorted(stages), "DeferredAt": str(datetime.now())}
+    s3Client.put_object(Bucket=bucket, Key=markerKey, Body=json.dumps(marker).encode("utf-8"),
+                        ContentType="application/json")
+
+
+def readBackfillMarker(s3Client, bucket, markerKey):
+    """
+    Returns a backfill marker, or None if there isn't one
+    """
+    try:
+        return json.loads(s3Client.get_object(Bucket=bucket, Key=markerKey)["Body"].read())
+    except s3Client.exceptions.NoSuchKey:
+        return None
+
+
+def listBackfillMarkers(s3Client, bucket, backfillPrefix):
+    """
+    Returns the keys of every backfill marker, oldest first
+    """
+    entries = []
+    paginator = s3Client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=backfillPrefix + "/"):
+        entries += [entry for entry in page.get("Contents", []) if entry["Key"].endswith(".json")]
+    return [entry["Key"] for entry in sorted(entries, key=lambda entry: entry["LastModified"])]
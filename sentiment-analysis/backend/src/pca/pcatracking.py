@@ -0,0 +1,197 @@
+"""
+Rendezvous between a Step Function that is waiting for a Transcribe job and the EventBridge notification that
+says the job has finished.  Either side can arrive first: each one records itself in the tracking table with a
+conditional write that only succeeds if the other side isn't already there, and whichever side's write fails is
+the one that arrived second, so it claims the other side's record and completes the handoff.  Nobody ever waits
+"""
+
+import threading
+import json
+import time
+import re
+import pcalanes
+
+# Total number of retry attempts to make for Transcribe internal failures
+RETRY_LIMIT = 2
+
+# Records that are never claimed, such as notifications for jobs that nobody waits for, expire after this long
+TRACKING_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# How many times we go round if the record that we lost to disappears before we can claim it
+RENDEZVOUS_ATTEMPTS = 3
+
+
+class LocalTrackingTable:
+    """
+    In-memory stand-in for the DynamoDB tracking table, supporting just the calls and the attribute_exists and
+    attribute_not_exists conditions that the rendezvous uses, so that both sides can be exercised locally
+    """
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def checkCondition(self, item, condition):
+        if condition is None:
+            return
+        match = re.fullmatch(r"attribute_(not_)?exists\((\w+)\)", condition.strip())
+        exists = (item is not None) and (match.group(2) in item)
+        if exists == bool(match.group(1)):
+            raise self.exceptions.ConditionalCheckFailedException(condition)
+
+    def put_item(self, Item, TableName, ConditionExpression=None):
+        with self.lock:
+            self.checkCondition(self.items.get(Item["PKJobId"]["S"]), ConditionExpression)
+            self.items[Item["PKJobId"]["S"]] = dict(Item)
+        return {}
+
+    def get_item(self, Key, TableName, ConsistentRead=False):
+        with self.lock:
+            item = self.items.get(Key["PKJobId"]["S"])
+        return {} if item is None else {"Item": dict(item)}
+
+    def delete_item(self, Key, TableName, ConditionExpression=None, ReturnValues="NONE"):
+        with self.lock:
+            item = self.items.get(Key["PKJobId"]["S"])
+            self.checkCondition(item, ConditionExpression)
+            self.items.pop(Key["PKJobId"]["S"], None)
+        return {"Attributes": dict(item)} if (ReturnValues == "ALL_OLD") and (item is not None) else {}
+
+    def update_item(self, **kwargs):
+        # Only used by the lane counters, which the local stand-in doesn't track
+        return {}
+
+
+def generateExpiryTime():
+    """
+    Returns the DynamoDB TTL value for a new tracking record
+    """
+    return {'N': str(int(time.time()) + TRACKING_TTL_SECONDS)}
+
+
+def claimRecord(ddbClient, table, jobName, requiredAttribute):
+    """
+    Atomically removes and returns the tracking record for this job, but only if it was written by the other side
+    of the rendezvous.  Returns None if someone else claimed it first
+    """
+    try:
+        response = ddbClient.delete_item(Key={'PKJobId': {'S': jobName}}, TableName=table,
+                                         ConditionExpression="attribute_exists(" + requiredAttribute + ")",
+                                         ReturnValues="ALL_OLD")
+        return response.get("Attributes")
+    except ddbClient.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def registerTaskToken(ddbClient, table, jobName, taskToken, taskState):
+    """
+    Called by the waiting side.  Records our task token unless the job's completion has already been recorded,
+    in which case that completion is claimed and returned as (jobStatus, jobDescriptor) for us to hand off;
+    otherwise None is returned and the notification side will do the handoff when the job finishes
+    """
+    for attempt in range(RENDEZVOUS_ATTEMPTS):
+        try:
+            ddbClient.put_item(Item={
+                                 'PKJobId': {'S': jobName},
+                                 'taskToken': {'S': taskToken},
+                                 'taskState': {'S': json.dumps(taskState)},
+                                 'expiresAt': generateExpiryTime()
+                               },
+                               TableName=table,
+                               ConditionExpression="attribute_not_exists(jobStatus)")
+            return None
+        except ddbClient.exceptions.ConditionalCheckFailedException:
+            # The job got there first - take its completion record
+            completion = claimRecord(ddbClient, table, jobName, "jobStatus")
+            if completion is not None:
+                return completion["jobStatus"]['S'], json.loads(completion["jobInfo"]['S'])
+
+    raise Exception('Unable to register the task token for Transcribe job \'{}\'.'.format(jobName))
+
+
+def registerJobCompletion(ddbClient, table, jobName, jobStatus, jobDescriptor):
+    """
+    Called by the notification side.  Records the job's completion unless a task token is already waiting for
+    it, in which case that token is claimed and returned as (taskToken, taskState) for us to hand off; otherwise
+    None is returned and the waiting side will do the handoff when it registers its token
+    """
+    for attempt in range(RENDEZVOUS_ATTEMPTS):
+        try:
+            ddbClient.put_item(Item={
+                                 'PKJobId': {'S': jobName},
+                                 'jobStatus': {'S': jobStatus},
+                                 'jobInfo': {'S': json.dumps(jobDescriptor)},
+                                 'expiresAt': generateExpiryTime()
+                               },
+                               TableName=table,
+                               ConditionExpression="attribute_not_exists(taskToken)")
+            return None
+        except ddbClient.exceptions.ConditionalCheckFailedException:
+            # The Step Function is already waiting - take its token
+            waiting = claimRecord(ddbClient, table, jobName, "taskToken")
+            if waiting is not None:
+                return waiting["taskToken"]['S'], json.loads(waiting["taskState"]['S'])
+
+    raise Exception('Unable to register the completion of Transcribe job \'{}\'.'.format(jobName))
+
+
+def recordJobOutcome(eventStatus, jobStatus, jobDescriptor):
+    """
+    Records how the job ended in the workflow state, carrying the job details forward, and if the job FAILED
+    due to a Transcribe internal failure then we ask for a retry, but only a limited number of times
+    """
+    eventStatus["transcribeJobInfo"] = jobDescriptor
+
+    # If the job has FAILED then we need to check if it's a service failure,
+    # as this can happen, then we want to re-try the job another time
+    finalResponse = jobStatus
+    if jobStatus == "FAILED":
+        errorMesg = jobDescriptor.get("FailureReason", "")
+        if errorMesg.startswith("Internal"):
+            # Internal failure - we want to retry a few times, but only once
+            retryCount = eventStatus.pop("retryCount", 0)
+
+            # Not retried enough yet - let's try another time
+            if (retryCount < RETRY_LIMIT):
+                eventStatus["retryCount"] = retryCount + 1
+                finalResponse = "RETRY"
+
+    eventStatus["transcribeStatus"] = finalResponse
+    return eventStatus
+
+
+def completeHandoff(ddbClient, table, sfnClient, taskToken, taskState, jobStatus, jobDescriptor):
+    """
+    Hands the job's result back to the waiting Step Function, giving back any Transcribe lane slot
+    """
+    eventStatus = taskState
+    pcalanes.releaseAdmittedSlot(ddbClient, table, eventStatus)
+
+    # All complete - continue our workflow with this status/retry count
+    recordJobOutcome(eventStatus, jobStatus, jobDescriptor)
+    sfnClient.send_task_success(taskToken=taskToken, output=json.dumps(eventStatus))
+    return eventStatus
+
+
+# Main entrypoint for testing - runs both arrival orders against the local stand-in
+if __name__ == "__main__":
+    class LocalStepFunctions:
+        def send_task_success(self, taskToken, output):
+            print("Task {} completed with {}".format(taskToken, output))
+
+    table = LocalTrackingTable()
+    descriptor = {"TranscriptionJobName": "call.wav", "TranscriptionJobStatus": "COMPLETED"}
+
+    # Step Function first, then the notification
+    assert registerTaskToken(table, "", "call.wav", "token-1", {"jobName": "call.wav"}) is None
+    taskToken, taskState = registerJobCompletion(table, "", "call.wav", "COMPLETED", descriptor)
+    completeHandoff(table, "", LocalStepFunctions(), taskToken, taskState, "COMPLETED", descriptor)
+
+    # Notification first, then the Step Function
+    assert registerJobCompletion(table, "", "call.wav", "COMPLETED", descriptor) is None
+    jobStatus, jobDescriptor = registerTaskToken(table, "", "call.wav", "token-2", {"jobName": "call.wav"})
+    completeHandoff(table, "", LocalStepFunctions(), "token-2", {"jobName": "call.wav"}, jobStatus, jobDescriptor)
+    assert table.items == {}
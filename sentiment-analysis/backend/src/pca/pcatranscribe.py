@@ -0,0 +1,188 @@
+"""
+Helpers for submitting Amazon Transcribe jobs at the maximum sustainable rate.  Every submission gets a unique,
+versioned job name, so there is never an existing job that has to be checked for and deleted first; vocabulary
+readiness is cached for the lifetime of the container, and job starts go through a client-side token bucket
+with exponential backoff whenever Transcribe tells us that we are going too fast.  The token bucket only paces
+the calls made from one container - Lambdas running side by side each have their own, so across them it's the
+backoff that keeps us within Transcribe's limits
+"""
+
+from datetime import datetime
+import threading
+import random
+import time
+import re
+
+# Client-side limits for StartTranscriptionJob - the burst allows a handful of jobs to go at once
+START_JOB_RATE = 5.0
+START_JOB_BURST = 10
+
+# Backoff settings for throttled calls
+THROTTLE_RETRIES = 6
+THROTTLE_BASE_DELAY = 0.5
+THROTTLE_MAX_DELAY = 20.0
+THROTTLE_ERROR_CODES = ["LimitExceededException", "ThrottlingException", "TooManyRequestsException"]
+
+# How long we trust a cached vocabulary state
+VOCAB_CACHE_SECONDS = 300
+
+# Fields of a Transcribe job that the workflow carries around with it once the job has finished
+JOB_DESCRIPTOR_FIELDS = ["TranscriptionJobName", "TranscriptionJobStatus", "FailureReason", "LanguageCode",
+                         "MediaFormat", "MediaSampleRateHertz", "Media", "Transcript", "Settings",
+                         "ContentRedaction", "IdentifyLanguage", "IdentifiedLanguageScore", "CompletionTime"]
+
+# Versioned job names are {base}-v{timestamp}, and Transcribe limits the name to 200 characters
+JOB_VERSION_SEPARATOR = "-v"
+JOB_VERSION_REGEX = re.compile(r"-v\d{20}(?=(\.json)?$)")
+JOB_NAME_MAX_LENGTH = 200
+
+
+class TokenBucket:
+    """ Simple thread-safe token bucket, refilling at a fixed rate up to a maximum burst size """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.lastRefill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, sleeping until one becomes available if the bucket is empty
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastRefill) * self.rate)
+                self.lastRefill = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                waitTime = (1.0 - self.tokens) / self.rate
+            time.sleep(waitTime)
+
+
+# Shared by every submission made from this container, but not with any other container
+submissionBucket = TokenBucket(START_JOB_RATE, START_JOB_BURST)
+vocabularyCache = {}
+
+
+def generateVersionedJobName(baseJobName):
+    """
+    Appends a timestamp version to the job name, which makes it unique for every submission
+    """
+    version = JOB_VERSION_SEPARATOR + datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    return baseJobName[:JOB_NAME_MAX_LENGTH - len(version)] + version
+
+
+def removeJobNameVersion(name):
+    """
+    Removes any version from a job name or from a job's output filename, which gives the stable name that the
+    parsed results are written under no matter how many times the file has been transcribed
+    """
+    return JOB_VERSION_REGEX.sub("", name)
+
+
+def isJobActive(transcribeClient, baseJobName):
+    """
+    Returns True if any version of the job, or any of the chunk jobs of a version, is still QUEUED or IN_PROGRESS
+    in Transcribe.  The names are matched on their un-versioned form, just as the parsed results are
+    """
+    versionedBase = removeJobNameVersion(generateVersionedJobName(baseJobName))
+    chunkPrefix = baseJobName[:JOB_NAME_MAX_LENGTH // 2] + "-chunk"
+    for status in ["QUEUED", "IN_PROGRESS"]:
+        kwargs = {"Status": status, "JobNameContains": baseJobName[:JOB_NAME_MAX_LENGTH // 2], "MaxResults": 100}
+        while True:
+            response = callWithBackoff(transcribeClient.list_transcription_jobs, **kwargs)
+            for job in response["TranscriptionJobSummaries"]:
+                jobName = job["TranscriptionJobName"]
+                if (removeJobNameVersion(jobName) == versionedBase) or jobName.startswith(chunkPrefix):
+                    return True
+            if "NextToken" not in response:
+                break
+            kwargs["NextToken"] = response["NextToken"]
+
+    return False
+
+
+def isThrottlingError(error):
+    """
+    Returns True if the given botocore exception means that we've been throttled
+    """
+    try:
+        return error.response["Error"]["Code"] in THROTTLE_ERROR_CODES
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+def callWithBackoff(apiCall, **kwargs):
+    """
+    Makes a Transcribe API call via the token bucket, retrying with exponential backoff and full jitter if we get
+    throttled.  Any other error, or running out of retries, raises the exception to the caller
+    """
+    attempt = 0
+    while True:
+        submissionBucket.acquire()
+        try:
+            return apiCall(**kwargs)
+        except Exception as e:
+            if (not isThrottlingError(e)) or (attempt >= THROTTLE_RETRIES):
+                raise e
+            delay = min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+
+def isVocabularyReady(transcribeClient, vocabName):
+    """
+    Returns True if the named custom vocabulary exists and is READY, caching the answer for a few minutes so
+    that a burst of job submissions only makes a single lookup
+    """
+    cached = vocabularyCache.get(vocabName)
+    if (cached is not None) and (cached[1] > time.monotonic()):
+        return cached[0]
+
+    try:
+        vocabState = callWithBackoff(transcribeClient.get_vocabulary, VocabularyName=vocabName)["VocabularyState"]
+        isReady = (vocabState == "READY")
+    except Exception as e:
+        # Doesn't exist - don't use it
+        isReady = False
+
+    vocabularyCache[vocabName] = (isReady, time.monotonic() + VOCAB_CACHE_SECONDS)
+    return isReady
+
+
+def startTranscriptionJob(transcribeClient, **kwargs):
+    """
+    Starts a Transcribe job at a rate that Transcribe will accept, removing any 'None' values on the way
+    """
+    return callWithBackoff(transcribeClient.start_transcription_job,
+                           **{k: v for k, v in kwargs.items() if v is not None})
+
+
+def createJobDescriptor(transcriptionJob):
+    """
+    Takes the TranscriptionJob block from get_transcription_job and keeps just the fields that the later stages
+    of the workflow need, in a form that can be passed around in the Step Functions state
+    """
+    descriptor = {}
+    for field in JOB_DESCRIPTOR_FIELDS:
+        if field in transcriptionJob:
+            descriptor[field] = transcriptionJob[field]
+    if "CompletionTime" in descriptor:
+        descriptor["CompletionTime"] = str(descriptor["CompletionTime"])
+
+    return descriptor
+
+
+def getJobDescriptor(sfData, jobName):
+    """
+    Returns the job descriptor carried in the workflow state if it is for the given job, or None if it isn't
+    there or if it describes a different job, such as an earlier language detection or retried job
+    """
+    descriptor = sfData.get("transcribeJobInfo")
+    if (descriptor is not None) and (descriptor.get("TranscriptionJobName") == jobName):
+        return descriptor
+    else:
+        return None
@@ -0,0 +1,212 @@
+"""
+Long-running worker that takes Transcribe job names from a queue and processes several of them at once across a
+pool of processes, for bulk work where one call per Lambda invocation is far too slow.  Each process keeps its
+configuration, clients and lookups warm between calls.  The queue is SQS, or a local file of job names as the
+stand-in.  SIGTERM or Ctrl-C stops it taking new jobs and lets the ones in flight finish, and it reports its
+health - throughput, failures and how long calls take - both in the log and, optionally, in a JSON file that a
+container health check can read
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+import signal
+import json
+import time
+import os
+
+# Default number of processes, and how many jobs we hold per process so that none of them sit idle
+WORKER_PROCESSES = os.cpu_count() or 2
+JOBS_PER_PROCESS = 2
+
+# How long we wait for jobs on each poll of the queue, and how often we report our health
+QUEUE_WAIT_SECONDS = 10
+HEALTH_INTERVAL_SECONDS = 60
+
+# SQS visibility timeout that we keep extending for the jobs in flight, so that no other worker picks them up
+VISIBILITY_TIMEOUT_SECONDS = 900
+
+
+def readJobName(body):
+    """
+    Returns the job name from a queue message, which is either just the name or the JSON workflow state
+    """
+    try:
+        return json.loads(body)["jobName"]
+    except (ValueError, TypeError, KeyError):
+        return body.strip()
+
+
+class SQSJobQueue:
+    """
+    Jobs from an SQS queue, where a message is only deleted once its job has been processed - a failed job
+    goes back on the queue when its visibility timeout expires, so the queue's redrive policy decides how
+    often it's retried
+    """
+    def __init__(self, sqsClient, queueUrl):
+        self.sqsClient = sqsClient
+        self.queueUrl = queueUrl
+
+    def receive(self, count):
+        response = self.sqsClient.receive_message(QueueUrl=self.queueUrl, MaxNumberOfMessages=min(count, 10),
+                                                  WaitTimeSeconds=QUEUE_WAIT_SECONDS,
+                                                  VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS)
+        return [(message["ReceiptHandle"], readJobName(message["Body"])) for message in response.get("Messages", [])]
+
+    def complete(self, handle):
+        self.sqsClient.delete_message(QueueUrl=self.queueUrl, ReceiptHandle=handle)
+
+    def fail(self, handle):
+        pass
+
+    def keepAlive(self, handles):
+        for offset in range(0, len(handles), 10):
+            self.sqsClient.change_message_visibility_batch(QueueUrl=self.queueUrl, Entries=[
+                {"Id": str(index), "ReceiptHandle": handle, "VisibilityTimeout": VISIBILITY_TIMEOUT_SECONDS}
+                for index, handle in enumerate(handles[offset:offset + 10])])
+
+
+class LocalFileJobQueue:
+    """
+    Local stand-in for the SQS queue - a file with one job name per line.  Finished and failed jobs are appended
+    to ".done" and ".failed" files alongside it, and a restarted worker skips any job that's already done
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.donePath = Path(str(path) + ".done")
+        self.failedPath = Path(str(path) + ".failed")
+        done = set(self.donePath.read_text().split()) if self.donePath.exists() else set()
+        self.pending = [name for name in self.path.read_text().split() if name not in done]
+
+    def receive(self, count):
+        jobs = [(name, name) for name in self.pending[:count]]
+        self.pending = self.pending[count:]
+        return jobs
+
+    def complete(self, handle):
+        with open(self.donePath, "a") as doneFile:
+            doneFile.write(handle + "\n")
+
+    def fail(self, handle):
+        with open(self.failedPath, "a") as failedFile:
+            failedFile.write(handle + "\n")
+
+    def keepAlive(self, handles):
+        pass
+
+
+class HealthMetrics:
+    """
+    Counts of what the worker has done, reported as throughput and timings
+    """
+    def __init__(self, healthPath=None):
+        self.healthPath = healthPath
+        self.startTime = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.inFlight = 0
+        self.totalSeconds = 0.0
+        self.lastActivity = self.startTime
+        self.state = "RUNNING"
+
+    def record(self, succeeded, seconds):
+        if succeeded:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.totalSeconds += seconds
+        self.lastActivity = time.time()
+
+    def report(self):
+        """
+        Prints our health, and writes it to the health file if we have one
+        """
+        elapsed = max(time.time() - self.startTime, 1.0)
+        finished = self.completed + self.failed
+        health = {"State": self.state, "Completed": self.completed, "Failed": self.failed,
+                  "InFlight": self.inFlight, "CallsPerHour": round(finished * 3600 / elapsed, 1),
+                  "AverageCallSeconds": round(self.totalSeconds / max(finished, 1), 2),
+                  "UptimeSeconds": round(elapsed), "LastActivity": round(self.lastActivity)}
+        print("Worker health: {}".format(json.dumps(health)))
+        if self.healthPath is not None:
+            workPath = Path(str(self.healthPath) + ".tmp")
+            workPath.write_text(json.dumps(health))
+            os.replace(workPath, self.healthPath)
+
+
+def initialiseProcess(initFunction):
+    """
+    Starts a pool process, which ignores the signals as only the main process decides when to stop
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if initFunction is not None:
+        initFunction()
+
+
+def timeJob(processFunction, jobName):
+    """
+    Runs one job in a pool process, returning how long it took
+    """
+    startTime = time.time()
+    processFunction(jobName)
+    return time.time() - startTime
+
+
+def runWorker(queue, processFunction, initFunction=None, processes=WORKER_PROCESSES, healthPath=None, once=False):
+    """
+    Feeds jobs from the queue to processFunction across a pool of processes until we're told to stop, or until
+    the queue is empty if once is set.  initFunction runs in each pool process as it starts, to warm it up.
+    Returns the health metrics
+    """
+    metrics = HealthMetrics(healthPath)
+    stopping = []
+
+    def requestStop(signum, frame):
+        if stopping == []:
+            print("Stopping - finishing the {} jobs in flight".format(metrics.inFlight))
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    inFlight = {}
+    lastReport = time.time()
+    with ProcessPoolExecutor(max_workers=processes, initializer=initialiseProcess,
+                             initargs=(initFunction,)) as pool:
+        while (stopping == []) or (inFlight != {}):
+            # Top up the jobs in flight, unless we're stopping
+            room = processes * JOBS_PER_PROCESS - len(inFlight)
+            if (stopping == []) and (room > 0):
+                jobs = queue.receive(room)
+                for handle, jobName in jobs:
+                    inFlight[pool.submit(timeJob, processFunction, jobName)] = (handle, jobName, time.time())
+                if (jobs == []) and (inFlight == {}):
+                    if once:
+                        break
+                    time.sleep(1)
+            metrics.inFlight = len(inFlight)
+
+            # Collect whatever has finished
+            if inFlight != {}:
+                done, notDone = wait(list(inFlight), timeout=QUEUE_WAIT_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle, jobName, submitted = inFlight.pop(future)
+                    try:
+                        metrics.record(True, future.result())
+                        queue.complete(handle)
+                    except Exception as e:
+                        print("Job {} failed ({})".format(jobName, str(e)))
+                        metrics.record(False, time.time() - submitted)
+                        queue.fail(handle)
+
+            # Keep our jobs hidden from other workers, and say how we're doing
+            if time.time() - lastReport >= HEALTH_INTERVAL_SECONDS:
+                queue.keepAlive([handle for handle, jobName, submitted in inFlight.values()])
+                metrics.inFlight = len(inFlight)
+                metrics.report()
+                lastReport = time.time()
+
+    metrics.inFlight = 0
+    metrics.state = "STOPPED"
+    metrics.report()
+    return metrics
@@ -0,0 +1,89 @@
+const zlib = require("zlib");
+
+// Scales used by the v2 encoding for word times and confidences
+const timeScale = 100;
+const confidenceScale = 10000;
+
+// Order of the fields in a v1 speech segment
+const segmentFields = [
+    "SegmentStartTime",
+    "SegmentEndTime",
+    "SegmentSpeaker",
+    "OriginalText",
+    "DisplayText",
+    "TextEdited",
+    "SentimentIsPositive",
+    "SentimentIsNegative",
+    "SentimentScore",
+    "BaseSentimentScores",
+    "EntitiesDetected",
+    "WordConfidence",
+];
+
+function decodeWords(words) {
+    let start = 0;
+
+    return words.Text.map((text, i) => {
+        start += words.Start[i];
+
+        return {
+            Text: text,
+            Confidence: words.Confidence[i] / confidenceScale,
+            StartTime: start / timeScale,
+            EndTime: (start + words.Length[i]) / timeScale,
+        };
+    });
+}
+
+function convertSegmentToV1(segment) {
+    // Segments that couldn't be encoded losslessly are stored as v1
+    if (!segment.Words) {
+        return segment;
+    }
+
+    const { Words, OriginalText, DisplayText, ...rest } = segment;
+    const originalText =
+        OriginalText !== undefined ? OriginalText : Words.Text.join("");
+
+    const decoded = {
+        ...rest,
+        OriginalText: originalText,
+        DisplayText: DisplayText !== undefined ? DisplayText : originalText,
+        WordConfidence: decodeWords(Words),
+    };
+
+    // Put the fields back into their usual order
+    const ordered = {};
+    segmentFields
+        .filter((field) => field in decoded)
+        .forEach((field) => (ordered[field] = decoded[field]));
+
+    return Object.assign(ordered, decoded);
+}
+
+// Turns a parsed results object from S3 into the v1 structure, whatever
+// encoding and compression the backend used to write it
+function decodeParsedResults(res) {
+    let body = res.Body;
+
+    if (res.ContentEncoding === "gzip") {
+        body = zlib.gunzipSync(body);
+    } else if (res.ContentEncoding) {
+        throw new Error(`Unsupported content encoding: ${res.ContentEncoding}`);
+    }
+
+    const parsed = JSON.parse(body.toString());
+
+    if (parsed.FormatVersion !== 2) {
+        return parsed;
+    }
+
+    const { FormatVersion, SpeechSegments, ...rest } = parsed;
+
+    return {
+        ...rest,
+        SpeechSegments: SpeechSegments.map(convertSegmentToV1),
+    };
+}
+
+exports.decodeParsedResults = decodeParsedResults;
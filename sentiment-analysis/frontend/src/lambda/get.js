@@ -1,4 +1,5 @@
 const AWS = require("aws-sdk");
+const { decodeParsedResults } = require("./format");
 const s3 = new AWS.S3();
 
 const dataBucket = process.env.DataBucket;
@@ -21,7 +22,7 @@ async function getData(key) {
     }
     console.log("Res:", res);
 
-    const data = JSON.parse(res.Body.toString());
+    const data = decodeParsedResults(res);
 
     const jobInfo =
         data.ConversationAnalytics.SourceInformation[0].TranscribeJobInfo;
@@ -1,4 +1,5 @@
 const AWS = require("aws-sdk");
+const { decodeParsedResults } = require("./format");
 const s3 = new AWS.S3();
 const ddb = new AWS.DynamoDB();
 
@@ -21,46 +22,93 @@ function makeItem(pk, sk, tk, data) {
     };
 }
 
+// Metadata keys on a parsed results object that point at its header object,
+// hold the hash of its content, and hold the hash of the content that the
+// processor built our items from if it wrote them itself
+const headerKeyMetadata = "pca-header-key";
+const contentHashMetadata = "pca-content-hash";
+const indexedHashMetadata = "pca-indexed-hash";
+
+async function loadCallHeader(bucket, key, head) {
+    // If the processor wrote a header object alongside the results then that's
+    // all that we need, so we don't have to download the whole transcript
+    const headerKey = head.Metadata[headerKeyMetadata];
+
+    if (headerKey) {
+        try {
+            const res = await s3
+                .getObject({
+                    Bucket: bucket,
+                    Key: headerKey,
+                })
+                .promise();
+            const header = JSON.parse(res.Body.toString());
+            console.log("Header:", header);
+
+            return {
+                analytics: header.ConversationAnalytics,
+                duration: header.Summary.Duration,
+            };
+        } catch (e) {
+            console.log("Unable to read header", headerKey, e);
+        }
+    }
+
+    const res = await s3
+        .getObject({
+            Bucket: bucket,
+            Key: key,
+        })
+        .promise();
+    console.log("Res:", res);
+
+    const parsed = decodeParsedResults(res);
+    console.log("Parsed:", parsed);
+
+    return {
+        analytics: parsed.ConversationAnalytics,
+        duration:
+            parsed.SpeechSegments[parsed.SpeechSegments.length - 1]
+                .SegmentEndTime,
+    };
+}
+
 async function createRecord(record) {
     const key = record.s3.object.key;
     console.log("Creating:", key);
 
-    let res;
-    try {
-        res = await s3
-            .getObject({
-                Bucket: record.s3.bucket.name,
-                Key: key,
-            })
-            .promise();
-    } catch (e) {
-        throw e;
-    }
-    console.log("Res:", res);
+    const head = await s3
+        .headObject({
+            Bucket: record.s3.bucket.name,
+            Key: key,
+        })
+        .promise();
 
-    const body = res.Body.toString();
+    // Nothing to do if the processor has already written the items for
+    // exactly this version of the file
+    const indexedHash = head.Metadata[indexedHashMetadata];
 
-    const parsed = JSON.parse(body);
-    console.log("Parsed:", parsed);
+    if (indexedHash && indexedHash === head.Metadata[contentHashMetadata]) {
+        console.log("Already indexed:", key);
+        return "Already indexed";
+    }
+
+    const header = await loadCallHeader(record.s3.bucket.name, key, head);
+    const analytics = header.analytics;
 
-    const jobInfo =
-        parsed.ConversationAnalytics.SourceInformation[0].TranscribeJobInfo;
+    const jobInfo = analytics.SourceInformation[0].TranscribeJobInfo;
 
-    let timestamp = new Date(
-        parsed.ConversationAnalytics.ConversationTime
-    ).getTime();
+    let timestamp = new Date(analytics.ConversationTime).getTime();
     console.log("Timestamp:", timestamp);
 
     let data = JSON.stringify({
         key: key,
         jobName: jobInfo.TranscriptionJobName,
         accuracy: jobInfo.AverageAccuracy,
-        lang: parsed.ConversationAnalytics.LanguageCode,
-        duration:
-            parsed.SpeechSegments[parsed.SpeechSegments.length - 1]
-                .SegmentEndTime,
+        lang: analytics.LanguageCode,
+        duration: header.duration,
         timestamp: timestamp,
-        location: parsed.ConversationAnalytics.ConversationLocation,
+        location: analytics.ConversationLocation,
     });
     console.log("Data:", data);
 
@@ -70,7 +118,7 @@ async function createRecord(record) {
     let items = [makeItem(callId, "call", timestamp, data)];
 
     // Sentiment entries
-    const sentiments = parsed.ConversationAnalytics.SentimentTrends;
+    const sentiments = analytics.SentimentTrends;
 
     if(sentiments.length > 0) {
         items.push(
@@ -111,7 +159,7 @@ async function createRecord(record) {
     }
 
     // Entities
-    parsed.ConversationAnalytics.CustomEntities.forEach((entity) => {
+    analytics.CustomEntities.forEach((entity) => {
         entity.Values.forEach((value) => {
             const entityId = `entity#${value}`;
 
@@ -124,7 +172,7 @@ async function createRecord(record) {
     });
 
     // Language
-    const language = parsed.ConversationAnalytics.LanguageCode;
+    const language = analytics.LanguageCode;
     const languageId = `language#${language}`;
 
     // Language record
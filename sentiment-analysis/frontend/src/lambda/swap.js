@@ -1,4 +1,5 @@
 const AWS = require("aws-sdk");
+const { decodeParsedResults } = require("./format");
 const ddb = new AWS.DynamoDB();
 const s3 = new AWS.S3();
 
@@ -75,9 +76,7 @@ async function getData(key) {
     }
     console.log("Res:", res);
 
-    const body = res.Body.toString();
-
-    return JSON.parse(body);
+    return decodeParsedResults(res);
 }
 
 async function putData(key, data) {
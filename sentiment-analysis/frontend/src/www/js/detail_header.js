@@ -54,8 +54,22 @@ export default function (data, speakers) {
         audio_failed();
     }
 
-    // Sentiment trends
+    // Sentiment trends - a call that has only been transcribed so far has none, and
+    // one whose analysis is part way through only has trends for some of its segments
     util.Set("detail_sentiment", "");
+    if (header.Status === "PARTIAL") {
+        let tr = util.Make("tr");
+        tr.appendChild(util.Make("th", "Sentiment"));
+        tr.appendChild(util.Make("td", "Analysis incomplete - these trends only cover part of the call"));
+        detail_sentiment.appendChild(tr);
+    }
+    if (header.Status === "TRANSCRIBED") {
+        let tr = util.Make("tr");
+        tr.appendChild(util.Make("th", "Sentiment"));
+        tr.appendChild(util.Make("td", "Analysis in progress - refresh to see the results"));
+        detail_sentiment.appendChild(tr);
+        return;
+    }
     header.SentimentTrends.forEach((trend) => {
         let tr = util.Make("tr");
 